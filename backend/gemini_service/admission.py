@@ -0,0 +1,98 @@
+# backend/gemini_service/admission.py
+import time
+from typing import Any, Dict, Optional
+
+# WebSocket close codes used when admission is refused
+CLOSE_TRY_AGAIN_LATER = 1013 # Server at capacity
+CLOSE_POLICY_VIOLATION = 1008 # Client kept exceeding its rate limit
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Consume one token; returns 0 on success, else seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class AdmissionController:
+    """Per-worker admission limits: open connections, concurrent generations and a
+    per-client message rate. Work over a limit is rejected up front instead of queueing
+    behind everyone else."""
+
+    def __init__(self, max_connections: int, max_inflight_generations: int,
+                 client_rate: float, client_burst: float, max_rate_violations: int = 20):
+        self.max_connections = max_connections
+        self.max_inflight_generations = max_inflight_generations
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.max_rate_violations = max_rate_violations
+        self.connections = 0
+        self.inflight = 0
+        self._inflight_by_client: Dict[str, int] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._violations: Dict[str, int] = {}
+        self.counters = {"rejected_connections": 0, "rejected_generations": 0, "rate_limited": 0}
+
+    # --- Connections ---
+    def admit_connection(self, client_id: str) -> bool:
+        if self.connections >= self.max_connections:
+            self.counters["rejected_connections"] += 1
+            return False
+        self.connections += 1
+        # A reconnect that overlaps the old socket keeps its bucket rather than starting full
+        self._buckets.setdefault(client_id, TokenBucket(self.client_rate, self.client_burst))
+        self._violations.setdefault(client_id, 0)
+        return True
+
+    def release_connection(self, client_id: str, forget_client: bool = True):
+        self.connections = max(0, self.connections - 1)
+        if forget_client:
+            self._buckets.pop(client_id, None)
+            self._violations.pop(client_id, None)
+
+    # --- Messages ---
+    def check_rate(self, client_id: str) -> Optional[Dict[str, Any]]:
+        """None if the message may proceed, else the rejection frame to send back"""
+        bucket = self._buckets.get(client_id)
+        if bucket is None: return None
+        retry_after = bucket.take()
+        if not retry_after:
+            return None
+        self.counters["rate_limited"] += 1
+        self._violations[client_id] = self._violations.get(client_id, 0) + 1
+        return {"type": "error", "code": "rate_limited", "error": "Too many messages, slow down", "retry_after": round(retry_after, 2)}
+
+    def should_disconnect(self, client_id: str) -> bool:
+        return self._violations.get(client_id, 0) >= self.max_rate_violations
+
+    # --- Generations ---
+    def start_generation(self, client_id: str) -> bool:
+        if self.inflight >= self.max_inflight_generations:
+            self.counters["rejected_generations"] += 1
+            return False
+        self.inflight += 1
+        self._inflight_by_client[client_id] = self._inflight_by_client.get(client_id, 0) + 1
+        return True
+
+    def finish_generation(self, client_id: str):
+        self.inflight = max(0, self.inflight - 1)
+        remaining = self._inflight_by_client.get(client_id, 0) - 1
+        if remaining > 0: self._inflight_by_client[client_id] = remaining
+        else: self._inflight_by_client.pop(client_id, None)
+
+    def is_generating(self, client_id: str) -> bool:
+        return client_id in self._inflight_by_client
+
+    def stats(self) -> Dict[str, Any]:
+        return {"connections": self.connections, "max_connections": self.max_connections,
+                "inflight_generations": self.inflight, "max_inflight_generations": self.max_inflight_generations,
+                **self.counters}
@@ -0,0 +1,359 @@
+# backend/gemini_service/attachment_preprocess.py
+import asyncio
+import io
+import logging
+import mimetypes
+import multiprocessing
+import re
+import time
+import zipfile
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+from xml.etree import ElementTree
+
+logger = logging.getLogger(__name__)
+
+DOCX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+PPTX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
+IMAGE_MIME_TYPES = ("image/png", "image/jpeg", "image/webp", "image/heic", "image/heif")
+DOCUMENT_KINDS = {"application/pdf": "pdf", DOCX_MIME_TYPE: "docx", PPTX_MIME_TYPE: "pptx"}
+# pydub/ffmpeg input format per MIME type; None lets ffmpeg probe
+AUDIO_FORMATS = {"audio/wav": "wav", "audio/mp3": "mp3", "audio/mpeg": "mp3", "audio/ogg": "ogg", "audio/opus": "ogg",
+                 "audio/flac": "flac", "audio/aac": "aac", "audio/aiff": "aiff", "audio/x-m4a": None}
+MAX_XML_BYTES = 64 * 1024 * 1024 # Uncompressed size of one document part; larger ones (or zip bombs) are sent as-is
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_A = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+
+# (data, mime_type, what was done), or None when the original should be sent
+Result = Optional[Tuple[bytes, str, str]]
+
+# --- Worker side: module-level functions so they pickle into the process pool ---
+
+def preprocess(kind: str, source: Union[bytes, str], mime_type: str, options: Dict[str, Any]) -> Result:
+    """Shrink one attachment (runs in a pool worker). `source` is the content or the path of a spilled upload."""
+    if isinstance(source, str):
+        with open(source, "rb") as f: source = f.read()
+    result = {"image": _image, "audio": _audio, "pdf": _pdf, "docx": _docx, "pptx": _pptx}[kind](source, mime_type, options)
+    return result if result is None or len(result[0]) < len(source) else None # Only ever send fewer bytes
+
+def _image(data: bytes, mime_type: str, options: Dict[str, Any]) -> Result:
+    """Downscale to `image_max_side` and re-encode; HEIC/HEIF (when pillow-heif is installed) become JPEG"""
+    from PIL import Image, ImageOps
+    heif = mime_type in ("image/heic", "image/heif")
+    if heif:
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+    max_side = options["image_max_side"]
+    Image.MAX_IMAGE_PIXELS = options["image_max_pixels"] # Decompression bombs fail in open() instead of filling the worker's memory
+    with Image.open(io.BytesIO(data)) as image:
+        if getattr(image, "is_animated", False): return None
+        size = image.size
+        if size[0] * size[1] > options["image_max_pixels"]: return None # PIL only refuses at twice its limit
+        if max(size) <= max_side and len(data) <= options["image_max_bytes"] and not heif: return None
+        image.draft("RGB", (max_side, max_side)) # JPEG decodes straight at a reduced scale
+        image = ImageOps.exif_transpose(image) # Orientation is lost with the EXIF block otherwise
+        if max(image.size) > max_side: image.thumbnail((max_side, max_side), Image.LANCZOS)
+        out = io.BytesIO()
+        if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+            image.save(out, "WEBP", quality=options["image_quality"])
+            out_mime = "image/webp"
+        else:
+            image.convert("RGB").save(out, "JPEG", quality=options["image_quality"], optimize=True)
+            out_mime = "image/jpeg"
+        return out.getvalue(), out_mime, f"image {size[0]}x{size[1]} -> {image.size[0]}x{image.size[1]} {out_mime.split('/')[1]}"
+
+def _audio(data: bytes, mime_type: str, options: Dict[str, Any]) -> Result:
+    """Downmix to mono and resample to `audio_sample_rate` (the model hears speech at 16kHz anyway)"""
+    from pydub import AudioSegment
+    segment = AudioSegment.from_file(io.BytesIO(data), format=AUDIO_FORMATS.get(mime_type))
+    rate, channels = segment.frame_rate, segment.channels
+    segment = segment.set_channels(1).set_frame_rate(min(rate, options["audio_sample_rate"]))
+    out = io.BytesIO()
+    audio_format = options["audio_format"]
+    segment.export(out, format=audio_format, bitrate=options["audio_bitrate"] if audio_format != "wav" else None)
+    return out.getvalue(), f"audio/{audio_format}", f"audio {rate}Hz/{channels}ch -> {segment.frame_rate}Hz/1ch {audio_format}"
+
+def _text(text: str, note: str) -> Result:
+    text = re.sub(r"\n{3,}", "\n\n", text).strip()
+    return (text.encode("utf-8"), "text/plain", note) if text else None
+
+def _pdf(data: bytes, mime_type: str, options: Dict[str, Any]) -> Result:
+    """Text layer of a PDF; PDFs with little text per page (scans, slides, charts) are sent as-is for the model to look at"""
+    from pypdf import PdfReader
+    reader = PdfReader(io.BytesIO(data))
+    if len(reader.pages) > options["pdf_max_pages"]: return None # Extraction time grows with pages; long documents go as-is
+    pages = [page.extract_text() or "" for page in reader.pages]
+    if not pages or sum(len(page.strip()) for page in pages) < options["pdf_min_chars_per_page"] * len(pages): return None
+    return _text("\n\n".join(f"[Page {number}]\n{page.strip()}" for number, page in enumerate(pages, 1)), f"pdf text ({len(pages)} pages)")
+
+def _xml_part(archive: zipfile.ZipFile, name: str) -> Optional[ElementTree.Element]:
+    info = archive.getinfo(name)
+    if info.file_size > MAX_XML_BYTES: return None
+    return ElementTree.fromstring(archive.read(info))
+
+def _docx(data: bytes, mime_type: str, options: Dict[str, Any]) -> Result:
+    """Paragraph text of a Word document (python-docx isn't needed for this: it is XML in a zip)"""
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        body = _xml_part(archive, "word/document.xml")
+    if body is None: return None
+    paragraphs = []
+    for paragraph in body.iter(f"{_W}p"):
+        text = []
+        for node in paragraph.iter():
+            if node.tag == f"{_W}t": text.append(node.text or "")
+            elif node.tag == f"{_W}tab": text.append("\t")
+            elif node.tag in (f"{_W}br", f"{_W}cr"): text.append("\n")
+        paragraphs.append("".join(text))
+    return _text("\n".join(paragraphs), "docx text")
+
+def _pptx(data: bytes, mime_type: str, options: Dict[str, Any]) -> Result:
+    """Text of each slide of a PowerPoint deck, in slide order"""
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        names = sorted((name for name in archive.namelist() if re.fullmatch(r"ppt/slides/slide\d+\.xml", name)),
+                       key=lambda name: int(re.search(r"\d+", name.rsplit("/", 1)[1]).group()))
+        slides = [_xml_part(archive, name) for name in names]
+    if not slides or any(slide is None for slide in slides): return None
+    text = ["\n".join("".join(t.text or "" for t in paragraph.iter(f"{_A}t")) for paragraph in slide.iter(f"{_A}p"))
+            for slide in slides]
+    return _text("\n\n".join(f"[Slide {number}]\n{body.strip()}" for number, body in enumerate(text, 1)), f"pptx text ({len(slides)} slides)")
+
+def _worker_main(conn):
+    """Pool worker: runs (fn, args) jobs received on `conn` until it gets None"""
+    while True:
+        try: job = conn.recv()
+        except EOFError: return
+        if job is None: return
+        fn, args = job
+        try: reply = (True, fn(*args))
+        except Exception as e: reply = (False, e if isinstance(e, ImportError) else RuntimeError(f"{type(e).__name__}: {e}")) # Any exception unpickles
+        conn.send(reply)
+
+# --- Event-loop side ---
+
+class WorkerDied(RuntimeError):
+    """The worker running a job exited before answering (crashed or was killed)"""
+
+class _Worker:
+    __slots__ = ("process", "conn")
+
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child,), name="attachment-preprocess", daemon=True)
+        self.process.start()
+        child.close() # Only the worker holds it now, so recv() sees EOF once the worker exits
+
+    def call(self, fn: Callable, args: Tuple) -> Any:
+        """Send a job and wait for its reply (runs in a thread)"""
+        try:
+            self.conn.send((fn, args))
+            ok, value = self.conn.recv()
+        except (EOFError, OSError) as e:
+            raise WorkerDied(f"Preprocessing worker {self.process.pid} exited ({self.process.exitcode})") from e
+        if not ok: raise value
+        return value
+
+class WorkerPool:
+    """Worker processes that each run one job at a time. Unlike ProcessPoolExecutor it knows which
+    worker runs which job, so a job that overruns its timeout is stopped by killing just its worker:
+    jobs on the other workers carry on, and a new worker replaces the killed one on demand."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._context = multiprocessing.get_context()
+        self._idle: List[_Worker] = []
+        self._busy: Set[_Worker] = set()
+        self._slots = asyncio.Semaphore(workers)
+        self.counters = {"started": 0, "killed": 0}
+
+    def start(self):
+        """Start every worker now (e.g. before the server starts threads, since they are forked)"""
+        while len(self._idle) + len(self._busy) < self.workers: self._idle.append(self._spawn())
+
+    def _spawn(self) -> _Worker:
+        self.counters["started"] += 1
+        return _Worker(self._context)
+
+    async def run(self, fn: Callable, *args: Any, timeout: Optional[float] = None) -> Any:
+        """fn(*args) in a worker; raises asyncio.TimeoutError (the worker is killed), WorkerDied, or what fn raised"""
+        async with self._slots:
+            worker = self._idle.pop() if self._idle else self._spawn()
+            self._busy.add(worker)
+            reusable = False
+            try:
+                result = await asyncio.wait_for(asyncio.to_thread(worker.call, fn, args), timeout)
+                reusable = True
+                return result
+            except WorkerDied:
+                raise
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                raise # Still running: killed below
+            except Exception:
+                reusable = True # fn raised; the worker answered and is fine
+                raise
+            finally:
+                self._busy.discard(worker)
+                if reusable: self._idle.append(worker)
+                else: self._kill(worker)
+
+    def _kill(self, worker: _Worker):
+        """Its reader thread then sees EOF and returns; the process is reaped when the next one starts"""
+        if worker.process.is_alive(): worker.process.kill()
+        self.counters["killed"] += 1
+
+    def close(self):
+        for worker in self._idle:
+            try: worker.conn.send(None)
+            except OSError: pass
+            worker.conn.close()
+        for worker in list(self._busy): self._kill(worker)
+        self._idle.clear()
+        self._busy.clear()
+
+class AttachmentPreprocessor:
+    """Shrinks new attachments before they are sent upstream: images downscaled and re-encoded,
+    audio resampled to mono, PDF/DOCX/PPTX reduced to their text. The work runs in a process
+    pool, so a large file never stalls other connections; results (including "leave it as it
+    is") are cached by content hash, and concurrent requests for the same content share one job.
+
+    A failed, timed-out or unhelpful job falls back to sending the original file. A timed-out job
+    is still running, so its worker is killed and replaced rather than left stuck; jobs running
+    on the other workers are not affected.
+    """
+
+    def __init__(self,
+                 workers: int = 2,
+                 cache_max_bytes: int = 64 * 1024 * 1024,
+                 min_bytes: int = 256 * 1024, # Smaller images and audio are sent as they are
+                 timeout: float = 30.0,
+                 image_max_side: int = 1536, # 0 leaves images alone
+                 image_max_bytes: int = 1024 * 1024, # Smaller images are re-encoded only when too large in pixels
+                 image_max_pixels: int = 64_000_000, # Larger images are not decoded at all
+                 image_quality: int = 85,
+                 audio_sample_rate: int = 16000, # 0 leaves audio alone
+                 audio_format: str = "mp3",
+                 audio_bitrate: str = "32k",
+                 document_text: bool = True,
+                 pdf_min_chars_per_page: int = 200,
+                 pdf_max_pages: int = 300,
+                 max_inline_bytes: int = 20 * 1024 * 1024): # Spilled uploads whose result is still larger keep using the File API
+        self.workers = workers
+        self.cache_max_bytes = cache_max_bytes
+        self.min_bytes = min_bytes
+        self.timeout = timeout
+        self.max_inline_bytes = max_inline_bytes
+        self.options = {"image_max_side": image_max_side, "image_max_bytes": image_max_bytes, "image_max_pixels": image_max_pixels,
+                        "image_quality": image_quality, "audio_sample_rate": audio_sample_rate, "audio_format": audio_format,
+                        "audio_bitrate": audio_bitrate, "document_text": document_text, "pdf_min_chars_per_page": pdf_min_chars_per_page,
+                        "pdf_max_pages": pdf_max_pages}
+        self._pool = WorkerPool(workers)
+        self._cache: "OrderedDict[str, Result]" = OrderedDict()
+        self._cache_bytes = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._unavailable: "set[str]" = set() # MIME types whose optional library is missing (logged once)
+        self.counters = {"processed": 0, "unchanged": 0, "skipped": 0, "cache_hits": 0, "coalesced": 0, "failed": 0, "timeouts": 0,
+                         "workers_replaced": 0, "bytes_in": 0, "bytes_out": 0, "job_ms": 0.0}
+
+    def start(self):
+        """Fork the workers now, while the server is still single-threaded"""
+        self._pool.start()
+
+    def close(self):
+        self._pool.close()
+
+    def _kind(self, mime_type: Optional[str], size: int) -> Optional[str]:
+        if mime_type in DOCUMENT_KINDS: return DOCUMENT_KINDS[mime_type] if self.options["document_text"] else None
+        if size < self.min_bytes: return None
+        if mime_type in IMAGE_MIME_TYPES: return "image" if self.options["image_max_side"] else None
+        if mime_type in AUDIO_FORMATS: return "audio" if self.options["audio_sample_rate"] else None
+        return None # Video is sampled at 1fps upstream; transcoding it here would cost more than it saves
+
+    async def prepare_all(self, files: List[Dict[str, Any]], skip: Optional[Callable[[Dict[str, Any]], bool]] = None) -> List[Dict[str, Any]]:
+        """prepare() every file concurrently, except those `skip` rejects (e.g. already prepared and stored)"""
+        pending = [i for i, entry in enumerate(files) if not (skip and skip(entry))]
+        prepared = list(files)
+        for i, entry in zip(pending, await asyncio.gather(*(self.prepare(files[i]) for i in pending))): prepared[i] = entry
+        return prepared
+
+    async def prepare(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        """The file entry (mime_type, data, filename, path, sha256) to send instead: a copy with the smaller content,
+        its MIME type and a "preprocessed" note, or `entry` itself"""
+        data = entry.get("data")
+        if data is None: return entry
+        size = memoryview(data).nbytes
+        mime_type = entry.get("mime_type") or mimetypes.guess_type(entry.get("filename") or "")[0]
+        kind = self._kind(mime_type, size)
+        if kind is None:
+            self.counters["skipped"] += 1
+            return entry
+        digest = entry.get("sha256")
+        if digest in self._cache:
+            self.counters["cache_hits"] += 1
+            self._cache.move_to_end(digest)
+            result = self._cache[digest]
+        else:
+            job = self._inflight.get(digest) if digest else None
+            if job is None:
+                source = entry["path"] if entry.get("path") else data if isinstance(data, bytes) else bytes(data)
+                job = asyncio.ensure_future(self._run(kind, source, mime_type, size))
+                if digest:
+                    self._inflight[digest] = job
+                    job.add_done_callback(lambda job: self._finished(digest, job))
+            else:
+                self.counters["coalesced"] += 1
+            try: result = await asyncio.shield(job) # A client going away doesn't cancel work others may share
+            except (asyncio.TimeoutError, WorkerDied): return entry
+        if result is None or (len(result[0]) > self.max_inline_bytes and entry.get("path")): return entry
+        return {**entry, "data": result[0], "mime_type": result[1], "path": None, "preprocessed": result[2], "original_size": size}
+
+    async def _run(self, kind: str, source: Union[bytes, str], mime_type: str, size: int) -> Result:
+        started = time.perf_counter()
+        try:
+            result = await self._pool.run(preprocess, kind, source, mime_type, self.options, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.counters["timeouts"] += 1
+            self.counters["workers_replaced"] += 1
+            logger.warning(f"Preprocessing {kind} ({mime_type}, {size} bytes) took over {self.timeout}s; sending it as-is and replacing its worker")
+            raise # Not cached: may well finish next time
+        except ImportError as e:
+            if mime_type not in self._unavailable:
+                self._unavailable.add(mime_type)
+                logger.warning(f"{mime_type} attachments are sent as-is: {e}")
+            return None
+        except WorkerDied as e:
+            self.counters["failed"] += 1
+            self.counters["workers_replaced"] += 1
+            logger.error(f"{e} while preprocessing {kind} ({mime_type}, {size} bytes); sending it as-is")
+            raise
+        except Exception as e:
+            self.counters["failed"] += 1
+            logger.warning(f"Preprocessing {kind} ({mime_type}, {size} bytes) failed, sending it as-is: {e}")
+            return None
+        finally:
+            self.counters["job_ms"] += (time.perf_counter() - started) * 1000
+        if result is None:
+            self.counters["unchanged"] += 1
+            return None
+        self.counters["processed"] += 1
+        self.counters["bytes_in"] += size
+        self.counters["bytes_out"] += len(result[0])
+        logger.info(f"Preprocessed {kind}: {result[2]}, {size} -> {len(result[0])} bytes in {(time.perf_counter() - started) * 1000:.0f}ms")
+        return result
+
+    def _finished(self, digest: str, job: asyncio.Future):
+        self._inflight.pop(digest, None)
+        if job.cancelled() or job.exception() is not None: return
+        result = job.result()
+        size = len(result[0]) if result else 0
+        if size > self.cache_max_bytes: return
+        self._cache[digest] = result
+        self._cache_bytes += size
+        while self._cache_bytes > self.cache_max_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= len(evicted[0]) if evicted else 0
+
+    def stats(self) -> Dict[str, Any]:
+        processed_in = self.counters["bytes_in"]
+        return {"workers": self.workers, "inflight": len(self._inflight), "cached": len(self._cache), "cache_bytes": self._cache_bytes,
+                "saved_ratio": round(1 - self.counters["bytes_out"] / processed_in, 3) if processed_in else 0,
+                **self.counters, "job_ms": round(self.counters["job_ms"], 1)}
@@ -0,0 +1,90 @@
+# backend/gemini_service/attachment_store.py
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class StoredAttachment:
+    def __init__(self, digest: str, part: Any, mime_type: str, filename: Optional[str], size: int):
+        self.digest = digest
+        self.part = part # Prepared upstream part (glm.Part), reused as-is on later turns
+        self.mime_type = mime_type
+        self.filename = filename
+        self.size = size
+        self.refcount = 0
+        self.created_at = time.time()
+
+class AttachmentStore:
+    """Content-addressed (SHA-256) store of prepared attachment parts shared by all connections.
+
+    Connections pin the digests they use with acquire()/release(); only unpinned entries
+    are evicted (least recently used first) once the store exceeds `max_bytes`, or when
+    older than `max_age` (File API uploads expire upstream).
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, max_age: float = 24 * 3600):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries: "OrderedDict[str, StoredAttachment]" = OrderedDict()
+        self._bytes = 0
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "rejected": 0}
+
+    def get(self, digest: str) -> Optional[StoredAttachment]:
+        entry = self._entries.get(digest)
+        if entry is not None and not entry.refcount and time.time() - entry.created_at > self.max_age:
+            self._remove(digest); entry = None
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+        self._entries.move_to_end(digest)
+        self.counters["hits"] += 1
+        return entry
+
+    def __contains__(self, digest: str) -> bool:
+        """Whether a part is stored for `digest`, without counting a hit or refreshing it"""
+        return digest in self._entries
+
+    def put(self, digest: str, part: Any, mime_type: str, filename: Optional[str], size: int) -> Optional[StoredAttachment]:
+        """Store a prepared part; returns None when pinned entries leave no room for it"""
+        existing = self._entries.get(digest)
+        if existing is not None:
+            return existing
+        self._evict(self.max_bytes - size)
+        if self._bytes + size > self.max_bytes:
+            self.counters["rejected"] += 1
+            logger.warning(f"Attachment store full ({self._bytes}/{self.max_bytes} bytes pinned); not storing {digest[:12]}")
+            return None
+        entry = self._entries[digest] = StoredAttachment(digest, part, mime_type, filename, size)
+        self._bytes += size
+        self.counters["stores"] += 1
+        return entry
+
+    def acquire(self, digest: str) -> bool:
+        """Pin an entry so it survives eviction; returns False if the digest is unknown"""
+        entry = self._entries.get(digest)
+        if entry is None: return False
+        entry.refcount += 1
+        return True
+
+    def release(self, digest: str):
+        entry = self._entries.get(digest)
+        if entry is not None and entry.refcount > 0:
+            entry.refcount -= 1
+            if self._bytes > self.max_bytes: self._evict(self.max_bytes)
+
+    def _evict(self, target_bytes: int):
+        if self._bytes <= target_bytes: return
+        for digest in [d for d, e in self._entries.items() if not e.refcount]: # LRU order
+            self._remove(digest)
+            self.counters["evictions"] += 1
+            if self._bytes <= target_bytes: break
+
+    def _remove(self, digest: str):
+        entry = self._entries.pop(digest)
+        self._bytes -= entry.size
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                "pinned": sum(1 for e in self._entries.values() if e.refcount), **self.counters}
@@ -0,0 +1,201 @@
+# backend/gemini_service/audio_pipeline.py
+import asyncio
+import logging
+import shutil
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+SendAudio = Callable[[bytes], Awaitable[None]]
+
+# ffmpeg output arguments per transcoded format ("pcm" is passed through untouched)
+ENCODER_ARGS = {
+    "mp3": ["-c:a", "libmp3lame", "-b:a", "64k", "-f", "mp3"],
+    "opus": ["-c:a", "libopus", "-b:a", "32k", "-application", "voip", "-page_duration", "20000", "-f", "ogg"],
+}
+
+class StreamingEncoder:
+    """One long-lived ffmpeg process per response: raw PCM in on stdin, encoded audio out on stdout.
+
+    Spawning a single process per stream avoids paying ffmpeg start-up for every chunk, and
+    keeps encoding off the event loop (and off this process's GIL).
+    """
+
+    def __init__(self, output_format: str, sample_rate: int, channels: int, send_audio: SendAudio, read_size: int = 4096):
+        self.output_format = output_format
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.send_audio = send_audio
+        self.read_size = read_size
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._reader: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-f", "s16le", "-ar", str(self.sample_rate), "-ac", str(self.channels), "-i", "pipe:0",
+            *ENCODER_ARGS[self.output_format], "-flush_packets", "1", "pipe:1",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        self._reader = asyncio.create_task(self._forward_output(), name="audio-encoder-output")
+
+    async def write(self, pcm: bytes):
+        self._process.stdin.write(pcm)
+        await self._process.stdin.drain()
+
+    async def finish(self):
+        """Close stdin and wait until every encoded byte has been forwarded"""
+        if not self._process: return
+        try:
+            self._process.stdin.close()
+            await self._reader
+        finally:
+            await self._process.wait()
+            self._process = None
+
+    def kill(self):
+        if self._reader: self._reader.cancel()
+        if self._process and self._process.returncode is None:
+            self._process.kill()
+        self._process = None
+
+    async def _forward_output(self):
+        while True:
+            data = await self._process.stdout.read(self.read_size)
+            if not data: return
+            await self.send_audio(data)
+
+class AudioEgress:
+    """Per-connection audio egress: a bounded jitter buffer drained by a background task.
+
+    submit() never blocks the text stream: audio chunks are buffered (dropping the oldest
+    once `max_buffer_ms` is exceeded) and a separate task cuts them into whole PCM frames
+    of `frame_ms`, optionally transcodes them, and sends them. end_stream() flushes and waits
+    for the current response's audio; reset() discards it after an interrupt.
+    """
+
+    def __init__(self,
+                 send_audio: SendAudio,
+                 output_format: str = "pcm",
+                 sample_rate: int = 24000,
+                 channels: int = 1,
+                 sample_width: int = 2,
+                 frame_ms: int = 20,
+                 max_buffer_ms: int = 5000,
+                 max_packet_frames: int = 5):
+        if output_format != "pcm" and output_format not in ENCODER_ARGS:
+            raise ValueError(f"Unsupported audio output format '{output_format}'")
+        if output_format != "pcm" and not shutil.which("ffmpeg"):
+            logger.warning(f"ffmpeg not found; sending raw PCM instead of {output_format}")
+            output_format = "pcm"
+        self.send_audio = send_audio
+        self.output_format = output_format
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frame_bytes = sample_rate * channels * sample_width * frame_ms // 1000
+        self.max_packet_bytes = self.frame_bytes * max_packet_frames
+        self.max_buffer_bytes = sample_rate * channels * sample_width * max_buffer_ms // 1000
+
+        self._buffer: Deque[bytes] = deque()
+        self._buffered_bytes = 0
+        self._remainder = bytearray() # Partial frame carried over to the next chunk
+        self._available = asyncio.Event()
+        self._idle = asyncio.Event(); self._idle.set()
+        self._flush_requested = False
+        self._encoder: Optional[StreamingEncoder] = None
+        self._task: Optional[asyncio.Task] = None
+        self._error: Optional[BaseException] = None
+        self.stats_counters = {"chunks_in": 0, "bytes_in": 0, "packets_out": 0, "dropped_chunks": 0}
+
+    @property
+    def format_info(self) -> Dict[str, object]:
+        return {"format": self.output_format, "sample_rate": self.sample_rate, "channels": self.channels}
+
+    @property
+    def buffered_bytes(self) -> int:
+        return self._buffered_bytes + len(self._remainder)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name="audio-egress")
+
+    def submit(self, audio: bytes):
+        """Queue an upstream audio chunk without waiting for it to be sent"""
+        if self._error: raise self._error
+        self._buffer.append(bytes(audio))
+        self._buffered_bytes += len(audio)
+        self.stats_counters["chunks_in"] += 1; self.stats_counters["bytes_in"] += len(audio)
+        while self._buffered_bytes > self.max_buffer_bytes and len(self._buffer) > 1:
+            self._buffered_bytes -= len(self._buffer.popleft())
+            self.stats_counters["dropped_chunks"] += 1
+        self._idle.clear()
+        self._available.set()
+
+    async def end_stream(self):
+        """Send the trailing partial frame, finish the encoder and wait for the buffer to drain"""
+        if self._task is None: return
+        self._flush_requested = True
+        self._idle.clear()
+        self._available.set()
+        await self._idle.wait()
+        if self._error: raise self._error
+
+    def reset(self):
+        """Drop everything buffered for the current response (e.g. after an interrupt)"""
+        self._buffer.clear(); self._buffered_bytes = 0; self._remainder.clear()
+        self._flush_requested = False
+        if self._encoder: self._encoder.kill(); self._encoder = None
+        if self._task and not self._task.done():
+            self._task.cancel()
+            self._task = None
+        self._idle.set()
+        self.start()
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except (asyncio.CancelledError, Exception): pass
+            self._task = None
+        if self._encoder: self._encoder.kill(); self._encoder = None
+
+    async def _run(self):
+        try:
+            while True:
+                await self._available.wait()
+                self._available.clear()
+                while self._buffer:
+                    chunk = self._buffer.popleft()
+                    self._buffered_bytes -= len(chunk)
+                    self._remainder += chunk
+                    while len(self._remainder) >= self.frame_bytes:
+                        # Whole frames only, at most one packet at a time so sends stay small
+                        size = min(len(self._remainder) - len(self._remainder) % self.frame_bytes, self.max_packet_bytes)
+                        packet = bytes(self._remainder[:size])
+                        del self._remainder[:size]
+                        await self._emit(packet)
+                if self._flush_requested:
+                    self._flush_requested = False
+                    if self._remainder:
+                        packet = bytes(self._remainder); self._remainder.clear()
+                        await self._emit(packet)
+                    if self._encoder:
+                        encoder, self._encoder = self._encoder, None
+                        await encoder.finish()
+                if not self._buffer:
+                    self._idle.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Audio egress failed: {e}", exc_info=True)
+            self._error = e
+            self._idle.set()
+
+    async def _emit(self, pcm: bytes):
+        self.stats_counters["packets_out"] += 1
+        if self.output_format == "pcm":
+            await self.send_audio(pcm)
+            return
+        if self._encoder is None:
+            self._encoder = StreamingEncoder(self.output_format, self.sample_rate, self.channels, self.send_audio)
+            await self._encoder.start()
+        await self._encoder.write(pcm)
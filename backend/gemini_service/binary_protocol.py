@@ -0,0 +1,75 @@
+# backend/gemini_service/binary_protocol.py
+# Binary WebSocket framing used next to the JSON protocol on /ws/{client_id}.
+#
+# Every binary frame is a 12 byte header followed by the raw payload:
+#
+#     version (u8) | frame type (u8) | flags (u8) | reserved (u8) | stream id (u32) | seq (u32)
+#
+# Inbound FILE_CHUNK frames carry an upload (stream id = upload id, chunks numbered
+# from 0, last chunk flagged FINAL; see upload_stream.py); a later `multimodal_message`
+# refers to the file with `{"upload_id": <id>}` instead of base64 `data`. Outbound AUDIO_CHUNK frames
+# carry TTS audio (stream id = response number) and are only sent to clients that
+# negotiated the protocol with `{"type": "hello", "protocols": ["binary-v1"]}`;
+# other clients keep receiving raw audio bytes.
+import struct
+from typing import Union
+
+PROTOCOL_NAME = "binary-v1"
+PROTOCOL_VERSION = 1
+
+FRAME_FILE_CHUNK = 1
+FRAME_AUDIO_CHUNK = 2
+
+FLAG_FINAL = 0x01
+
+HEADER = struct.Struct("!BBBxII")
+HEADER_SIZE = HEADER.size
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+class ProtocolError(ValueError):
+    """Malformed or out-of-order binary frame"""
+
+class BinaryFrame:
+    def __init__(self, frame_type: int, flags: int, stream_id: int, seq: int, payload: memoryview):
+        self.frame_type = frame_type
+        self.flags = flags
+        self.stream_id = stream_id
+        self.seq = seq
+        self.payload = payload
+
+    @property
+    def final(self) -> bool:
+        return bool(self.flags & FLAG_FINAL)
+
+def decode_frame(data: Buffer) -> BinaryFrame:
+    """Parse a frame; the payload is a view into `data`, not a copy"""
+    if len(data) < HEADER_SIZE:
+        raise ProtocolError(f"Binary frame too short ({len(data)} bytes)")
+    version, frame_type, flags, stream_id, seq = HEADER.unpack_from(data)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported binary protocol version {version}")
+    return BinaryFrame(frame_type, flags, stream_id, seq, memoryview(data)[HEADER_SIZE:])
+
+def encode_frame(frame_type: int, stream_id: int, seq: int, payload: Buffer = b"", final: bool = False) -> bytes:
+    return b"".join((HEADER.pack(PROTOCOL_VERSION, frame_type, FLAG_FINAL if final else 0, stream_id, seq), payload))
+
+class AudioFramer:
+    """Wraps outbound TTS audio chunks in AUDIO_CHUNK frames, one stream per response"""
+
+    def __init__(self):
+        self.stream_id = 0
+        self.seq = 0
+
+    def start_stream(self):
+        self.stream_id = (self.stream_id + 1) & 0xFFFFFFFF
+        self.seq = 0
+
+    def frame(self, audio: Buffer) -> bytes:
+        data = encode_frame(FRAME_AUDIO_CHUNK, self.stream_id, self.seq, audio)
+        self.seq += 1
+        return data
+
+    def end_stream(self) -> bytes:
+        """Empty FINAL frame telling the client the response's audio is complete"""
+        return encode_frame(FRAME_AUDIO_CHUNK, self.stream_id, self.seq, final=True)
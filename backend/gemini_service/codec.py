@@ -0,0 +1,80 @@
+# backend/gemini_service/codec.py
+import json
+import logging
+from abc import ABC, abstractmethod
+from typing import Any, Union
+
+logger = logging.getLogger(__name__)
+
+# JSON encoding for WebSocket frames. orjson and msgspec are optional: both parse and
+# serialize several times faster than the stdlib, which matters most for the many small
+# chunks streamed per answer. Select with JSON_CODEC=auto|orjson|msgspec|stdlib.
+
+class JsonCodec(ABC):
+    """loads() accepts str or UTF-8 bytes; dumps() returns compact UTF-8 bytes, so len() is the frame size"""
+
+    name = "abstract"
+
+    @abstractmethod
+    def loads(self, data: Union[str, bytes]) -> Any: ...
+    @abstractmethod
+    def dumps(self, obj: Any) -> bytes: ...
+
+class StdlibCodec(JsonCodec):
+    name = "stdlib"
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        # ASCII-escaped, so encoding can't fail and the byte count equals the character count
+        return json.dumps(obj, separators=(",", ":")).encode("ascii")
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def __init__(self):
+        try:
+            import orjson
+        except ImportError as e:
+            raise RuntimeError("JSON_CODEC=orjson requires the 'orjson' package (pip install orjson)") from e
+        self._orjson = orjson
+        self.loads, self.dumps = orjson.loads, orjson.dumps # Shadow the methods below: one C call per frame, no Python wrapper
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+    def dumps(self, obj):
+        return self._orjson.dumps(obj)
+
+class MsgspecCodec(JsonCodec):
+    name = "msgspec"
+
+    def __init__(self):
+        try:
+            import msgspec
+        except ImportError as e:
+            raise RuntimeError("JSON_CODEC=msgspec requires the 'msgspec' package (pip install msgspec)") from e
+        self._decode = msgspec.json.Decoder().decode
+        self._decode_error = msgspec.DecodeError
+        self._encode = self.dumps = msgspec.json.Encoder().encode # Shadows dumps() below, as for orjson
+
+    def loads(self, data):
+        try: return self._decode(data)
+        except self._decode_error as e: raise ValueError(str(e)) from e # Same contract as json.loads
+
+    def dumps(self, obj):
+        return self._encode(obj)
+
+CODECS = {"orjson": OrjsonCodec, "msgspec": MsgspecCodec, "stdlib": StdlibCodec}
+
+def create_codec(name: str = "auto") -> JsonCodec:
+    """The named codec, or for 'auto' the fastest one installed"""
+    name = name.lower()
+    if name != "auto":
+        if name not in CODECS: raise ValueError(f"Unknown JSON codec '{name}'")
+        return CODECS[name]()
+    for factory in (OrjsonCodec, MsgspecCodec):
+        try: return factory()
+        except RuntimeError: continue
+    return StdlibCodec()
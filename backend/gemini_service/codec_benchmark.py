@@ -0,0 +1,70 @@
+# backend/gemini_service/codec_benchmark.py
+#
+# Single-core microbenchmark of the per-frame JSON work on the /ws hot path.
+#
+#   python codec_benchmark.py                 (run from backend/gemini_service)
+#   python codec_benchmark.py --seconds 2 --chunks 16
+#
+# For each available codec it times decoding an inbound text_message, validating it with
+# the same pydantic model main.py uses, and encoding one streamed text chunk for the
+# writer (codec bytes -> str for the ASGI text frame). "baseline" is the pre-codec path:
+# json.loads, and json.dumps straight to str. A message is one decode + validate plus
+# --chunks encodes (a streamed answer and its complete frame).
+import argparse
+import json
+import os
+import time
+from typing import Any, Callable, Dict, List
+
+os.environ.setdefault("LOG_LEVEL", "WARNING") # Importing main configures logging
+from codec import CODECS, create_codec # noqa: E402
+from main import TextMessage # noqa: E402
+
+INBOUND = json.dumps({"type": "text_message", "text": "Tell me a short joke about WebSockets, please", "role": "user",
+                      "enableTTS": True, "id": "bench-client:1"})
+CHUNK = {"type": "text", "content": "streamed words from the model, roughly one chunk ", "role": "assistant"}
+
+def per_call_us(fn: Callable[[], Any], seconds: float) -> float:
+    """Mean microseconds per call, timed in batches until `seconds` have passed"""
+    calls, batch = 0, 1000
+    started = time.perf_counter()
+    while True:
+        for _ in range(batch): fn()
+        calls += batch
+        elapsed = time.perf_counter() - started
+        if elapsed >= seconds: return elapsed / calls * 1e6
+
+def bench(name: str, loads: Callable[[Any], Any], encode: Callable[[Any], str], seconds: float, chunks: int) -> Dict[str, Any]:
+    parsed = loads(INBOUND)
+    decode_us = per_call_us(lambda: loads(INBOUND), seconds)
+    validate_us = per_call_us(lambda: TextMessage.model_validate(parsed), seconds)
+    encode_us = per_call_us(lambda: encode(CHUNK), seconds)
+    message_us = decode_us + validate_us + chunks * encode_us
+    return {"codec": name, "decode_us": decode_us, "validate_us": validate_us, "encode_us": encode_us,
+            "inbound_per_sec": 1e6 / (decode_us + validate_us), "chunks_per_sec": 1e6 / encode_us, "messages_per_sec": 1e6 / message_us}
+
+def run(seconds: float, chunks: int) -> List[Dict[str, Any]]:
+    results = [bench("baseline", json.loads, lambda obj: json.dumps(obj, separators=(",", ":")), seconds, chunks)]
+    for name in CODECS:
+        try: codec = create_codec(name)
+        except RuntimeError as e:
+            print(f"skipping {name}: {e}")
+            continue
+        results.append(bench(name, codec.loads, lambda obj, dumps=codec.dumps: dumps(obj).decode("utf-8"), seconds, chunks))
+    return results
+
+def format_results(results: List[Dict[str, Any]]) -> str:
+    baseline = results[0]["messages_per_sec"]
+    lines = [f"{'codec':<10}{'decode us':>11}{'valid. us':>11}{'encode us':>11}{'in msg/s':>12}{'chunks/s':>12}{'msg/s/core':>12}{'speedup':>9}",
+             "-" * 88]
+    for r in results:
+        lines.append(f"{r['codec']:<10}{r['decode_us']:>11.2f}{r['validate_us']:>11.2f}{r['encode_us']:>11.2f}{r['inbound_per_sec']:>12,.0f}"
+                     f"{r['chunks_per_sec']:>12,.0f}{r['messages_per_sec']:>12,.0f}{r['messages_per_sec'] / baseline:>8.2f}x")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark JSON codecs on the WebSocket message path")
+    parser.add_argument("--seconds", type=float, default=1.0, help="Timing budget per measurement")
+    parser.add_argument("--chunks", type=int, default=9, help="Outbound frames per message (SIM_CHUNKS text chunks + complete)")
+    args = parser.parse_args()
+    print(format_results(run(args.seconds, args.chunks)))
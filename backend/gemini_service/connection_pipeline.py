@@ -0,0 +1,354 @@
+# backend/gemini_service/connection_pipeline.py
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from fastapi import WebSocket, WebSocketDisconnect
+from starlette.websockets import WebSocketState
+
+from codec import JsonCodec, StdlibCodec
+from memory import MemoryAccount
+from session_recorder import SessionRecording
+from metrics import WS_BYTES_RECEIVED, WS_BYTES_SENT, WS_MESSAGE_LATENCY, WS_MESSAGES, WS_REJECTED, message_type_label
+from tracing import NOOP_TRACE, Tracer, use_trace
+
+logger = logging.getLogger(__name__)
+
+MessageHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+BinaryHandler = Callable[[bytes], Awaitable[Optional[Dict[str, Any]]]]
+InlineHandler = Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]
+AdmitHook = Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]
+
+class SlowConsumerError(RuntimeError):
+    """Raised when the browser does not drain the outbound queue within the send timeout"""
+
+class ConnectionPipeline:
+    """Runs one WebSocket as three tasks: a reader, a writer and a generation worker.
+
+    The reader answers pings and "interrupt" immediately and queues everything else
+    (bounded, rejecting when full); the worker runs one generation at a time as a
+    cancellable task; the writer drains a bounded outbound queue, with control frames
+    (pong, errors, acks) jumping ahead of streamed chunks. Producers block on the full
+    outbound queue for at most `send_timeout` before the client is dropped as too slow;
+    control frames never block, so a client that lets `control_queue_size` of them pile
+    up is dropped the same way rather than losing any.
+
+    Frames are encoded when queued, so the queue holds compact bytes rather than dicts; with
+    a MemoryAccount, those bytes also count against a per-connection and worker-wide budget,
+    and producers wait (for the same `send_timeout`) while it is exhausted.
+    """
+
+    def __init__(self,
+                 websocket: WebSocket,
+                 client_id: str,
+                 handler: MessageHandler,
+                 receive_timeout: Optional[float],
+                 send_queue_size: int = 256,
+                 recv_queue_size: int = 8,
+                 send_timeout: float = 15.0,
+                 control_queue_size: int = 64,
+                 on_activity: Optional[Callable[[], None]] = None,
+                 on_binary: Optional[BinaryHandler] = None,
+                 inline_handlers: Optional[Dict[str, InlineHandler]] = None,
+                 admit: Optional[AdmitHook] = None,
+                 tracer: Optional[Tracer] = None,
+                 codec: Optional[JsonCodec] = None,
+                 memory: Optional[MemoryAccount] = None,
+                 recording: Optional[SessionRecording] = None):
+        self.websocket = websocket
+        self.client_id = client_id
+        self.handler = handler
+        self.receive_timeout = receive_timeout # None when idle connections are reaped externally
+        self.send_timeout = send_timeout
+        self.control_queue_size = control_queue_size
+        self.on_activity = on_activity
+        self.on_binary = on_binary # Awaited inline on the reader, so frames are handled in order; may return a control reply
+        self.inline_handlers = inline_handlers or {} # Quick, synchronous JSON message types that bypass the worker queue
+        self.admit = admit # Checked before queueing work; returns a rejection reply to refuse the message
+        self.tracer = tracer if tracer and tracer.enabled else None
+        self.codec = codec or StdlibCodec()
+        self.memory = memory # Charged for queued frame bytes
+        self.recording = recording # Frames in and out, for session_replay.py
+
+        # Items are (generation id, kind, encoded frame); generation 0 is connection-level control traffic
+        self._outbound: asyncio.Queue = asyncio.Queue(maxsize=send_queue_size)
+        self._control: Deque[Tuple[int, str, Any]] = deque()
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event() # Set by the writer as it frees budgeted bytes
+        self._inbound: asyncio.Queue = asyncio.Queue(maxsize=recv_queue_size) # (message, trace, queued_at_ns)
+        self._traces: Dict[int, Any] = {} # Sampled generation id -> trace, finished once the writer sends its last frame
+
+        self._generation_seq = 0
+        self._current_generation = 0
+        self._interrupted_upto = 0 # queued chunks of generations <= this id are dropped
+        self._generation_task: Optional[asyncio.Task] = None
+        self._stopped = asyncio.Event()
+        self.close_code = 1000
+        self.close_reason = ""
+
+    # --- Producer API (used by the message handler and audio callback) ---
+    async def send_json(self, data: Dict[str, Any]):
+        await self._enqueue((self._current_generation, "text", self.codec.dumps(data)))
+
+    async def send_bytes(self, data: bytes):
+        await self._enqueue((self._current_generation, "bytes", data))
+
+    def send_control(self, data: Dict[str, Any]):
+        """Queue a small frame that skips ahead of streamed output and never blocks"""
+        if len(self._control) >= self.control_queue_size:
+            # Errors and acks must not be dropped; a client this far behind is closed instead
+            if not self._stopped.is_set(): logger.warning(f"Control queue for {self.client_id} is full; closing as a slow consumer")
+            self.stop(1008, "Client too slow to receive")
+            return
+        frame = self.codec.dumps(data)
+        if self.memory: self.memory.charge(len(frame))
+        self._control.append((0, "text", frame))
+        self._wakeup.set()
+
+    async def _enqueue(self, item: Tuple[int, str, Any]):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.send_timeout
+        if self.memory:
+            while not self.memory.try_charge(len(item[2])):
+                self._drained.clear()
+                try: await asyncio.wait_for(self._drained.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    raise SlowConsumerError(f"Outbound buffer for {self.client_id} stayed over its memory budget for {self.send_timeout}s")
+        try:
+            await asyncio.wait_for(self._outbound.put(item), timeout=deadline - loop.time())
+        except BaseException as e:
+            self._release(item)
+            if isinstance(e, asyncio.TimeoutError):
+                raise SlowConsumerError(f"Outbound queue for {self.client_id} stayed full for {self.send_timeout}s")
+            raise
+        self._wakeup.set()
+
+    def _release(self, item: Tuple[int, str, Any]):
+        if self.memory and item[1] != "trace_end":
+            self.memory.release(len(item[2]))
+            self._drained.set()
+
+    @property
+    def outbound_depth(self) -> int:
+        return self._outbound.qsize() + len(self._control)
+
+    @property
+    def inbound_depth(self) -> int:
+        return self._inbound.qsize()
+
+    def interrupt(self) -> bool:
+        """Cancel the in-flight generation and drop its queued, unsent chunks. A generation that
+        already finished keeps its tail (including "complete") even if it hasn't been sent yet."""
+        task = self._generation_task
+        if task and not task.done():
+            self._interrupted_upto = self._current_generation
+            task.cancel()
+            return True
+        return False
+
+    def stop(self, code: int, reason: str):
+        """End the connection from outside (idle reaper, admission control) with the given close code"""
+        if self._stopped.is_set(): return
+        self.close_code, self.close_reason = code, reason
+        self._stopped.set()
+
+    # --- Tasks ---
+    async def run(self):
+        """Run until the socket closes, times out, or a task fails; then cancel the rest"""
+        tasks = [
+            asyncio.create_task(self._reader(), name=f"ws-reader-{self.client_id}"),
+            asyncio.create_task(self._writer(), name=f"ws-writer-{self.client_id}"),
+            asyncio.create_task(self._worker(), name=f"ws-worker-{self.client_id}"),
+            asyncio.create_task(self._stopped.wait(), name=f"ws-stop-{self.client_id}"),
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            if self._stopped.is_set(): await self._drain_control() # Let the client see why it is being closed
+        finally:
+            if self._generation_task: tasks.append(self._generation_task) # Awaited too, so its session lease is released before run() returns
+            for task in tasks: task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for trace in self._traces.values(): self.tracer.finish(trace, outcome="closed")
+            self._traces.clear()
+        for task in done:
+            if not task.cancelled() and task.exception():
+                raise task.exception()
+
+    async def _reader(self):
+        while True:
+            try:
+                if self.receive_timeout is None: frame = await self.websocket.receive()
+                else: frame = await asyncio.wait_for(self.websocket.receive(), timeout=self.receive_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Receive timeout for {self.client_id}. Closing.")
+                self.close_code, self.close_reason = 1001, "Idle timeout"
+                return
+            except (WebSocketDisconnect, RuntimeError):
+                logger.info(f"{self.client_id} disconnected gracefully.")
+                return
+            if frame.get("type") == "websocket.disconnect":
+                logger.info(f"{self.client_id} disconnected gracefully.")
+                return
+            if self.on_activity: self.on_activity()
+            if self.recording: self.recording.inbound(frame)
+
+            if frame.get("bytes") is not None:
+                WS_BYTES_RECEIVED.inc(len(frame["bytes"]), kind="binary")
+                if not self.on_binary:
+                    self.send_control({"type": "error", "error": "Binary frames are not supported on this connection"})
+                    continue
+                try:
+                    reply = await self.on_binary(frame["bytes"])
+                except ValueError as frame_err:
+                    logger.error(f"Binary frame error for {self.client_id}: {frame_err}")
+                    reply = {"type": "error", "error": f"Invalid binary frame: {frame_err}"}
+                except OSError as io_err: # e.g. ENOSPC while spilling an upload: fails that upload, not the connection
+                    logger.error(f"Binary frame I/O error for {self.client_id}: {io_err}")
+                    reply = {"type": "error", "error": str(io_err)}
+                if reply: self.send_control(reply)
+                continue
+
+            raw_data = frame.get("text") or ""
+            WS_BYTES_RECEIVED.inc(len(raw_data), kind="text") # Characters; equal to bytes for ASCII JSON
+            trace = self.tracer.start_trace(self.client_id) if self.tracer else NOOP_TRACE
+            try:
+                with trace.span("ws.parse", bytes=len(raw_data)):
+                    message_data = self.codec.loads(raw_data)
+                if not isinstance(message_data, dict): raise ValueError("Expected a JSON object")
+            except ValueError as data_err:
+                logger.error(f"Data/Validation error for {self.client_id}: {data_err} - Data: {raw_data[:200]}...")
+                self.send_control({"type": "error", "error": f"Invalid message format or data: {data_err}"})
+                continue
+
+            message_type = message_data.get("type")
+            if message_type == "ping":
+                self.send_control({"type": "pong"})
+            elif message_type == "interrupt":
+                interrupted = self.interrupt()
+                logger.info(f"Interrupt from {self.client_id} (generation cancelled: {interrupted})")
+                self.send_control({"type": "interrupted", "cancelled": interrupted})
+            elif message_type in self.inline_handlers:
+                try:
+                    reply = self.inline_handlers[message_type](message_data)
+                except ValueError as inline_err:
+                    logger.error(f"Error handling '{message_type}' for {self.client_id}: {inline_err}")
+                    reply = {"type": "error", "error": str(inline_err)}
+                if reply: self.send_control(reply)
+            else:
+                rejection = self.admit(message_data) if self.admit else None
+                if rejection:
+                    WS_REJECTED.inc(reason=rejection.get("code", "admission"))
+                    self.send_control(self.for_message(rejection, message_data))
+                    continue
+                if trace.sampled and message_data.get("id") is not None: trace.message_id = str(message_data["id"])
+                try:
+                    self._inbound.put_nowait((message_data, trace, time.time_ns() if trace.sampled else 0))
+                except asyncio.QueueFull:
+                    WS_REJECTED.inc(reason="queue_full")
+                    logger.warning(f"Inbound queue full for {self.client_id}; rejecting '{message_type}'")
+                    self.send_control(self.for_message({"type": "error", "code": "queue_full", "error": "Too many pending messages, please wait for the current response"}, message_data))
+
+    @staticmethod
+    def for_message(reply: Dict[str, Any], message_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Echo the client's optional message "id" so it can tell which message a reply ends"""
+        if "id" not in message_data: return reply
+        return {**reply, "id": message_data["id"]}
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            message_data, trace, queued_at = await self._inbound.get()
+            message_type = message_type_label(message_data.get("type"))
+            WS_MESSAGES.inc(type=message_type)
+            started = loop.time()
+            self._generation_seq += 1
+            self._current_generation = self._generation_seq
+            handler = self.handler(message_data)
+            if trace.sampled:
+                trace.add_span("ws.queue_wait", queued_at, time.time_ns())
+                if trace.message_id is None: trace.message_id = str(self._current_generation)
+                self._traces[self._current_generation] = trace
+                handler = self._traced(handler, trace, message_type)
+            self._generation_task = asyncio.create_task(handler, name=f"ws-generation-{self.client_id}")
+            await asyncio.wait({self._generation_task})
+            task, self._generation_task = self._generation_task, None
+            if task.cancelled():
+                logger.info(f"Generation {self._current_generation} for {self.client_id} cancelled")
+                if trace.sampled: self._end_trace(trace, "cancelled")
+                continue
+            error = task.exception()
+            if trace.sampled: self._end_trace(trace, "error" if error else "ok")
+            if not error: WS_MESSAGE_LATENCY.observe(loop.time() - started, type=message_type)
+            if isinstance(error, SlowConsumerError):
+                logger.warning(str(error))
+                self.close_code, self.close_reason = 1008, "Client too slow to receive"
+                return
+            if error:
+                logger.error(f"Error processing message for {self.client_id}: {error}", exc_info=error)
+                self.send_control({"type": "error", "error": "Internal server error"})
+                self.close_code, self.close_reason = 1011, "Internal server error"
+                await self._drain_control()
+                return
+
+    @staticmethod
+    async def _traced(handler: Awaitable[None], trace, message_type: str):
+        use_trace(trace) # The generation task runs in its own context copy, so this stays local to it
+        with trace.span("ws.handle", type=message_type):
+            await handler
+
+    def _end_trace(self, trace, outcome: str):
+        """Finish a trace once the writer has sent everything its generation queued"""
+        trace.set(outcome=outcome)
+        try:
+            self._outbound.put_nowait((self._current_generation, "trace_end", trace))
+            self._wakeup.set()
+        except asyncio.QueueFull:
+            self._traces.pop(self._current_generation, None)
+            self.tracer.finish(trace) # Don't wait on a backed-up client; the tail of ws.send goes unrecorded
+
+    async def _writer(self):
+        while True:
+            if self._control:
+                item = self._control.popleft()
+            elif not self._outbound.empty():
+                item = self._outbound.get_nowait()
+                if item[1] == "trace_end":
+                    self._traces.pop(item[0], None)
+                    self.tracer.finish(item[2])
+                    continue
+                if item[0] and item[0] <= self._interrupted_upto:
+                    self._release(item)
+                    continue # chunk from an interrupted generation
+            else:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            generation, kind, payload = item
+            if self.websocket.client_state != WebSocketState.CONNECTED:
+                return
+            trace = self._traces.get(generation) if self._traces else None
+            if trace: sent_at = time.perf_counter_ns()
+            try:
+                if kind == "bytes":
+                    await self.websocket.send_bytes(payload)
+                    WS_BYTES_SENT.inc(len(payload), kind="binary")
+                else:
+                    # Queued as codec bytes (so len() is the byte count); ASGI text frames must be str, hence the decode
+                    await self.websocket.send_text(payload.decode("utf-8"))
+                    WS_BYTES_SENT.inc(len(payload), kind="text")
+                if trace: trace.accumulate("ws.send_bytes" if kind == "bytes" else "ws.send_json", time.perf_counter_ns() - sent_at)
+                if self.recording: self.recording.outbound(kind, payload)
+            except (WebSocketDisconnect, RuntimeError) as send_err:
+                logger.info(f"Send to {self.client_id} failed, stopping writer: {send_err}")
+                return
+            finally:
+                self._release(item)
+
+    async def _drain_control(self, timeout: float = 1.0):
+        """Give the writer a moment to flush a final error frame before shutdown"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._control and loop.time() < deadline:
+            await asyncio.sleep(0.01)
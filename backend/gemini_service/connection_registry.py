@@ -0,0 +1,314 @@
+# backend/gemini_service/connection_registry.py
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from fastapi import WebSocket
+
+from connection_pipeline import ConnectionPipeline
+from gemini_client import GeminiClient
+
+logger = logging.getLogger(__name__)
+
+Deliver = Callable[[Dict[str, Any]], Awaitable[None]]
+Close = Callable[[int, str], None]
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class ConnectionEntry:
+    __slots__ = ("websocket", "client", "deliver", "close", "pipeline") # One per open socket
+
+    def __init__(self, websocket: WebSocket, client: Optional[GeminiClient], deliver: Optional[Deliver] = None, close: Optional[Close] = None):
+        self.websocket = websocket
+        self.client = client # Session leased for the running turn; None between turns
+        self.deliver = deliver # Queues a server-initiated JSON message on the connection
+        self.close = close # Ends the connection with (code, reason); its handler then releases the lease
+        self.pipeline: Optional[ConnectionPipeline] = None # Read by /metrics for queue depths
+
+class ConnectionRegistry:
+    """Tracks WebSocket connections. Local entries hold the live socket; shared implementations
+    also record which worker owns each client id so messages can be routed across workers."""
+
+    def __init__(self, worker_id: Optional[str] = None):
+        self.worker_id = worker_id or default_worker_id()
+        self._local: Dict[str, ConnectionEntry] = {}
+
+    # --- Local view ---
+    def get(self, client_id: str) -> Optional[ConnectionEntry]:
+        return self._local.get(client_id)
+
+    def __contains__(self, client_id: str) -> bool:
+        return client_id in self._local
+
+    def __len__(self) -> int:
+        return len(self._local)
+
+    def items(self) -> List[Tuple[str, ConnectionEntry]]:
+        return list(self._local.items())
+
+    @property
+    def healthy(self) -> bool:
+        """False while this worker can't receive messages routed to its clients (/ready reports it)"""
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {"worker_id": self.worker_id, "local": len(self._local)}
+
+    # --- Lifecycle ---
+    async def start(self): pass
+    async def close(self): self._local.clear()
+
+    async def register(self, client_id: str, entry: ConnectionEntry):
+        self._local[client_id] = entry
+
+    async def unregister(self, client_id: str) -> Optional[ConnectionEntry]:
+        return self._local.pop(client_id, None)
+
+    # --- Cluster view ---
+    async def total_count(self) -> int:
+        return len(self._local)
+
+    async def worker_counts(self) -> Dict[str, int]:
+        return {self.worker_id: len(self._local)}
+
+    async def send_to(self, client_id: str, message: Dict[str, Any]) -> bool:
+        """Deliver a JSON message to a client wherever it is connected; False if unknown"""
+        entry = self._local.get(client_id)
+        if entry is None or entry.deliver is None:
+            return False
+        await entry.deliver(message)
+        return True
+
+class InProcessRegistry(ConnectionRegistry):
+    """Single-process registry (the original module-level dict behaviour)"""
+
+# --- Shared backends ---
+class SharedBackend(ABC):
+    """Minimal key/value + pub/sub surface the shared registry needs (Redis-shaped)"""
+
+    @abstractmethod
+    async def hset(self, key: str, field: str, value: str): ...
+    @abstractmethod
+    async def hget(self, key: str, field: str) -> Optional[str]: ...
+    @abstractmethod
+    async def hdel(self, key: str, *fields: str): ...
+    @abstractmethod
+    async def hgetall(self, key: str) -> Dict[str, str]: ...
+    @abstractmethod
+    async def publish(self, channel: str, message: str): ...
+    @abstractmethod
+    async def subscribe(self, channel: str) -> AsyncIterator[str]:
+        """Subscribe before returning (so no message published afterwards is missed); iterate the result"""
+    async def close(self): pass
+
+class InMemorySharedBackend(SharedBackend):
+    """Local stand-in for a shared store: registries in one process that share an instance
+    behave like workers sharing Redis, which is what the tests and single-box setups use."""
+
+    def __init__(self):
+        self._hashes: Dict[str, Dict[str, str]] = defaultdict(dict)
+        self._subscribers: Dict[str, List[asyncio.Queue]] = defaultdict(list)
+
+    async def hset(self, key, field, value): self._hashes[key][field] = value
+    async def hget(self, key, field): return self._hashes[key].get(field)
+    async def hgetall(self, key): return dict(self._hashes[key])
+
+    async def hdel(self, key, *fields):
+        for field in fields: self._hashes[key].pop(field, None)
+
+    async def publish(self, channel, message):
+        for queue in self._subscribers[channel]: queue.put_nowait(message)
+
+    async def subscribe(self, channel):
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers[channel].append(queue)
+        async def messages():
+            try:
+                while True: yield await queue.get()
+            finally:
+                self._subscribers[channel].remove(queue)
+        return messages()
+
+class RedisSharedBackend(SharedBackend):
+    """Redis implementation (requires the optional `redis` package)"""
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError as e:
+            raise RuntimeError("REGISTRY_BACKEND=redis requires the 'redis' package (pip install redis)") from e
+        self._redis = redis_asyncio.from_url(url, decode_responses=True)
+
+    async def hset(self, key, field, value): await self._redis.hset(key, field, value)
+    async def hget(self, key, field): return await self._redis.hget(key, field)
+    async def hdel(self, key, *fields): await self._redis.hdel(key, *fields)
+    async def hgetall(self, key): return await self._redis.hgetall(key)
+    async def publish(self, channel, message): await self._redis.publish(channel, message)
+
+    async def subscribe(self, channel):
+        pubsub = self._redis.pubsub()
+        await pubsub.subscribe(channel)
+        async def messages():
+            try:
+                async for item in pubsub.listen():
+                    if item.get("type") == "message": yield item["data"]
+            finally:
+                await pubsub.unsubscribe(channel)
+                await pubsub.close()
+        return messages()
+
+    async def close(self): await self._redis.close()
+
+class SharedRegistry(ConnectionRegistry):
+    """Registry shared by several workers/nodes through a SharedBackend.
+
+    Each worker publishes its connection count as a heartbeat and owns the client ids it
+    registered; send_to() publishes to the owner's channel when the client is elsewhere.
+    Workers whose heartbeat is older than `worker_ttl` are ignored (crashed or stopped).
+    If the subscription to this worker's channel fails (connection reset, failover), the
+    listener resubscribes with exponential backoff; meanwhile the heartbeat says it isn't
+    listening, so other workers report its clients as unreachable instead of publishing
+    messages nobody receives.
+    """
+
+    OWNERS_KEY = "gemini_ws:owners"
+    WORKERS_KEY = "gemini_ws:workers"
+    CHANNEL_PREFIX = "gemini_ws:worker:"
+
+    def __init__(self, backend: SharedBackend, worker_id: Optional[str] = None, heartbeat_interval: float = 5.0, worker_ttl: float = 15.0,
+                 listener_backoff: float = 1.0, listener_max_backoff: float = 30.0):
+        super().__init__(worker_id)
+        self.backend = backend
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_ttl = worker_ttl
+        self.listener_backoff = listener_backoff
+        self.listener_max_backoff = listener_max_backoff
+        self.listening = False
+        self._tasks: List[asyncio.Task] = []
+        self.counters = {"routed_in": 0, "routed_dropped": 0, "listener_failures": 0, "listener_reconnects": 0}
+
+    @property
+    def healthy(self) -> bool:
+        return self.listening
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "listening": self.listening, **self.counters}
+
+    async def start(self):
+        routed = await self.backend.subscribe(self.CHANNEL_PREFIX + self.worker_id)
+        self.listening = True
+        await self._heartbeat()
+        self._tasks = [asyncio.create_task(self._heartbeat_loop(), name="registry-heartbeat"),
+                       asyncio.create_task(self._listen(routed), name="registry-listener")]
+        logger.info(f"Shared connection registry started for worker {self.worker_id}")
+
+    async def close(self):
+        for task in self._tasks: task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.listening = False
+        owned = [cid for cid in self._local]
+        if owned: await self.backend.hdel(self.OWNERS_KEY, *owned)
+        await self.backend.hdel(self.WORKERS_KEY, self.worker_id)
+        await super().close()
+        await self.backend.close()
+
+    async def register(self, client_id, entry):
+        await super().register(client_id, entry)
+        await self.backend.hset(self.OWNERS_KEY, client_id, self.worker_id)
+        await self._heartbeat()
+
+    async def unregister(self, client_id):
+        entry = await super().unregister(client_id)
+        if entry is not None and await self.backend.hget(self.OWNERS_KEY, client_id) == self.worker_id:
+            await self.backend.hdel(self.OWNERS_KEY, client_id) # Only if it didn't reconnect elsewhere
+        if entry is not None: await self._heartbeat()
+        return entry
+
+    async def worker_counts(self) -> Dict[str, int]:
+        now = time.time()
+        counts = {}
+        for worker_id, raw in (await self.backend.hgetall(self.WORKERS_KEY)).items():
+            info = json.loads(raw)
+            if now - info["updated"] <= self.worker_ttl: counts[worker_id] = info["connections"]
+        counts[self.worker_id] = len(self._local) # Our own count is always current
+        return counts
+
+    async def total_count(self) -> int:
+        return sum((await self.worker_counts()).values())
+
+    async def send_to(self, client_id, message) -> bool:
+        if client_id in self._local:
+            return await super().send_to(client_id, message)
+        owner = await self.backend.hget(self.OWNERS_KEY, client_id)
+        if owner is None or owner == self.worker_id or not await self._reachable(owner):
+            return False
+        await self.backend.publish(self.CHANNEL_PREFIX + owner, json.dumps({"client_id": client_id, "message": message}))
+        return True
+
+    async def _reachable(self, worker_id: str) -> bool:
+        """The worker's heartbeat is fresh and it is listening for routed messages"""
+        raw = await self.backend.hget(self.WORKERS_KEY, worker_id)
+        if raw is None: return False
+        info = json.loads(raw)
+        return time.time() - info["updated"] <= self.worker_ttl and info.get("listening", True)
+
+    async def _heartbeat(self):
+        await self.backend.hset(self.WORKERS_KEY, self.worker_id, json.dumps({"connections": len(self._local), "updated": time.time(), "listening": self.listening}))
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try: await self._heartbeat()
+            except Exception as e: logger.error(f"Registry heartbeat failed: {e}")
+
+    async def _listen(self, routed: Optional[AsyncIterator[str]]):
+        delay = self.listener_backoff
+        while True:
+            try:
+                if routed is None:
+                    routed = await self.backend.subscribe(self.CHANNEL_PREFIX + self.worker_id)
+                    self.listening = True
+                    self.counters["listener_reconnects"] += 1
+                    logger.info(f"Registry listener for worker {self.worker_id} resubscribed")
+                    await self._heartbeat()
+                    delay = self.listener_backoff
+                async for raw in routed: await self._deliver_routed(raw)
+                raise ConnectionError("subscription ended")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                routed = None
+                if self.listening: self.counters["listener_failures"] += 1
+                self.listening = False
+                logger.error(f"Registry listener for worker {self.worker_id} failed, resubscribing in {delay:.1f}s: {e}")
+                try: await self._heartbeat() # Tell the other workers not to route here meanwhile
+                except Exception: pass
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.listener_max_backoff)
+
+    async def _deliver_routed(self, raw: str):
+        try:
+            envelope = json.loads(raw)
+            delivered = await super().send_to(envelope["client_id"], envelope["message"])
+            self.counters["routed_in"] += 1
+            if not delivered:
+                self.counters["routed_dropped"] += 1
+                logger.info(f"Routed message for {envelope['client_id']} dropped: not connected here")
+        except Exception as e:
+            logger.error(f"Failed to deliver routed message: {e}")
+
+def create_registry(backend: str, redis_url: Optional[str] = None, worker_id: Optional[str] = None) -> ConnectionRegistry:
+    """Build the registry selected by REGISTRY_BACKEND (memory | redis)"""
+    if backend == "memory":
+        return InProcessRegistry(worker_id)
+    if backend == "redis":
+        if not redis_url: raise ValueError("REGISTRY_BACKEND=redis requires REDIS_URL")
+        return SharedRegistry(RedisSharedBackend(redis_url), worker_id)
+    raise ValueError(f"Unknown registry backend '{backend}'")
@@ -0,0 +1,192 @@
+# backend/gemini_service/conversation.py
+import hashlib
+import logging
+import re
+import secrets
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Token counts are estimated locally (no round trip to count_tokens): ~4 characters per
+# text token, and a flat cost per attachment (Gemini bills an image at 258 tokens).
+CHARS_PER_TOKEN = 4
+ATTACHMENT_TOKENS = 258
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+def estimate_tokens(text: Optional[str]) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN if text else 0
+
+class Turn:
+    """One message of the conversation; its token estimate is computed once, on append"""
+
+    def __init__(self, role: str, parts: List[Any], text: str = "", attachments: Optional[List[str]] = None):
+        self.role = role
+        self.parts = parts # Upstream parts as sent (attachment parts are shared with the AttachmentStore)
+        self.text = text
+        self.attachments = attachments or [] # Labels kept for the summary once the parts are dropped
+        self.tokens = estimate_tokens(text) + ATTACHMENT_TOKENS * len(self.attachments)
+
+    def as_content(self) -> Dict[str, Any]:
+        return {"role": self.role, "parts": self.parts}
+
+class Summarizer(ABC):
+    """Folds evicted turns into the running summary. May be slow (e.g. model-backed); results are cached."""
+
+    @abstractmethod
+    async def summarize(self, previous: str, turns: List[Turn], max_tokens: int) -> str: ...
+
+class ExtractiveSummarizer(Summarizer):
+    """Keeps the first sentence of each turn (plus attachment names), dropping the oldest lines to fit"""
+
+    def __init__(self, max_line_chars: int = 240):
+        self.max_line_chars = max_line_chars
+
+    async def summarize(self, previous, turns, max_tokens):
+        lines = previous.splitlines() if previous else []
+        for turn in turns:
+            first = re.split(r"(?<=[.!?])\s", " ".join(turn.text.split()), maxsplit=1)[0][:self.max_line_chars]
+            attached = f" [attached: {', '.join(turn.attachments)}]" if turn.attachments else ""
+            if first or attached: lines.append(f"{turn.role}: {first}{attached}")
+        while lines and estimate_tokens("\n".join(lines)) > max_tokens:
+            lines.pop(0)
+        return "\n".join(lines)
+
+class SummaryCache:
+    """LRU of summaries keyed by (previous summary, folded turns), shared across conversations"""
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def key(previous: str, turns: List[Turn], max_tokens: int) -> str:
+        digest = hashlib.sha256(f"{max_tokens}\0{previous}".encode("utf-8"))
+        for turn in turns:
+            digest.update(f"\0{turn.role}\0{turn.text}\0{','.join(turn.attachments)}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        summary = self._entries.get(key)
+        if summary is None:
+            self.counters["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.counters["hits"] += 1
+        return summary
+
+    def put(self, key: str, summary: str):
+        self._entries[key] = summary
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._entries), **self.counters}
+
+class Conversation:
+    """History of one client, bounded to `max_tokens` of recent turns plus a summary of the rest.
+
+    Turns are appended as they complete; once the kept turns exceed the budget, the oldest
+    are folded into the summary (whole user/model exchanges at a time) and their parts are
+    released, so both the prompt and the memory held per conversation stay bounded.
+    """
+
+    def __init__(self, max_tokens: int, summary_tokens: int, summarizer: Summarizer, summary_cache: Optional[SummaryCache] = None):
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.summarizer = summarizer
+        self.summary_cache = summary_cache
+        self.turns: List[Turn] = []
+        self.tokens = 0 # Running total over self.turns
+        self.summary = ""
+        self.summarized_turns = 0
+        self.attachments: Set[str] = set() # Digests uploaded in this conversation, which later turns may reference by hash alone
+        self.last_used = time.monotonic()
+
+    def window(self, text_part: Callable[[str], Any] = lambda text: {"text": text}) -> List[Dict[str, Any]]:
+        """Contents to send ahead of the new turn: the summary (if any), then the kept turns"""
+        self.last_used = time.monotonic()
+        contents = [turn.as_content() for turn in self.turns]
+        if self.summary:
+            contents.insert(0, {"role": "user", "parts": [text_part(SUMMARY_PREFIX + self.summary)]})
+        return contents
+
+    @property
+    def window_tokens(self) -> int:
+        return self.tokens + (estimate_tokens(SUMMARY_PREFIX + self.summary) if self.summary else 0)
+
+    async def append(self, *turns: Turn):
+        for turn in turns:
+            self.turns.append(turn)
+            self.tokens += turn.tokens
+        if self.tokens > self.max_tokens: await self._compact()
+
+    async def _compact(self):
+        # Fold the oldest turns until the rest fit in 3/4 of the budget (so the summarizer runs every few
+        # exchanges, not on every one), never splitting an exchange or dropping the latest turn
+        cut, remaining, target = 0, self.tokens, self.max_tokens * 3 // 4
+        while cut < len(self.turns) - 1 and (remaining > target or self.turns[cut].role != "user"):
+            remaining -= self.turns[cut].tokens
+            cut += 1
+        if cut == 0: return
+        folded = self.turns[:cut]
+        key = SummaryCache.key(self.summary, folded, self.summary_tokens) if self.summary_cache else None
+        summary = self.summary_cache.get(key) if key else None
+        if summary is None:
+            summary = await self.summarizer.summarize(self.summary, folded, self.summary_tokens)
+            if key: self.summary_cache.put(key, summary)
+        self.summary = summary
+        self.turns = self.turns[cut:]
+        self.tokens = remaining
+        self.summarized_turns += cut
+        logger.debug(f"Folded {cut} turns into the summary ({estimate_tokens(summary)} tokens); {remaining} tokens kept")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"turns": len(self.turns), "tokens": self.tokens, "summary_tokens": estimate_tokens(self.summary),
+                "summarized_turns": self.summarized_turns}
+
+class ConversationStore:
+    """Conversations by a server-issued resume token (never the client-chosen id, which anyone
+    can claim). Kept after a disconnect so a reconnect presenting the token resumes its history;
+    the least recently used are dropped beyond `max_conversations` or after `idle_ttl`."""
+
+    def __init__(self, max_tokens: int = 8000, summary_tokens: int = 512, max_conversations: int = 10000,
+                 idle_ttl: float = 1800.0, summarizer: Optional[Summarizer] = None, summary_cache: Optional[SummaryCache] = None):
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.max_conversations = max_conversations
+        self.idle_ttl = idle_ttl
+        self.summarizer = summarizer or ExtractiveSummarizer()
+        self.summary_cache = summary_cache if summary_cache is not None else SummaryCache()
+        self._conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+        self.counters = {"created": 0, "resumed": 0, "evicted": 0}
+
+    def find(self, token: str) -> Optional[Conversation]:
+        """The conversation issued under `token`, or None if it is unknown or expired"""
+        conversation = self._conversations.get(token)
+        if conversation is not None and time.monotonic() - conversation.last_used > self.idle_ttl:
+            del self._conversations[token]; conversation = None
+        if conversation is not None:
+            self._conversations.move_to_end(token)
+            self.counters["resumed"] += 1
+        return conversation
+
+    def open(self) -> Tuple[str, Conversation]:
+        """A new conversation and the token that resumes it"""
+        token = secrets.token_urlsafe(24)
+        conversation = self._conversations[token] = Conversation(self.max_tokens, self.summary_tokens, self.summarizer, self.summary_cache)
+        self.counters["created"] += 1
+        while len(self._conversations) > self.max_conversations:
+            self._conversations.popitem(last=False)
+            self.counters["evicted"] += 1
+        return token, conversation
+
+    def discard(self, token: str):
+        self._conversations.pop(token, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"conversations": len(self._conversations), "tokens": sum(c.tokens for c in self._conversations.values()),
+                "summary_cache": self.summary_cache.stats(), **self.counters}
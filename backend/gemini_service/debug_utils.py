@@ -1,103 +1,296 @@
+import csv
+import os
 import time
 import wave
 import json
 import logging
 import asyncio
-import websockets
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Any
-import matplotlib.pyplot as plt
-from pydub import AudioSegment
+from typing import Dict, List, Any, Optional, Tuple
 from datetime import datetime
 
+from load_test import LoadTest, RequestResult, Scenario, format_report, percentile
+from memory import RingBuffer
+from lazy_imports import lazy_module
+
+# Only audio analysis needs these (mostly in pool workers), so metrics-only use doesn't pay for importing them
+os.environ.setdefault("MPLBACKEND", "Agg") # Headless; read when pyplot is first imported
+np = lazy_module("numpy")
+plt = lazy_module("matplotlib.pyplot")
+pydub = lazy_module("pydub")
+
 # Remove redundant basicConfig - rely on main.py for setup
 # logging.basicConfig(level=logging.INFO) 
 logger = logging.getLogger(__name__)
 
+# Upper bounds (ms) of the latency histogram buckets in the breakdown report
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+SILENCE_DBFS = -50.0 # Analysis windows quieter than this count as silence
+SILENCE_WINDOW_MS = 20
+CLIP_LEVEL = 0.999 # Fraction of full scale treated as clipped
+WAVEFORM_COLUMNS = 2000 # Min/max pairs drawn per waveform, however long the clip
+
+class MessageTimeline:
+    """Client-side timeline of one message (offsets in ms from sending it), plus the
+    server's own timing from the "complete" frame when it reports one"""
+
+    CSV_FIELDS = ["message_id", "sent_at", "outcome", "ttft_ms", "first_audio_ms", "audio_lag_ms", "chunks",
+                  "gap_p50_ms", "gap_max_ms", "completed_ms", "upstream_ttft_ms", "relay_ttft_ms", "server_ms", "error"]
+
+    def __init__(self, message_id: str, sent_at: float):
+        self.message_id = message_id
+        self.sent_at = sent_at # Wall clock, epoch seconds
+        self.outcome = "ok"
+        self.first_text_ms: Optional[float] = None
+        self.first_audio_ms: Optional[float] = None
+        self.chunk_ms: List[float] = []
+        self.completed_ms: Optional[float] = None
+        self.server_timing: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+
+    @classmethod
+    def from_result(cls, message_id: str, result: RequestResult) -> "MessageTimeline":
+        ms = lambda seconds: round(seconds * 1000, 2) if seconds is not None else None
+        timeline = cls(message_id, result.sent_at)
+        timeline.outcome = result.outcome
+        timeline.first_text_ms = ms(result.ttft)
+        timeline.first_audio_ms = ms(result.first_audio)
+        timeline.chunk_ms = [ms(t) for t in result.chunk_times]
+        timeline.completed_ms = ms(result.latency)
+        timeline.server_timing = result.server_timing
+        timeline.error = result.error
+        return timeline
+
+    @property
+    def gaps_ms(self) -> List[float]:
+        """Time between consecutive text chunks"""
+        return [round(b - a, 2) for a, b in zip(self.chunk_ms, self.chunk_ms[1:])]
+
+    @property
+    def audio_lag_ms(self) -> Optional[float]:
+        """How far the first audio frame trails the first text chunk (audio forwarding)"""
+        if self.first_audio_ms is None or self.first_text_ms is None: return None
+        return round(self.first_audio_ms - self.first_text_ms, 2)
+
+    @property
+    def relay_ttft_ms(self) -> Optional[float]:
+        """Part of the time-to-first-token not spent waiting on Gemini (our relay + network)"""
+        upstream = self.server_timing.get("upstream_ttft_ms")
+        if upstream is None or self.first_text_ms is None: return None
+        return round(self.first_text_ms - upstream, 2)
+
+    def as_row(self) -> Dict[str, Any]:
+        gaps = sorted(self.gaps_ms)
+        return {"message_id": self.message_id, "sent_at": round(self.sent_at, 3), "outcome": self.outcome,
+                "ttft_ms": self.first_text_ms, "first_audio_ms": self.first_audio_ms, "audio_lag_ms": self.audio_lag_ms,
+                "chunks": len(self.chunk_ms), "gap_p50_ms": percentile(gaps, 50), "gap_max_ms": gaps[-1] if gaps else None,
+                "completed_ms": self.completed_ms, "upstream_ttft_ms": self.server_timing.get("upstream_ttft_ms"),
+                "relay_ttft_ms": self.relay_ttft_ms, "server_ms": self.server_timing.get("server_ms"), "error": self.error}
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {**self.as_row(), "chunk_ms": self.chunk_ms, "gaps_ms": self.gaps_ms, "server_timing": self.server_timing}
+
+def latency_summary(values: List[float]) -> Dict[str, Any]:
+    """Percentiles plus a fixed-bucket histogram of a list of millisecond values"""
+    values = sorted(v for v in values if v is not None)
+    histogram = {f"<={bound}": 0 for bound in LATENCY_BUCKETS_MS}
+    histogram[f">{LATENCY_BUCKETS_MS[-1]}"] = 0
+    for value in values:
+        bucket = next((f"<={bound}" for bound in LATENCY_BUCKETS_MS if value <= bound), f">{LATENCY_BUCKETS_MS[-1]}")
+        histogram[bucket] += 1
+    return {"count": len(values), "p50": percentile(values, 50), "p90": percentile(values, 90), "p95": percentile(values, 95),
+            "p99": percentile(values, 99), "max": values[-1] if values else None, "histogram": histogram}
+
 class PerformanceMetrics:
-    def __init__(self):
-        self.response_times: List[float] = []
-        self.audio_sizes: List[int] = []
+    """Keeps the latest `max_samples` samples and timelines and `max_errors` error messages, so long
+    runs use fixed memory; totals and averages still cover every message"""
+
+    def __init__(self, max_samples: int = 10000, max_errors: int = 100):
+        self.response_times = RingBuffer(max_samples, "d")
+        self.audio_sizes = RingBuffer(max_samples, "q")
+        self.timelines: "deque[MessageTimeline]" = deque(maxlen=max_samples)
         self.connection_stats: Dict[str, Any] = {
             "total_connections": 0,
             "failed_connections": 0,
             "avg_response_time": 0
         }
-        self.errors: List[str] = []
+        self.errors: "deque[str]" = deque(maxlen=max_errors)
+        self.error_count = 0
+        self._response_time_sum = 0.0
+        self._audio_bytes_sum = 0
 
     def log_response_time(self, time_ms: float):
         self.response_times.append(time_ms)
+        self._response_time_sum += time_ms
         
     def log_audio_size(self, size_bytes: int):
         self.audio_sizes.append(size_bytes)
+        self._audio_bytes_sum += size_bytes
 
     def log_error(self, error: str):
         self.errors.append(error)
+        self.error_count += 1
+
+    def log_timeline(self, timeline: MessageTimeline):
+        self.timelines.append(timeline)
+        if timeline.completed_ms is not None: self.log_response_time(timeline.completed_ms)
+        if timeline.error: self.log_error(timeline.error)
+
+    def latency_breakdown(self) -> Dict[str, Any]:
+        """Where the time went: upstream generation, our relay, chunk pacing and audio forwarding"""
+        ok = [t for t in self.timelines if t.outcome == "ok"]
+        return {
+            "ttft_ms": latency_summary([t.first_text_ms for t in ok]),
+            "upstream_ttft_ms": latency_summary([t.server_timing.get("upstream_ttft_ms") for t in ok]),
+            "relay_ttft_ms": latency_summary([t.relay_ttft_ms for t in ok]),
+            "first_audio_ms": latency_summary([t.first_audio_ms for t in ok]),
+            "audio_lag_ms": latency_summary([t.audio_lag_ms for t in ok]),
+            "inter_chunk_gap_ms": latency_summary([gap for t in ok for gap in t.gaps_ms]),
+            "completed_ms": latency_summary([t.completed_ms for t in ok]),
+        }
+
+    def export_json(self, path: Path):
+        path.write_text(json.dumps({"breakdown": self.latency_breakdown(), "timelines": [t.as_dict() for t in self.timelines]}, indent=2))
+
+    def export_csv(self, path: Path):
+        with path.open("w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=MessageTimeline.CSV_FIELDS)
+            writer.writeheader()
+            for timeline in self.timelines: writer.writerow(timeline.as_row())
 
     def generate_report(self) -> Dict[str, Any]:
-        if self.response_times:
-            avg_response = sum(self.response_times) / len(self.response_times)
-            self.connection_stats["avg_response_time"] = avg_response
+        total = self.response_times.total
+        if total:
+            self.connection_stats["avg_response_time"] = self._response_time_sum / total
 
         return {
             "metrics": {
-                "total_messages": len(self.response_times),
+                "total_messages": total,
                 "avg_response_time_ms": self.connection_stats["avg_response_time"],
-                "avg_audio_size_kb": sum(self.audio_sizes) / len(self.audio_sizes) / 1024 if self.audio_sizes else 0,
-                "error_rate": len(self.errors) / len(self.response_times) if self.response_times else 0
+                "avg_audio_size_kb": self._audio_bytes_sum / self.audio_sizes.total / 1024 if self.audio_sizes.total else 0,
+                "error_rate": self.error_count / total if total else 0
             },
-            "errors": self.errors
+            "errors": list(self.errors), # Most recent only
+            **({"latency_breakdown": self.latency_breakdown()} if self.timelines else {})
         }
 
+# --- Audio analysis (module-level so it can run in pool worker processes) ---
+def load_samples(audio_path: Path, audio_format: str = "pcm", sample_rate: int = 24000) -> Tuple["np.ndarray", "pydub.AudioSegment"]:
+    """Decode a saved response into float samples in [-1, 1], shaped (frames, channels).
+    "pcm" is the server's raw 16-bit mono egress (AUDIO_OUTPUT_FORMAT=pcm); other formats go through pydub/ffmpeg."""
+    if audio_format == "pcm":
+        audio = pydub.AudioSegment.from_raw(str(audio_path), sample_width=2, frame_rate=sample_rate, channels=1)
+    else:
+        audio = pydub.AudioSegment.from_file(audio_path, format={"opus": "ogg"}.get(audio_format, audio_format)) # Opus egress is Ogg-framed
+    dtype = {1: np.int8, 2: np.int16, 4: np.int32}.get(audio.sample_width)
+    raw = np.frombuffer(audio.raw_data, dtype=dtype) if dtype else np.array(audio.get_array_of_samples())
+    samples = raw.astype(np.float32) / float(1 << (8 * audio.sample_width - 1))
+    return samples.reshape(-1, audio.channels), audio
+
+def _dbfs(level: float) -> Optional[float]:
+    return round(20 * float(np.log10(level)), 2) if level > 0 else None
+
+def audio_metrics(samples: "np.ndarray", frame_rate: int) -> Dict[str, Any]:
+    """Level metrics over all channels: RMS, peak, share of silent windows and clipped samples"""
+    if not samples.size:
+        return {"rms": 0.0, "rms_dbfs": None, "peak": 0.0, "peak_dbfs": None, "silence_ratio": 1.0, "clipped_samples": 0, "clipping_ratio": 0.0}
+    rms = float(np.sqrt(np.mean(np.square(samples, dtype=np.float64))))
+    peak = float(np.max(np.abs(samples)))
+    clipped = int(np.count_nonzero(np.abs(samples) >= CLIP_LEVEL))
+    # RMS per SILENCE_WINDOW_MS window of the channel mix (a trailing partial window is ignored)
+    window = max(1, frame_rate * SILENCE_WINDOW_MS // 1000)
+    mono = samples.mean(axis=1)
+    windows = mono[:len(mono) // window * window].reshape(-1, window)
+    window_rms = np.sqrt(np.mean(np.square(windows, dtype=np.float64), axis=1))
+    silence_ratio = float(np.mean(window_rms < 10 ** (SILENCE_DBFS / 20))) if len(window_rms) else 1.0
+    return {"rms": round(rms, 6), "rms_dbfs": _dbfs(rms), "peak": round(peak, 6), "peak_dbfs": _dbfs(peak),
+            "silence_ratio": round(silence_ratio, 4), "clipped_samples": clipped, "clipping_ratio": round(clipped / samples.size, 6)}
+
+def decimate_minmax(signal: "np.ndarray", columns: int = WAVEFORM_COLUMNS) -> Tuple["np.ndarray", "np.ndarray", "np.ndarray"]:
+    """Per-column (start index, min, max) envelope, so drawing cost doesn't grow with clip length"""
+    if len(signal) <= columns:
+        index = np.arange(len(signal))
+        return index, signal, signal
+    starts = np.linspace(0, len(signal), columns, endpoint=False).astype(np.int64)
+    return starts, np.minimum.reduceat(signal, starts), np.maximum.reduceat(signal, starts)
+
+def analyze_audio(audio_path: Path, waveform_path: Optional[Path] = None, audio_format: str = "pcm", sample_rate: int = 24000) -> Dict[str, Any]:
+    """Decode once, compute metrics and optionally render the waveform; returns {} if the file can't be decoded"""
+    try:
+        samples, audio = load_samples(audio_path, audio_format, sample_rate)
+    except Exception as e:
+        logger.error(f"Error analyzing audio file {audio_path}: {e}")
+        return {}
+    analysis = {"duration_ms": len(audio), "channels": audio.channels, "sample_width_bytes": audio.sample_width,
+                "frame_rate": audio.frame_rate, "size_bytes": len(audio.raw_data), **audio_metrics(samples, audio.frame_rate)}
+    if waveform_path is not None:
+        try:
+            render_waveform(samples.mean(axis=1), audio.frame_rate, waveform_path)
+            analysis["waveform"] = str(waveform_path)
+        except Exception as e:
+            logger.error(f"Error plotting waveform: {e}")
+    return analysis
+
+def render_waveform(signal: "np.ndarray", frame_rate: int, output_path: Path, columns: int = WAVEFORM_COLUMNS):
+    starts, lows, highs = decimate_minmax(signal, columns)
+    seconds = starts / frame_rate
+    fig, ax = plt.subplots(figsize=(15, 5))
+    ax.fill_between(seconds, lows, highs, linewidth=0.5, step="post")
+    ax.set_title("Audio Waveform")
+    ax.set_xlabel("Time (s)")
+    ax.set_ylabel("Amplitude (full scale)")
+    ax.set_ylim(-1.05, 1.05)
+    fig.savefig(output_path)
+    plt.close(fig)
+
 class AudioAnalyzer:
-    def __init__(self, output_dir: Path):
+    """Runs audio analysis in a process pool so decoding and plotting never block the event loop"""
+
+    def __init__(self, output_dir: Path, audio_format: str = "pcm", sample_rate: int = 24000, max_workers: Optional[int] = None):
         self.output_dir = output_dir
         self.output_dir.mkdir(exist_ok=True)
+        self.audio_format = audio_format
+        self.sample_rate = sample_rate
+        self.max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
 
     def analyze_audio_file(self, audio_path: Path) -> Dict[str, Any]:
-        """Analyze audio file and return metrics"""
-        try:
-            audio = AudioSegment.from_file(audio_path)
-            
-            return {
-                "duration_ms": len(audio),
-                "channels": audio.channels,
-                "sample_width_bytes": audio.sample_width,
-                "frame_rate": audio.frame_rate,
-                "size_bytes": len(audio.raw_data)
-            }
-        except Exception as e:
-            logger.error(f"Error analyzing audio file: {e}")
-            return {}
+        """Analyze audio file and return metrics (synchronous; prefer analyze() from async code)"""
+        return analyze_audio(audio_path, None, self.audio_format, self.sample_rate)
 
     def plot_waveform(self, audio_path: Path, output_path: Path):
-        """Generate waveform plot"""
-        try:
-            audio = AudioSegment.from_file(audio_path)
-            samples = audio.get_array_of_samples()
-            
-            plt.figure(figsize=(15, 5))
-            plt.plot(samples)
-            plt.title("Audio Waveform")
-            plt.xlabel("Sample")
-            plt.ylabel("Amplitude")
-            plt.savefig(output_path)
-            plt.close()
-        except Exception as e:
-            logger.error(f"Error plotting waveform: {e}")
+        """Generate waveform plot (synchronous)"""
+        analyze_audio(audio_path, output_path, self.audio_format, self.sample_rate)
+
+    async def analyze(self, audio_path: Path, waveform_path: Optional[Path] = None) -> Dict[str, Any]:
+        """Metrics (and waveform) computed in a worker process"""
+        if self._executor is None: self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, analyze_audio, audio_path, waveform_path, self.audio_format, self.sample_rate)
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
 
 async def run_performance_test(
     host: str = "localhost",
     port: int = 8000,
     num_messages: int = 5,
-    save_audio: bool = True
+    save_audio: bool = True,
+    clients: int = 1,
+    audio_format: str = "pcm",
+    sample_rate: int = 24000
 ) -> None:
-    """Run performance test and generate report"""
+    """Run a closed-loop load test (see load_test.py) with the sample messages and generate a report"""
     metrics = PerformanceMetrics()
     output_dir = Path("debug_output")
     output_dir.mkdir(exist_ok=True)
     
-    audio_analyzer = AudioAnalyzer(output_dir)
+    audio_analyzer = AudioAnalyzer(output_dir, audio_format, sample_rate)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
     test_messages = [
@@ -109,68 +302,50 @@ async def run_performance_test(
     ]
 
     try:
-        uri = f"ws://{host}:{port}/ws/debug-client"
-        async with websockets.connect(uri) as websocket:
-            for i in range(min(num_messages, len(test_messages))):
-                message = test_messages[i]
-                start_time = time.time()
-                
-                # Send message
-                await websocket.send(json.dumps({
-                    "type": "text_message", # Explicitly set type
-                    "text": message,
-                    "role": "user",
-                    "enableTTS": True
-                }))
-
-                # Collect response
-                audio_chunks = []
-                while True:
-                    try:
-                        response = await websocket.recv()
-                        if isinstance(response, str):
-                            data = json.loads(response)
-                            if data.get("type") == "error":
-                                metrics.log_error(data.get("error"))
-                            elif data.get("type") == "complete":
-                                break
-                        elif isinstance(response, bytes):
-                            audio_chunks.append(response)
-                    except websockets.exceptions.ConnectionClosed:
-                        break
-
-                # Log metrics
-                end_time = time.time()
-                metrics.log_response_time((end_time - start_time) * 1000)
-                
-                if audio_chunks and save_audio:
-                    # Save and analyze audio
-                    audio_data = b"".join(audio_chunks)
-                    metrics.log_audio_size(len(audio_data))
-                    
-                    audio_path = output_dir / f"response_{i}_{timestamp}.mp3"
-                    audio_path.write_bytes(audio_data)
-                    
-                    # Analyze audio quality
-                    analysis = audio_analyzer.analyze_audio_file(audio_path)
-                    waveform_path = output_dir / f"waveform_{i}_{timestamp}.png"
-                    audio_analyzer.plot_waveform(audio_path, waveform_path)
-                    
-                    logger.info(f"Audio analysis for message {i}:")
-                    logger.info(json.dumps(analysis, indent=2))
+        scenario = Scenario.from_dict({
+            "phases": [{"name": "debug", "mode": "closed", "clients": clients,
+                        "duration": 3600, "max_requests": num_messages}], # Bounded by max_requests
+            "order": "sequential", "seed": 0, # Same messages in the same order every run, so reports compare
+            "messages": [{"type": "text_message", "text": text, "role": "user", "enableTTS": True} for text in test_messages],
+        }, url=f"ws://{host}:{port}")
+        load_test = LoadTest(scenario, capture_audio=save_audio)
+        load_report = await load_test.run()
+
+        pending = {}
+        for i, result in enumerate(load_test.results["debug"]):
+            metrics.log_timeline(MessageTimeline.from_result(f"message_{i}", result))
+            if not result.audio: continue
+            # Save audio; analysis runs in worker processes once the load test is over
+            audio_data = b"".join(result.audio)
+            metrics.log_audio_size(len(audio_data))
+            
+            audio_path = output_dir / f"response_{i}_{timestamp}.{audio_format}"
+            audio_path.write_bytes(audio_data)
+            pending[f"message_{i}"] = audio_analyzer.analyze(audio_path, output_dir / f"waveform_{i}_{timestamp}.png")
+
+        # Analyze audio quality
+        analyses = dict(zip(pending, await asyncio.gather(*pending.values())))
+        for message_id, analysis in analyses.items():
+            logger.info(f"Audio analysis for {message_id}:")
+            logger.info(json.dumps(analysis, indent=2))
 
         # Generate final report
         report = metrics.generate_report()
+        report["load_test"] = load_report["phases"][0]
+        if analyses: report["audio_analysis"] = analyses
         report_path = output_dir / f"performance_report_{timestamp}.json"
         report_path.write_text(json.dumps(report, indent=2))
+        metrics.export_json(output_dir / f"timelines_{timestamp}.json")
+        metrics.export_csv(output_dir / f"timelines_{timestamp}.csv")
         
         logger.info("Performance test complete. Report saved to: %s", report_path)
-        logger.info("
-Summary:")
-        logger.info(json.dumps(report["metrics"], indent=2))
+        logger.info("\nSummary:")
+        logger.info(format_report(load_report))
 
     except Exception as e:
         logger.error(f"Error during performance test: {e}", exc_info=True)
+    finally:
+        audio_analyzer.close()
 
 if __name__ == "__main__":
     import argparse
@@ -178,8 +353,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run Gemini service performance tests")
     parser.add_argument("--host", default="localhost", help="WebSocket host")
     parser.add_argument("--port", type=int, default=8000, help="WebSocket port")
-    parser.add_argument("--messages", type=int, default=5, help="Number of test messages")
+    parser.add_argument("--messages", type=int, default=5, help="Number of test messages per client")
+    parser.add_argument("--clients", type=int, default=1, help="Concurrent simulated clients")
     parser.add_argument("--no-audio", action="store_false", dest="save_audio", help="Don't save audio files")
+    parser.add_argument("--audio-format", default="pcm", choices=["pcm", "mp3", "opus"], help="Server's AUDIO_OUTPUT_FORMAT")
+    parser.add_argument("--sample-rate", type=int, default=24000, help="Server's AUDIO_SAMPLE_RATE (pcm)")
     
     args = parser.parse_args()
     
@@ -191,5 +369,8 @@ if __name__ == "__main__":
         host=args.host,
         port=args.port,
         num_messages=args.messages,
-        save_audio=args.save_audio
+        save_audio=args.save_audio,
+        clients=args.clients,
+        audio_format=args.audio_format,
+        sample_rate=args.sample_rate
     ))
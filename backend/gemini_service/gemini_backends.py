@@ -0,0 +1,188 @@
+# backend/gemini_service/gemini_backends.py
+import asyncio
+import hashlib
+import itertools
+import logging
+import os
+import random
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, Dict, Optional
+
+from lazy_imports import lazy_module
+
+genai = lazy_module("google.generativeai") # Imported on first use (or by warm-up), not by the simulated backend
+
+logger = logging.getLogger(__name__)
+
+class GeminiBackend(ABC):
+    """Where GeminiClient's live sessions and file uploads come from.
+
+    connect() returns a session with `send_message_streaming(request)` (an async iterator of
+    responses carrying `.text` and `.audio`), `close()` and optionally `async ping()`, which the
+    session pool uses to health-check idle sessions (it raises once the session is unusable); upload_file() returns an object
+    with the uploaded file's `.uri`.
+    """
+
+    name = "abstract"
+    requires_api_key = True
+
+    @abstractmethod
+    def connect(self, model: str, config: Dict[str, Any]) -> Any: ...
+    @abstractmethod
+    async def upload_file(self, path: str, mime_type: str, display_name: Optional[str] = None) -> Any: ...
+
+# genai.configure is process-global; backends only need to run it once per key
+_configured_api_key: Optional[str] = None
+
+def _ensure_configured(api_key: str):
+    global _configured_api_key
+    if _configured_api_key != api_key:
+        genai.configure(api_key=api_key)
+        _configured_api_key = api_key
+
+class LiveGeminiBackend(GeminiBackend):
+    name = "live"
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self._client = None # Created on first use, so building the backend doesn't import the SDK
+
+    @property
+    def client(self) -> Any:
+        if self._client is None:
+            _ensure_configured(self.api_key)
+            self._client = genai.Client()
+        return self._client
+
+    def connect(self, model, config):
+        return self.client.connect(model, config)
+
+    async def upload_file(self, path, mime_type, display_name=None):
+        self.client # Configures the API key
+        return await asyncio.to_thread(genai.upload_file, path=path, mime_type=mime_type, display_name=display_name)
+
+# --- Simulated backend ---
+class SimulatedBackendError(RuntimeError):
+    """Injected failure (connect or mid-stream)"""
+
+class SimulationConfig:
+    def __init__(self,
+                 chunks: int = 8,
+                 chunk_tokens: int = 4,
+                 first_token_ms: float = 150.0,
+                 token_latency_ms: float = 6.0,
+                 jitter_ms: float = 0.0,
+                 audio_chunk_bytes: int = 4800,
+                 failure_rate: float = 0.0,
+                 connect_failure_rate: float = 0.0,
+                 stall_rate: float = 0.0,
+                 stall_ms: float = 2000.0,
+                 seed: Optional[int] = 0):
+        self.chunks = chunks
+        self.chunk_tokens = chunk_tokens
+        self.first_token_ms = first_token_ms # Extra wait before the first chunk (prompt processing)
+        self.token_latency_ms = token_latency_ms # Per token, so a chunk takes chunk_tokens * this
+        self.jitter_ms = jitter_ms # Uniform 0..jitter added to every wait
+        self.audio_chunk_bytes = audio_chunk_bytes # Silent 16-bit PCM per chunk; 0 sends no audio
+        self.failure_rate = failure_rate # Probability a stream fails part-way through
+        self.connect_failure_rate = connect_failure_rate
+        self.stall_rate = stall_rate # Probability a chunk is delayed by stall_ms (tail latency)
+        self.stall_ms = stall_ms
+        self.seed = seed # None for non-reproducible runs
+
+    @classmethod
+    def from_env(cls) -> "SimulationConfig":
+        env = os.getenv
+        seed = env("SIM_SEED", "0")
+        return cls(chunks=int(env("SIM_CHUNKS", 8)),
+                   chunk_tokens=int(env("SIM_CHUNK_TOKENS", 4)),
+                   first_token_ms=float(env("SIM_FIRST_TOKEN_MS", 150)),
+                   token_latency_ms=float(env("SIM_TOKEN_LATENCY_MS", 6)),
+                   jitter_ms=float(env("SIM_JITTER_MS", 0)),
+                   audio_chunk_bytes=int(env("SIM_AUDIO_CHUNK_BYTES", 4800)),
+                   failure_rate=float(env("SIM_FAILURE_RATE", 0)),
+                   connect_failure_rate=float(env("SIM_CONNECT_FAILURE_RATE", 0)),
+                   stall_rate=float(env("SIM_STALL_RATE", 0)),
+                   stall_ms=float(env("SIM_STALL_MS", 2000)),
+                   seed=None if seed.lower() == "none" else int(seed))
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(vars(self))
+
+_WORDS = ("the", "service", "streams", "a", "simulated", "answer", "with", "steady", "token", "timing", "for", "benchmarks")
+
+class SimulatedResponse:
+    def __init__(self, text: Optional[str] = None, audio: Optional[bytes] = None):
+        self.text = text
+        self.audio = audio
+
+class SimulatedSession:
+    """Live-session stand-in. Each session draws from its own seeded RNG, so a given
+    session sequence reproduces the same chunk timings and injected failures."""
+
+    def __init__(self, config: SimulationConfig, rng: random.Random):
+        self.config = config
+        self.rng = rng
+        self.closed = False
+        self._silence = bytes(config.audio_chunk_bytes)
+
+    async def _wait(self, base_ms: float):
+        cfg = self.config
+        delay = base_ms + (self.rng.uniform(0, cfg.jitter_ms) if cfg.jitter_ms else 0)
+        if cfg.stall_rate and self.rng.random() < cfg.stall_rate: delay += cfg.stall_ms
+        await asyncio.sleep(delay / 1000)
+
+    async def send_message_streaming(self, request: Dict[str, Any]) -> AsyncIterator[SimulatedResponse]:
+        if self.closed: raise SimulatedBackendError("Session is closed")
+        cfg = self.config
+        fail_at = self.rng.randrange(cfg.chunks) if cfg.failure_rate and self.rng.random() < cfg.failure_rate else None
+        await self._wait(cfg.first_token_ms)
+        for i in range(cfg.chunks):
+            await self._wait(cfg.token_latency_ms * cfg.chunk_tokens)
+            if i == fail_at: raise SimulatedBackendError(f"Injected failure after {i} chunks")
+            words = " ".join(_WORDS[(i * cfg.chunk_tokens + j) % len(_WORDS)] for j in range(cfg.chunk_tokens))
+            yield SimulatedResponse(text=words + " ", audio=self._silence or None)
+
+    async def ping(self):
+        if self.closed: raise SimulatedBackendError("Session is closed")
+        await asyncio.sleep(0)
+
+    def close(self):
+        self.closed = True
+
+class SimulatedUpload:
+    def __init__(self, uri: str):
+        self.uri = uri
+
+class SimulatedGeminiBackend(GeminiBackend):
+    """Offline backend streaming synthetic text/audio with configurable latency, jitter and failures"""
+
+    name = "simulated"
+    requires_api_key = False
+
+    def __init__(self, config: Optional[SimulationConfig] = None):
+        self.config = config or SimulationConfig.from_env()
+        self._session_seq = itertools.count()
+
+    def connect(self, model, config):
+        index = next(self._session_seq)
+        seed = self.config.seed
+        rng = random.Random(seed * 1_000_003 + index) if seed is not None else random.Random()
+        if self.config.connect_failure_rate and rng.random() < self.config.connect_failure_rate:
+            raise SimulatedBackendError("Injected connect failure")
+        return SimulatedSession(self.config, rng)
+
+    async def upload_file(self, path, mime_type, display_name=None):
+        return SimulatedUpload(f"sim://files/{hashlib.sha256(path.encode()).hexdigest()[:16]}")
+
+def create_backend(name: str, api_key: Optional[str] = None) -> GeminiBackend:
+    """Build the backend selected by GEMINI_BACKEND (live | simulated; 'stub' is an alias for simulated)"""
+    name = name.lower()
+    if name == "live":
+        if not api_key: raise ValueError("GEMINI_BACKEND=live requires GOOGLE_API_KEY")
+        return LiveGeminiBackend(api_key)
+    if name in ("simulated", "stub"):
+        backend = SimulatedGeminiBackend()
+        logger.warning(f"Using the simulated Gemini backend: {backend.config.as_dict()}")
+        return backend
+    raise ValueError(f"Unknown Gemini backend '{name}'")
@@ -1,14 +1,26 @@
 # backend/gemini_service/gemini_client.py
-import google.generativeai as genai
-from google.ai import generativelanguage as glm # For explicit types
-from typing import Optional, Dict, Any, Callable, AsyncIterable, List
+from typing import Optional, Dict, Any, Callable, AsyncIterable, AsyncIterator, List, Tuple
 import asyncio
 import json
 import logging
 import mimetypes # For guessing MIME types
+import time
+
+from attachment_preprocess import AttachmentPreprocessor
+from attachment_store import AttachmentStore
+from lazy_imports import lazy_module
+from conversation import Conversation, Turn
+from gemini_backends import GeminiBackend, LiveGeminiBackend
+from resilience import UpstreamResilience, UpstreamUnavailable
+from metrics import UPSTREAM_AUDIO_BYTES, UPSTREAM_CHUNKS, UPSTREAM_ERRORS, UPSTREAM_LATENCY, UPSTREAM_REQUESTS, UPSTREAM_TTFT
+from tracing import current_trace
 
 logger = logging.getLogger(__name__)
 
+# The SDK takes ~0.5s to import; loaded by the startup warm-up (or the first message) rather than with this module
+genai = lazy_module("google.generativeai")
+glm = lazy_module("google.ai.generativelanguage") # For explicit types
+
 # Supported MIME types for Gemini 1.5 Flash (adjust as needed based on model)
 # Reference: https://ai.google.dev/gemini-api/docs/prompting_with_media#supported_files
 SUPPORTED_MIME_TYPES = [
@@ -24,14 +36,74 @@ SUPPORTED_MIME_TYPES = [
     # Add others if needed and supported
 ]
 
+# Requests with inline data above this size are rejected upstream; larger spilled uploads go through the File API
+INLINE_DATA_LIMIT = 20 * 1024 * 1024
+
+# Using gemini-1.5-flash for potential better multimodal support
+MODEL = "gemini-1.5-flash"
+
+_END = object() # First "response" of a stream that ended without any
+
+def _as_bytes(data: Any) -> Optional[bytes]:
+    """Return bytes for glm.Blob without copying when `data` already is (or fully views) a bytes object"""
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, memoryview):
+        if isinstance(data.obj, bytes) and data.contiguous and data.nbytes == len(data.obj):
+            return data.obj
+        return data.tobytes()
+    if isinstance(data, bytearray):
+        return bytes(data)
+    return None
+
+class VoiceConfig:
+    """Voice settings of a client's live session. Slotted, but read and written like the dict it replaced."""
+
+    __slots__ = ("name", "language", "rate", "pitch")
+
+    def __init__(self, name: str = "Charon", language: str = "en-US", rate: float = 1.0, pitch: float = 0.0):
+        self.name = name
+        self.language = language
+        self.rate = max(0.25, min(4.0, rate))
+        self.pitch = max(-20.0, min(20.0, pitch))
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.__slots__: raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value: Any):
+        if key not in self.__slots__: raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __repr__(self) -> str:
+        return repr(self.as_dict())
+
+async def record_exchange(conversation: Conversation, role: str, text: str, answer: str, filenames: List[str] = ()):
+    """Append an exchange answered without upstream (e.g. replayed from the response cache).
+    Its attachments were never prepared, so the history keeps a placeholder for each."""
+    parts = ([glm.Part(text=text)] if text else []) + [glm.Part(text=f"[{name} is no longer attached]") for name in filenames]
+    await conversation.append(Turn(role, parts, text or "", list(filenames)), Turn("model", [glm.Part(text=answer)], answer))
+
 class GeminiClient:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: Optional[str] = None, attachment_store: Optional[AttachmentStore] = None, backend: Optional[GeminiBackend] = None,
+                 resilience: Optional[UpstreamResilience] = None, preprocessor: Optional[AttachmentPreprocessor] = None):
         try:
-            genai.configure(api_key=api_key)
-            self.client = genai.Client()
+            self.attachment_store = attachment_store # Shared cache of prepared file parts keyed by SHA-256
+            self.preprocessor = preprocessor # Shared worker pool that shrinks new attachments; None sends them as they are
+            self.backend = backend or LiveGeminiBackend(api_key) # Live API unless a (shared or simulated) backend is given
+            self.resilience = resilience # Shared retry/hedging/circuit-breaker policy; None calls upstream once, as before
             self.session = None
+            self.session_failed = False
+            self.has_history = False # Set once a turn is sent; such sessions must not be shared
+            self.last_timing: Dict[str, float] = {} # Upstream timings (ms) of the latest send_message
             self.audio_callback = None
-            self.voice_config = {"name": "Charon", "language": "en-US", "rate": 1.0, "pitch": 0.0}
+            self.voice_config = VoiceConfig()
         except Exception as e:
             logger.error(f"Failed to configure Gemini client: {e}", exc_info=True)
             raise # Re-raise exception after logging
@@ -42,54 +114,211 @@ class GeminiClient:
             logger.warning("Session already initialized. Closing existing session first.")
             await self.close()
         try:
-            self.voice_config = {
-                "name": voice_name,
-                "language": language,
-                "rate": max(0.25, min(4.0, rate)),
-                "pitch": max(-20.0, min(20.0, pitch))
-            }
+            self.voice_config = VoiceConfig(voice_name, language, rate, pitch)
             logger.info(f"Initializing live session with voice config: {self.voice_config}")
-            config = {
-                "response_modalities": ["TEXT", "AUDIO"],
-                "speech_config": {
-                    "voice_config": {"prebuilt_voice_config": {"voice_name": self.voice_config["name"]}}
-                }
-            }
-            # Using gemini-1.5-flash for potential better multimodal support
-            self.session = self.client.connect("gemini-1.5-flash", config)
+            self.session = await self._connect()
+            self.session_failed = False
+            self.has_history = False
             logger.info("Live session initialized successfully.")
             return True
+        except UpstreamUnavailable:
+            raise # Circuit open: callers answer "try again later" rather than report a failure
         except Exception as e:
             logger.error(f"Session initialization failed: {str(e)}", exc_info=True)
             raise RuntimeError(f"Session initialization failed: {str(e)}")
 
+    def _session_config(self) -> Dict[str, Any]:
+        return {
+            "response_modalities": ["TEXT", "AUDIO"],
+            "speech_config": {
+                "voice_config": {"prebuilt_voice_config": {"voice_name": self.voice_config["name"]}}
+            }
+        }
+
+    async def _connect(self) -> Any:
+        """Open a live session for the current voice config, retrying transient failures"""
+        attempt = 1
+        while True:
+            if self.resilience: self.resilience.start_attempt(first=attempt == 1)
+            try:
+                session = self.backend.connect(MODEL, self._session_config())
+            except Exception as e:
+                if not self.resilience: raise
+                self.resilience.breaker.record_failure()
+                if not self.resilience.can_retry(attempt): raise
+                delay = self.resilience.backoff(attempt)
+                logger.warning(f"Connect attempt {attempt} failed ({e}); retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            if self.resilience: self.resilience.breaker.record_success()
+            return session
+
+    async def reconnect(self, retry: bool = True):
+        """Replace the live session with a fresh one for the same voice. History is sent from the
+        Conversation with every message, so nothing the client said is lost. With `retry=False`
+        it makes one connect attempt, for callers whose own retry loop already counts it."""
+        old, self.session = self.session, None
+        if old:
+            try: old.close()
+            except Exception as e: logger.warning(f"Error closing failed session: {e}")
+        self.session = await self._connect() if retry else self.backend.connect(MODEL, self._session_config())
+        self.session_failed = False
+        if self.resilience: self.resilience.counters["reconnects"] += 1
+        logger.info("Live session re-established")
+
+    async def _first_response(self, request: Dict[str, Any], hedge: bool) -> Tuple[AsyncIterator[Any], Any]:
+        """Start the request and wait for its first response (_END if there is none). If that takes
+        longer than the hedge delay, the same request also goes to a fresh session; the first to
+        answer wins and the other is cancelled."""
+        stream = self.session.send_message_streaming(request)
+        first = asyncio.ensure_future(anext(stream, _END))
+        delay = self.resilience.hedge_delay if hedge and self.resilience else None
+        if delay is None: return stream, await first
+        try:
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            if done or not self.resilience.retry_budget.try_spend(): return stream, await first
+            self.resilience.counters["hedges"] += 1
+            hedge_session = None
+            try:
+                hedge_session = self.backend.connect(MODEL, self._session_config())
+                hedge_stream = hedge_session.send_message_streaming(request)
+            except Exception as e: # A hedge that can't be sent just leaves the primary to answer
+                logger.warning(f"Hedged request not sent: {e}")
+                if hedge_session is not None: hedge_session.close()
+                return stream, await first
+            second = asyncio.ensure_future(anext(hedge_stream, _END))
+        except BaseException:
+            first.cancel()
+            raise
+        candidates = {first: (self.session, stream), second: (hedge_session, hedge_stream)}
+        pending, winner = set(candidates), None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in (first, second) if task in done and not task.exception()), None)
+        finally:
+            for task in candidates:
+                if task is not winner: task.cancel()
+            await asyncio.gather(*(task for task in candidates if task is not winner), return_exceptions=True)
+            for task, (session, task_stream) in candidates.items():
+                if task is winner: continue
+                await task_stream.aclose()
+                if session is hedge_session: session.close()
+        if winner is None: return stream, first.result() # Both failed: raise the primary's error
+        if winner is second:
+            self.resilience.counters["hedge_wins"] += 1
+            old, self.session = self.session, hedge_session
+            try: old.close()
+            except Exception as e: logger.warning(f"Error closing slower session: {e}")
+        return candidates[winner][1], winner.result()
+
+    async def _stream(self, request: Dict[str, Any]) -> AsyncIterator[Any]:
+        """Upstream responses for one request. Failures before the first response are retried on a
+        re-established session; once anything was streamed to the client, errors propagate."""
+        attempt = 1
+        while True:
+            if self.resilience: self.resilience.start_attempt(first=attempt == 1)
+            UPSTREAM_REQUESTS.inc()
+            try:
+                # One connect per retry, counted as part of this attempt: no nested retry loop, no extra budget
+                if attempt > 1: await self.reconnect(retry=False)
+                stream, first = await self._first_response(request, hedge=attempt == 1)
+                break
+            except Exception as e:
+                if not self.resilience: raise
+                self.resilience.breaker.record_failure()
+                if not self.resilience.can_retry(attempt): raise
+                UPSTREAM_ERRORS.inc(stage="retried")
+                delay = self.resilience.backoff(attempt)
+                logger.warning(f"Upstream attempt {attempt} failed before the first response ({e}); retrying in {delay:.2f}s on a new session")
+                await asyncio.sleep(delay)
+                attempt += 1
+        try:
+            if first is not _END:
+                yield first
+                async for response in stream: yield response
+        except Exception:
+            if self.resilience: self.resilience.breaker.record_failure()
+            raise
+        if self.resilience: self.resilience.breaker.record_success()
+
+    async def _resume(self):
+        """After a failed stream, try to get a working session back instead of discarding this client"""
+        try:
+            await self.reconnect()
+        except Exception as e:
+            logger.warning(f"Could not re-establish the live session: {e}")
+
+    @staticmethod
+    def _unavailable(error: UpstreamUnavailable) -> Dict[str, Any]:
+        logger.warning(f"Message not sent: {error}")
+        UPSTREAM_ERRORS.inc(stage="circuit_open")
+        return {"type": "error", "code": "upstream_unavailable", "error": str(error), "retry_after": round(error.retry_after, 1)}
+
+    def _is_stored(self, file_info: Dict[str, Any]) -> bool:
+        """Already prepared on an earlier turn or connection (so not preprocessed again)"""
+        return bool(self.attachment_store) and file_info.get("sha256") in self.attachment_store
+
     async def send_message(self,
                            text: Optional[str], # Text is now optional
                            role: str = "user",
                            enable_tts: bool = True,
-                           files_data: Optional[List[Dict[str, Any]]] = None # List of dicts with mime_type, data (bytes), filename
+                           files_data: Optional[List[Dict[str, Any]]] = None, # List of dicts with mime_type, data (bytes/bytearray/memoryview), filename, optional path and sha256
+                           conversation: Optional[Conversation] = None # Earlier turns to send first; the completed exchange is appended
                            ) -> AsyncIterable[Dict[str, Any]]:
         """Send message (text and/or files) using Gemini Live API and stream responses"""
+        if not self.session and self.resilience:
+            try: await self.reconnect() # An earlier failure left this client without a session
+            except UpstreamUnavailable as e:
+                yield self._unavailable(e)
+                return
+            except Exception as e: logger.warning(f"Could not re-establish the live session: {e}")
         if not self.session:
             logger.error("Session not initialized for send_message")
+            UPSTREAM_ERRORS.inc(stage="session")
             yield {"type": "error", "error": "Session not initialized"}
             return
 
+        self.last_timing = {}
+        stage = "prepare" # Reported with upstream errors: prepare (incl. File API uploads) or stream
+        trace = current_trace()
+        prepare_started = time.time_ns()
         try:
             parts = []
+            history_parts = [] # What the conversation keeps: attachments only while the AttachmentStore holds them
+            attachments = []
             log_parts_summary = []
 
             # Add text part if provided
             if text:
                 parts.append(glm.Part(text=text))
+                history_parts.append(parts[-1])
                 log_parts_summary.append("text")
 
+            # Shrink new attachments (downscale, resample, extract text) in worker processes, all files at once
+            if files_data and self.preprocessor:
+                preprocess_started = time.perf_counter()
+                with trace.span("preprocess", files=len(files_data)):
+                    files_data = await self.preprocessor.prepare_all(files_data, skip=self._is_stored)
+                self.last_timing["preprocess_ms"] = round((time.perf_counter() - preprocess_started) * 1000, 1)
+
             # Add file parts if provided
             if files_data:
                 for file_info in files_data:
                     mime_type = file_info.get("mime_type")
-                    file_bytes = file_info.get("data")
+                    file_data = file_info.get("data")
+                    file_path = file_info.get("path") # Set for uploads spilled to disk
                     filename = file_info.get("filename", "file")
+                    digest = file_info.get("sha256")
+
+                    # Reuse the part prepared for identical content on an earlier turn or connection
+                    stored = self.attachment_store.get(digest) if digest and self.attachment_store else None
+                    if stored:
+                        parts.append(stored.part)
+                        history_parts.append(stored.part); attachments.append(stored.filename or filename)
+                        log_parts_summary.append(f"file: {stored.filename or filename} ({stored.mime_type}, {stored.size} bytes, stored {digest[:12]})")
+                        continue
 
                     # Validate MIME type
                     if not mime_type or mime_type not in SUPPORTED_MIME_TYPES:
@@ -108,53 +337,122 @@ class GeminiClient:
                             yield {"type": "warning", "message": f"File '{filename}' skipped: Unsupported or missing MIME type."}
                             continue
 
+                    # Large files already on disk are streamed to the File API instead of inlined
+                    file_size = memoryview(file_data).nbytes if isinstance(file_data, (bytes, bytearray, memoryview)) else 0
+                    if file_path and file_size > INLINE_DATA_LIMIT:
+                        with trace.span("file_api_upload", bytes=file_size):
+                            uploaded = await self.backend.upload_file(file_path, mime_type, display_name=filename)
+                        part = glm.Part(file_data=glm.FileData(mime_type=mime_type, file_uri=uploaded.uri))
+                        parts.append(part)
+                        kept = digest and self.attachment_store and self.attachment_store.put(digest, part, mime_type, filename, len(uploaded.uri))
+                        history_parts.append(part if kept else glm.Part(text=f"[{filename} is no longer attached]")); attachments.append(filename)
+                        log_parts_summary.append(f"file: {filename} ({mime_type}, {file_size} bytes via File API)")
+                        continue
+
                     # Validate data
-                    if not file_bytes or not isinstance(file_bytes, bytes):
+                    file_bytes = _as_bytes(file_data)
+                    if not file_bytes:
                         logger.error(f"Invalid/missing file data for '{filename}'. Skipping file.")
                         yield {"type": "warning", "message": f"File '{filename}' skipped: Invalid data."}
                         continue
 
                     # Add validated file part
-                    parts.append(glm.Part(inline_data=glm.Blob(mime_type=mime_type, data=file_bytes)))
-                    log_parts_summary.append(f"file: {filename} ({mime_type}, {len(file_bytes)} bytes)")
+                    part = glm.Part(inline_data=glm.Blob(mime_type=mime_type, data=file_bytes))
+                    parts.append(part)
+                    kept = digest and self.attachment_store and self.attachment_store.put(digest, part, mime_type, filename, len(file_bytes))
+                    history_parts.append(part if kept else glm.Part(text=f"[{filename} is no longer attached]")); attachments.append(filename)
+                    preprocessed = f", {file_info['preprocessed']} from {file_info['original_size']} bytes" if file_info.get("preprocessed") else ""
+                    log_parts_summary.append(f"file: {filename} ({mime_type}, {len(file_bytes)} bytes{preprocessed})")
 
             if not parts:
                 logger.warning("Attempted to send message with no text and no valid files.")
                 yield {"type": "error", "error": "Cannot send an empty message (no text or valid files)."}
                 return
 
-            logger.info(f"Sending message with parts: {log_parts_summary}")
+            trace.add_span("build_parts", prepare_started, time.time_ns(), parts=len(parts))
 
-            # Construct the request using the Parts
+            # Construct the request using the Parts, after the conversation's summary and recent turns
+            history = conversation.window(text_part=lambda summary: glm.Part(text=summary)) if conversation else []
+            if history: log_parts_summary.append(f"history: {len(history)} contents, ~{conversation.window_tokens} tokens")
+            logger.info(f"Sending message with parts: {log_parts_summary}")
             request = {
-                "contents": [{"parts": parts, "role": role}],
+                "contents": history + [{"parts": parts, "role": role}],
                 "tools": [{ "function_declarations": [genai.protos.FunctionDeclaration(name="text_to_speech")]}] if enable_tts else []
                  # Note: Tool schema might need adjustment depending on exact API requirements
             }
 
             # Stream the response
-            async for response in self.session.send_message_streaming(request):
+            self.has_history = True
+            stage = "stream"
+            started = time.perf_counter()
+            stream_started = time.time_ns()
+            first_chunk = True
+            answer = []
+            async for response in self._stream(request):
+                if first_chunk:
+                    elapsed = time.perf_counter() - started
+                    UPSTREAM_TTFT.observe(elapsed)
+                    self.last_timing["upstream_ttft_ms"] = round(elapsed * 1000, 1)
+                    trace.add_span("upstream.first_chunk", stream_started, time.time_ns())
+                    first_chunk = False
                 if response.text:
+                    answer.append(response.text)
+                    UPSTREAM_CHUNKS.inc(kind="text")
                     yield {"type": "text", "content": response.text, "role": "assistant"}
 
+                if response.audio:
+                    UPSTREAM_CHUNKS.inc(kind="audio")
+                    UPSTREAM_AUDIO_BYTES.inc(len(response.audio))
                 if enable_tts and self.audio_callback and response.audio:
                     try:
                         await self.audio_callback(response.audio)
                         # Removed separate audio_chunk yield, callback handles sending
                     except Exception as audio_e:
                         logger.error(f"Audio callback failed: {str(audio_e)}", exc_info=True)
+                        UPSTREAM_ERRORS.inc(stage="audio_callback")
                         yield {"type": "error", "error": f"Audio processing failed: {str(audio_e)}"}
             
+            elapsed = time.perf_counter() - started
+            UPSTREAM_LATENCY.observe(elapsed)
+            self.last_timing["upstream_ms"] = round(elapsed * 1000, 1)
+            trace.add_span("upstream.stream", stream_started, time.time_ns())
+            if conversation:
+                answer_text = "".join(answer)
+                await conversation.append(Turn(role, history_parts, text or "", attachments),
+                                          Turn("model", [glm.Part(text=answer_text)], answer_text))
             # Send final completion marker
             yield {"type": "complete", "role": "assistant"}
 
+        except UpstreamUnavailable as e:
+            yield self._unavailable(e)
         except Exception as e:
             logger.exception(f"Message processing failed: {str(e)}")
+            UPSTREAM_ERRORS.inc(stage=stage)
+            trace.add_span(f"upstream.{stage}", prepare_started if stage == "prepare" else stream_started, time.time_ns(), error=type(e).__name__)
+            self.session_failed = True # Don't hand this session to another connection
             yield {"type": "error", "error": f"Message processing failed: {str(e)}"}
+            if self.resilience and stage == "stream": await self._resume() # Keeps this client (and its conversation) usable
 
-    def set_audio_callback(self, callback: Callable):
+    def set_audio_callback(self, callback: Optional[Callable]):
         self.audio_callback = callback
 
+    def is_healthy(self) -> bool:
+        """True while the live session is open and has not failed mid-stream"""
+        return self.session is not None and not self.session_failed
+
+    async def probe(self, timeout: float = 5.0) -> bool:
+        """Round-trip the idle live session; is_healthy() alone only knows about failures a turn ran into"""
+        if not self.is_healthy(): return False
+        ping = getattr(self.session, "ping", None)
+        if ping is None: return True # Session type without a ping: nothing more to check
+        try:
+            await asyncio.wait_for(ping(), timeout)
+        except Exception as e:
+            logger.warning(f"Live session failed its health probe: {e!r}")
+            self.session_failed = True
+            return False
+        return True
+
     async def update_voice_settings(self, voice_name: Optional[str] = None, language: Optional[str] = None, rate: Optional[float] = None, pitch: Optional[float] = None):
         logger.warning("Updating voice settings might require re-initializing the session.")
         if voice_name: self.voice_config["name"] = voice_name
@@ -0,0 +1,87 @@
+# backend/gemini_service/idle_reaper.py
+import asyncio
+import heapq
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class IdleReaper:
+    """Closes connections whose last activity is older than `idle_timeout`.
+
+    `last_activity` is the shared client_id -> loop time dict that the connections keep
+    writing; the reaper never touches it on the hot path. It keeps one heap entry per
+    connection keyed by the earliest time it could be idle, and on expiry re-checks the
+    real last activity, re-scheduling connections that were active in the meantime. So a
+    message costs a dict write, and a scan costs O(log n) per connection that is due.
+    """
+
+    def __init__(self,
+                 last_activity: Dict[str, float],
+                 idle_timeout: float,
+                 on_idle: Callable[[str], Awaitable[None]],
+                 is_busy: Optional[Callable[[str], bool]] = None):
+        self.last_activity = last_activity
+        self.idle_timeout = idle_timeout
+        self.on_idle = on_idle
+        self.is_busy = is_busy # e.g. a generation is still streaming to this client
+        self._heap: List[Tuple[float, str]] = []
+        self._scheduled: Dict[str, float] = {} # client_id -> deadline of its live heap entry
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.reaped = 0
+
+    def track(self, client_id: str):
+        now = asyncio.get_running_loop().time()
+        self._schedule(client_id, self.last_activity.get(client_id, now) + self.idle_timeout)
+        self._wakeup.set()
+
+    def forget(self, client_id: str):
+        self._scheduled.pop(client_id, None) # Its heap entry is skipped lazily
+
+    def _schedule(self, client_id: str, deadline: float):
+        self._scheduled[client_id] = deadline
+        heapq.heappush(self._heap, (deadline, client_id))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name="idle-reaper")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - loop.time()
+            if delay > 0:
+                self._wakeup.clear()
+                try: await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError: pass
+                continue
+            deadline, client_id = heapq.heappop(self._heap)
+            if self._scheduled.get(client_id) != deadline:
+                continue # Forgotten or re-scheduled since this entry was pushed
+            last = self.last_activity.get(client_id)
+            if last is None:
+                self._scheduled.pop(client_id, None)
+                continue
+            now = loop.time()
+            if last + self.idle_timeout > now or (self.is_busy and self.is_busy(client_id)):
+                self._schedule(client_id, max(last + self.idle_timeout, now + 1.0))
+                continue
+            self._scheduled.pop(client_id, None)
+            self.reaped += 1
+            logger.info(f"Reaping idle connection {client_id} (idle {now - last:.1f}s)")
+            try: await self.on_idle(client_id)
+            except Exception as e: logger.error(f"Failed to close idle connection {client_id}: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {"tracked": len(self._scheduled), "heap_size": len(self._heap), "reaped": self.reaped}
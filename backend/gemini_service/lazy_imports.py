@@ -0,0 +1,47 @@
+# backend/gemini_service/lazy_imports.py
+import importlib
+import logging
+import time
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+class LazyModule:
+    """Stands in for a module until an attribute is first used, which imports it. Keeps heavy SDKs
+    (google.generativeai alone takes ~0.5s) off the import path of code that may never need them."""
+
+    __slots__ = ("_name", "_module")
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def load(self) -> Any:
+        if self._module is None: self._module = importlib.import_module(self._name) # Import lock makes this thread-safe
+        return self._module
+
+    def __getattr__(self, attribute: str) -> Any:
+        return getattr(self.load(), attribute)
+
+    def __repr__(self) -> str:
+        return f"<lazy module '{self._name}' ({'loaded' if self._module is not None else 'not loaded'})>"
+
+_registry: Dict[str, LazyModule] = {}
+
+def lazy_module(name: str) -> Any:
+    """A LazyModule for `name`, shared by every caller so preload() can import it ahead of use"""
+    module = _registry.get(name)
+    if module is None: module = _registry[name] = LazyModule(name)
+    return module
+
+def preload() -> Dict[str, float]:
+    """Import every lazy module registered so far (run in a thread during warm-up); ms per module"""
+    timings = {}
+    for name, module in list(_registry.items()):
+        started = time.perf_counter()
+        try: module.load()
+        except ImportError as e:
+            logger.warning(f"Could not preload {name}: {e}")
+            continue
+        timings[name] = round((time.perf_counter() - started) * 1000, 1)
+    return timings
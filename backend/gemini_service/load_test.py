@@ -0,0 +1,394 @@
+# backend/gemini_service/load_test.py
+#
+# Concurrent load generator for the /ws endpoint.
+#
+#   python load_test.py --scenario scenarios/smoke.json --output report.json   (run from backend/gemini_service)
+#   python load_test.py --url ws://localhost:8000 --clients 50 --duration 60 --mode closed
+#
+# Point it at a local server started with GEMINI_BACKEND=simulated (SIM_* settings in
+# gemini_backends.py) to measure the service's own overhead without the Gemini API. Note the server's per-client rate limit
+# (CLIENT_RATE_LIMIT/CLIENT_RATE_BURST): rates above it show up as rejections. Repeated
+# first-turn messages are served from the response cache unless RESPONSE_CACHE_ENABLED=false.
+#
+# Scenario files are JSON:
+#   {
+#     "url": "ws://localhost:8000",
+#     "request_timeout": 60,
+#     "seed": 1,
+#     "order": "random",
+#     "phases": [
+#       {"name": "warmup", "mode": "closed", "clients": 10, "duration": 30, "ramp_up": 10, "think_time": 1.0},
+#       {"name": "peak", "mode": "open", "clients": 50, "duration": 60, "ramp_up": 15, "rate": 40}
+#     ],
+#     "messages": [
+#       {"weight": 3, "type": "text_message", "text": "Tell me a short joke", "enableTTS": false},
+#       {"weight": 1, "type": "multimodal_message", "text": "Describe this",
+#        "files": [{"path": "samples/photo.png", "mime_type": "image/png"}]}
+#     ]
+#   }
+#
+# closed: each client sends, waits for the answer, thinks for `think_time`, and repeats.
+# open: messages arrive at `rate`/s (Poisson) regardless of completions, spread over `clients`
+# connections; ramp_up starts clients (closed) or raises the rate (open) linearly.
+# order: "random" (default) picks messages by weight from the seeded generator; "sequential"
+# sends them in file order, cycling, and ignores weights.
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import logging
+import math
+import random
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from lazy_imports import lazy_module
+
+websockets = lazy_module("websockets") # Not needed by importers that only want the report helpers
+
+logger = logging.getLogger(__name__)
+
+# Error codes the server uses to refuse a message outright; other errors that end a message count as "error"
+REJECTION_CODES = {"rate_limited", "overloaded", "queue_full"}
+
+DEFAULT_MESSAGES = [
+    {"type": "text_message", "text": "Tell me a short joke", "enableTTS": False},
+    {"type": "text_message", "text": "How does text-to-speech work?", "enableTTS": False},
+    {"type": "text_message", "text": "Tell me about the solar system", "enableTTS": True},
+]
+
+class Phase:
+    def __init__(self, name: str, mode: str = "closed", clients: int = 1, duration: float = 30.0, ramp_up: float = 0.0,
+                 rate: float = 1.0, think_time: float = 0.0, max_requests: Optional[int] = None):
+        if mode not in ("closed", "open"): raise ValueError(f"Phase '{name}': mode must be 'closed' or 'open'")
+        if clients < 1: raise ValueError(f"Phase '{name}': clients must be >= 1")
+        self.name = name
+        self.mode = mode
+        self.clients = clients
+        self.duration = duration
+        self.ramp_up = min(ramp_up, duration)
+        self.rate = rate # Arrivals per second (open loop)
+        self.think_time = think_time # Pause between a reply and the next message (closed loop)
+        self.max_requests = max_requests # Per client (closed) or per phase (open)
+
+class Scenario:
+    def __init__(self, url: str, phases: List[Phase], messages: List[Dict[str, Any]], request_timeout: float = 60.0, seed: Optional[int] = None,
+                 order: str = "random"):
+        if not phases: raise ValueError("Scenario needs at least one phase")
+        if not messages: raise ValueError("Scenario needs at least one message")
+        if order not in ("random", "sequential"): raise ValueError(f"Unknown message order '{order}'")
+        self.url = url.rstrip("/")
+        self.phases = phases
+        self.messages = messages
+        self.weights = [m.get("_weight", 1) for m in messages]
+        self.request_timeout = request_timeout
+        self.random = random.Random(seed)
+        self._sequence = itertools.cycle(messages) if order == "sequential" else None
+
+    @classmethod
+    def from_file(cls, path: str, url: Optional[str] = None) -> "Scenario":
+        spec = json.loads(Path(path).read_text())
+        return cls.from_dict(spec, base_dir=Path(path).parent, url=url)
+
+    @classmethod
+    def from_dict(cls, spec: Dict[str, Any], base_dir: Path = Path("."), url: Optional[str] = None) -> "Scenario":
+        messages = [_load_message(m, base_dir) for m in spec.get("messages") or DEFAULT_MESSAGES]
+        phases = [Phase(**p) for p in spec["phases"]]
+        return cls(url or spec.get("url", "ws://localhost:8000"), phases, messages, spec.get("request_timeout", 60.0), spec.get("seed"),
+                   spec.get("order", "random"))
+
+    def pick_message(self) -> Dict[str, Any]:
+        if self._sequence is not None: return next(self._sequence)
+        return self.random.choices(self.messages, weights=self.weights)[0]
+
+def _load_message(spec: Dict[str, Any], base_dir: Path) -> Dict[str, Any]:
+    """Build the wire payload once: file paths are read and base64-encoded up front"""
+    message = {k: v for k, v in spec.items() if k != "weight"}
+    files = []
+    for file_spec in message.get("files") or ():
+        file_spec = dict(file_spec)
+        path = file_spec.pop("path", None)
+        if path is not None:
+            file_spec["data"] = base64.b64encode((base_dir / path).read_bytes()).decode("ascii")
+            file_spec.setdefault("filename", Path(path).name)
+        files.append(file_spec)
+    if files: message["files"] = files
+    message["_weight"] = spec.get("weight", 1)
+    return message
+
+class RequestResult:
+    def __init__(self, phase: str, message_type: str):
+        self.phase = phase
+        self.message_type = message_type
+        self.sent_at = time.time()
+        self.started = time.perf_counter()
+        self.ttft: Optional[float] = None # Seconds to the first text chunk
+        self.first_audio: Optional[float] = None # Seconds to the first audio frame
+        self.chunk_times: List[float] = [] # Arrival offsets (s) of every text chunk
+        self.server_timing: Dict[str, Any] = {} # "timing" reported by the server on complete
+        self.latency: Optional[float] = None # Seconds to "complete" (or rejection/failure)
+        self.outcome = "pending" # ok | error | rejected | timeout | disconnected
+        self.error: Optional[str] = None
+        self.text_chunks = 0
+        self.audio_bytes = 0
+        self.audio: Optional[List[bytes]] = None # Raw audio frames, only when the caller asked to capture them
+
+    def finish(self, outcome: str, error: Optional[str] = None):
+        if self.outcome != "pending": return
+        self.latency = time.perf_counter() - self.started
+        self.outcome = outcome
+        self.error = error
+
+class SimulatedClient:
+    """One WebSocket connection that can have several messages in flight.
+
+    The server answers a connection's messages in order, so streamed text and audio belong to the
+    oldest outstanding message. Every reply that ends a message ("complete", refusals, validation
+    errors, "attachment_missing") echoes the "id" we send and is matched by it; errors without an
+    id come from the generation itself and are followed by a "complete".
+    """
+
+    def __init__(self, url: str, client_id: str, request_timeout: float, capture_audio: bool = False):
+        self.url = f"{url}/ws/{client_id}"
+        self.client_id = client_id
+        self.request_timeout = request_timeout
+        self.capture_audio = capture_audio
+        self._ws = None
+        self._reader: Optional[asyncio.Task] = None
+        self._outstanding: "OrderedDict[str, tuple]" = OrderedDict() # id -> (RequestResult, Future)
+        self._seq = 0
+        self.closed: Optional[str] = None
+
+    async def connect(self):
+        self._ws = await websockets.connect(self.url, max_size=None)
+        self._reader = asyncio.create_task(self._read(), name=f"load-reader-{self.client_id}")
+
+    async def close(self):
+        if self._ws is not None: await self._ws.close()
+        if self._reader:
+            try: await asyncio.wait_for(self._reader, timeout=5)
+            except (asyncio.TimeoutError, asyncio.CancelledError): self._reader.cancel()
+
+    async def request(self, message: Dict[str, Any], phase: str) -> RequestResult:
+        result = RequestResult(phase, message.get("type", "unknown"))
+        if self.closed:
+            result.finish("disconnected", self.closed)
+            return result
+        self._seq += 1
+        message_id = f"{self.client_id}:{self._seq}"
+        future = asyncio.get_running_loop().create_future()
+        if self.capture_audio: result.audio = []
+        self._outstanding[message_id] = (result, future)
+        payload = {k: v for k, v in message.items() if not k.startswith("_")}
+        payload["id"] = message_id
+        try:
+            await self._ws.send(json.dumps(payload))
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.request_timeout)
+        except asyncio.TimeoutError:
+            result.finish("timeout", f"No reply within {self.request_timeout}s")
+        except websockets.ConnectionClosed as e:
+            result.finish("disconnected", f"Connection closed ({e.code})")
+        finally:
+            self._outstanding.pop(message_id, None)
+        return result
+
+    def _oldest(self) -> Optional[RequestResult]:
+        for result, future in self._outstanding.values():
+            if not future.done(): return result
+        return None
+
+    def _resolve(self, message_id: Optional[str], outcome: str, error: Optional[str] = None):
+        if message_id is None:
+            message_id = next((mid for mid, (_, f) in self._outstanding.items() if not f.done()), None)
+        entry = self._outstanding.get(message_id) if message_id else None
+        if entry is None or entry[1].done(): return
+        result, future = entry
+        result.finish(outcome if outcome != "ok" or result.error is None else "error", error or result.error)
+        future.set_result(None)
+
+    async def _read(self):
+        try:
+            async for frame in self._ws:
+                if isinstance(frame, bytes):
+                    result = self._oldest()
+                    if result:
+                        if result.first_audio is None: result.first_audio = time.perf_counter() - result.started
+                        result.audio_bytes += len(frame)
+                        if result.audio is not None: result.audio.append(frame)
+                    continue
+                data = json.loads(frame)
+                kind = data.get("type")
+                if kind == "text":
+                    result = self._oldest()
+                    if result:
+                        offset = time.perf_counter() - result.started
+                        result.text_chunks += 1
+                        result.chunk_times.append(offset)
+                        if result.ttft is None: result.ttft = offset
+                elif kind == "complete":
+                    entry = self._outstanding.get(data.get("id"))
+                    result = entry[0] if entry else self._oldest()
+                    if result: result.server_timing = data.get("timing") or {}
+                    self._resolve(data.get("id"), "ok")
+                elif kind == "error":
+                    if data.get("id") is not None:
+                        code = data.get("code")
+                        self._resolve(data["id"], "rejected" if code in REJECTION_CODES else "error", code or data.get("error", "error"))
+                    else:
+                        result = self._oldest() # A "complete" still follows generation errors
+                        if result and result.error is None: result.error = data.get("error", "error")
+                elif kind == "attachment_missing":
+                    self._resolve(data.get("id"), "error", "attachment_missing")
+        except websockets.ConnectionClosed as e:
+            self.closed = f"Connection closed ({e.code} {e.reason})".strip()
+        finally:
+            self.closed = self.closed or "Connection closed"
+            for message_id in list(self._outstanding):
+                self._resolve(message_id, "disconnected", self.closed)
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values: return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def summarize(phase: Phase, results: List[RequestResult], elapsed: float) -> Dict[str, Any]:
+    outcomes: Dict[str, int] = {}
+    for r in results: outcomes[r.outcome] = outcomes.get(r.outcome, 0) + 1
+    ok = [r for r in results if r.outcome == "ok"]
+    latencies = sorted(r.latency for r in ok)
+    ttfts = sorted(r.ttft for r in ok if r.ttft is not None)
+    def ms(value): return round(value * 1000, 2) if value is not None else None
+    return {
+        "phase": phase.name, "mode": phase.mode, "clients": phase.clients,
+        "duration_s": round(elapsed, 2),
+        "requests": len(results), "outcomes": outcomes,
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed > 0 else 0.0,
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "latency_ms": {"p50": ms(percentile(latencies, 50)), "p95": ms(percentile(latencies, 95)),
+                       "p99": ms(percentile(latencies, 99)), "max": ms(latencies[-1] if latencies else None)},
+        "ttft_ms": {"p50": ms(percentile(ttfts, 50)), "p95": ms(percentile(ttfts, 95)), "p99": ms(percentile(ttfts, 99))},
+        "audio_bytes": sum(r.audio_bytes for r in results),
+        "errors": sorted({r.error for r in results if r.error})[:10],
+    }
+
+class LoadTest:
+    def __init__(self, scenario: Scenario, capture_audio: bool = False):
+        self.scenario = scenario
+        self.capture_audio = capture_audio
+        self.run_id = uuid.uuid4().hex[:8]
+        self.results: Dict[str, List[RequestResult]] = {}
+
+    async def run(self) -> Dict[str, Any]:
+        report = {"url": self.scenario.url, "run_id": self.run_id, "started_at": time.time(), "phases": []}
+        for phase in self.scenario.phases:
+            logger.info(f"Phase '{phase.name}': {phase.mode} loop, {phase.clients} clients, {phase.duration}s")
+            results: List[RequestResult] = []
+            started = time.perf_counter()
+            if phase.mode == "closed": await self._run_closed(phase, results)
+            else: await self._run_open(phase, results)
+            self.results[phase.name] = results
+            report["phases"].append(summarize(phase, results, time.perf_counter() - started))
+        return report
+
+    def _client(self, phase: Phase, index: int) -> SimulatedClient:
+        return SimulatedClient(self.scenario.url, f"load-{self.run_id}-{phase.name}-{index}", self.scenario.request_timeout, self.capture_audio)
+
+    async def _connect(self, client: SimulatedClient, results: List[RequestResult], phase: Phase) -> bool:
+        try:
+            await client.connect()
+            return True
+        except Exception as e:
+            failed = RequestResult(phase.name, "connect")
+            failed.finish("disconnected", f"Connect failed: {e}")
+            results.append(failed)
+            return False
+
+    async def _run_closed(self, phase: Phase, results: List[RequestResult]):
+        deadline = time.perf_counter() + phase.duration
+        async def user(index: int):
+            await asyncio.sleep(phase.ramp_up * index / phase.clients)
+            client = self._client(phase, index)
+            if not await self._connect(client, results, phase): return
+            sent = 0
+            try:
+                while time.perf_counter() < deadline and (phase.max_requests is None or sent < phase.max_requests):
+                    results.append(await client.request(self.scenario.pick_message(), phase.name))
+                    sent += 1
+                    if client.closed: break
+                    if phase.think_time: await asyncio.sleep(self.scenario.random.expovariate(1 / phase.think_time))
+            finally:
+                await client.close()
+        await asyncio.gather(*(user(i) for i in range(phase.clients)))
+
+    async def _run_open(self, phase: Phase, results: List[RequestResult]):
+        clients = [self._client(phase, i) for i in range(phase.clients)]
+        connected = [c for c, ok in zip(clients, await asyncio.gather(*(self._connect(c, results, phase) for c in clients))) if ok]
+        if not connected: return
+        loop_start = time.perf_counter()
+        in_flight: List[asyncio.Task] = []
+        sent, turn = 0, 0
+        async def send(client: SimulatedClient, message: Dict[str, Any]):
+            results.append(await client.request(message, phase.name))
+        try:
+            while True:
+                elapsed = time.perf_counter() - loop_start
+                if elapsed >= phase.duration or (phase.max_requests is not None and sent >= phase.max_requests): break
+                rate = phase.rate * (min(1.0, elapsed / phase.ramp_up) if phase.ramp_up else 1.0)
+                interval = self.scenario.random.expovariate(max(rate, 1e-3))
+                if interval > 0.1:
+                    # Arrivals are memoryless, so while the rate ramps we wait in short steps and redraw
+                    await asyncio.sleep(min(0.1, phase.duration - elapsed))
+                    continue
+                await asyncio.sleep(interval)
+                live = [c for c in connected if not c.closed]
+                if not live: break
+                client = live[turn % len(live)]; turn += 1
+                in_flight.append(asyncio.create_task(send(client, self.scenario.pick_message())))
+                sent += 1
+            if in_flight: await asyncio.gather(*in_flight)
+        finally:
+            await asyncio.gather(*(c.close() for c in connected))
+
+def format_report(report: Dict[str, Any]) -> str:
+    header = f"{'phase':<14}{'mode':<8}{'clients':>8}{'reqs':>7}{'ok':>7}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ttft p50':>10}{'err%':>7}"
+    lines = [header, "-" * len(header)]
+    for p in report["phases"]:
+        lat, ttft = p["latency_ms"], p["ttft_ms"]
+        fmt = lambda v: f"{v:.1f}" if v is not None else "-"
+        lines.append(f"{p['phase']:<14}{p['mode']:<8}{p['clients']:>8}{p['requests']:>7}{p['outcomes'].get('ok', 0):>7}{p['throughput_rps']:>9.2f}"
+                     f"{fmt(lat['p50']):>10}{fmt(lat['p95']):>10}{fmt(lat['p99']):>10}{fmt(ttft['p50']):>10}{p['error_rate'] * 100:>7.1f}")
+        for error in p["errors"]: lines.append(f"    ! {error}")
+    return "\n".join(lines)
+
+async def run_scenario(scenario: Scenario, capture_audio: bool = False) -> Dict[str, Any]:
+    return await LoadTest(scenario, capture_audio).run()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the Gemini WebSocket service")
+    parser.add_argument("--scenario", help="JSON scenario file (phases + weighted messages)")
+    parser.add_argument("--url", help="Server base URL, e.g. ws://localhost:8000 (overrides the scenario)")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed", help="Single-phase mode when no scenario is given")
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--ramp-up", type=float, default=0.0)
+    parser.add_argument("--rate", type=float, default=5.0, help="Arrivals per second (open loop)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Mean pause between messages (closed loop)")
+    parser.add_argument("--output", help="Write the JSON report here")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.scenario:
+        scenario = Scenario.from_file(args.scenario, url=args.url)
+    else:
+        scenario = Scenario.from_dict({"phases": [{"name": args.mode, "mode": args.mode, "clients": args.clients, "duration": args.duration,
+                                                   "ramp_up": args.ramp_up, "rate": args.rate, "think_time": args.think_time}]}, url=args.url)
+    report = asyncio.run(run_scenario(scenario))
+    print(format_report(report))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        logger.info(f"Report written to {args.output}")
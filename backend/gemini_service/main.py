@@ -1,24 +1,49 @@
 # backend/gemini_service/main.py
+import os
+import time
+# Start-up timings in /ready count from the first import of this module, including the imports below.
+# `python main.py` imports it twice (as __main__, then via uvicorn), hence the environment variable.
+STARTED_AT = float(os.environ.setdefault("GEMINI_SERVICE_STARTED_AT", str(time.time())))
 import base64
-import json
 import asyncio
+import uuid
 import logging
-import os
 from dotenv import load_dotenv
 from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import List, Optional, Dict, Any, Tuple
+from typing import List, Optional, Dict, Any, Set, Tuple
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException 
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Header, Response
 from starlette.websockets import WebSocketState # Import WebSocketState from starlette
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, ValidationError
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field, ValidationError, model_validator
 
-from gemini_client import GeminiClient
+from gemini_client import GeminiClient, VoiceConfig, record_exchange
+from codec import create_codec
+from gemini_backends import create_backend
+from resilience import CircuitBreaker, RetryBudget, UpstreamResilience, UpstreamUnavailable
+from connection_pipeline import ConnectionPipeline
+from binary_protocol import PROTOCOL_NAME, PROTOCOL_VERSION, HEADER_SIZE, AudioFramer, decode_frame
+from upload_stream import RamBudget, StreamingUpload, UploadManager
+from attachment_store import AttachmentStore
+from attachment_preprocess import AttachmentPreprocessor
+from conversation import ConversationStore
+from audio_pipeline import AudioEgress
+from response_cache import InMemoryResponseCache, ResponseCache, ResponseRecorder, cache_key, content_hash, replay
+from session_pool import SessionPool, SessionPoolExhausted, voice_key
+from connection_registry import ConnectionEntry, ConnectionRegistry, create_registry
+from admission import CLOSE_POLICY_VIOLATION, CLOSE_TRY_AGAIN_LATER, AdmissionController
+from idle_reaper import IdleReaper
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY as METRICS, WS_CLOSES, WS_CONNECTIONS, WS_TTFT, WS_UPLOAD_SIZE
+from tracing import create_tracer, current_trace
+from session_recorder import SessionRecorder, mask_user_content
+from memory import MemoryBudget, allocation_report, gc_report, process_memory
+from lazy_imports import preload
 
 # --- Load Environment Variables FIRST ---
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
-loaded = load_dotenv(dotenv_path=dotenv_path, verbose=True)
+loaded = load_dotenv(dotenv_path=dotenv_path)
 logger = logging.getLogger(__name__) 
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 logging.basicConfig(level=getattr(logging, LOG_LEVEL.upper(), logging.INFO),
@@ -28,24 +53,120 @@ logger.info(f"Attempted to load .env file from: {dotenv_path}, Loaded: {loaded}"
 # --- Configuration ---
 HOST = os.getenv('HOST', '0.0.0.0')
 PORT = int(os.getenv('PORT', 8000))
+WORKERS = int(os.getenv('WORKERS', 1)) # Uvicorn worker processes; >1 needs REGISTRY_BACKEND=redis for cluster-wide state
+REGISTRY_BACKEND = os.getenv('REGISTRY_BACKEND', 'memory').lower() # memory (single process) or redis
+REDIS_URL = os.getenv('REDIS_URL')
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN') # Enables server-initiated messages via POST /connections/{client_id}/messages
+GEMINI_BACKEND = os.getenv('GEMINI_BACKEND', 'live').lower() # live, or simulated for offline benchmarking (SIM_* settings, see gemini_backends.py)
 DEFAULT_VOICE = os.getenv('DEFAULT_VOICE', 'Charon')
 DEFAULT_LANGUAGE = os.getenv('DEFAULT_LANGUAGE', 'en-US')
 ALLOWED_ORIGINS = os.getenv('ALLOWED_ORIGINS', 'http://localhost:5173,http://localhost:3000,https://lovable.dev,https://*.googleprod.com').split(',')
 WS_PING_INTERVAL = int(os.getenv('WS_PING_INTERVAL', 30))
 WS_PING_TIMEOUT = int(os.getenv('WS_PING_TIMEOUT', 10))
+WS_IDLE_TIMEOUT = float(os.getenv('WS_IDLE_TIMEOUT', WS_PING_INTERVAL * 1.5)) # Seconds without client frames before the reaper closes a socket
+MAX_CONNECTIONS = int(os.getenv('MAX_CONNECTIONS', 1000)) # Per worker; further sockets are closed with 1013
+MAX_INFLIGHT_GENERATIONS = int(os.getenv('MAX_INFLIGHT_GENERATIONS', 100)) # Concurrent upstream generations per worker
+CLIENT_RATE_LIMIT = float(os.getenv('CLIENT_RATE_LIMIT', 1.0)) # Sustained messages per second per client
+CLIENT_RATE_BURST = float(os.getenv('CLIENT_RATE_BURST', 5))
+WS_SEND_QUEUE_SIZE = int(os.getenv('WS_SEND_QUEUE_SIZE', 256)) # Outbound frames buffered per connection
+WS_RECV_QUEUE_SIZE = int(os.getenv('WS_RECV_QUEUE_SIZE', 8)) # Pending client messages per connection
+WS_SEND_TIMEOUT = float(os.getenv('WS_SEND_TIMEOUT', 15)) # Seconds a full send queue may stall before dropping the client
+WS_MEMORY_BUDGET = int(os.getenv('WS_MEMORY_BUDGET', 256 * 1024 * 1024)) # Queued outbound frame bytes across all connections
+WS_CONNECTION_MEMORY = int(os.getenv('WS_CONNECTION_MEMORY', 2 * 1024 * 1024)) # Per connection; producers wait (up to WS_SEND_TIMEOUT) beyond it
+WS_PER_MESSAGE_DEFLATE = os.getenv('WS_PER_MESSAGE_DEFLATE', 'false').lower() == 'true' # zlib state costs ~45KB per socket; small JSON chunks and PCM barely compress
+MEMORY_TRACEMALLOC = os.getenv('MEMORY_TRACEMALLOC', 'false').lower() == 'true' # Allocation sites in /debug/memory; slows allocation-heavy code
+JSON_CODEC = os.getenv('JSON_CODEC', 'auto').lower() # auto (orjson, then msgspec, then stdlib), orjson, msgspec or stdlib
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', 200 * 1024 * 1024)) # Per file sent over binary frames
+MAX_PENDING_UPLOADS = int(os.getenv('MAX_PENDING_UPLOADS', 4))
+UPLOAD_SPILL_THRESHOLD = int(os.getenv('UPLOAD_SPILL_THRESHOLD', 8 * 1024 * 1024)) # Larger uploads go to a temp file
+UPLOAD_RAM_BUDGET = int(os.getenv('UPLOAD_RAM_BUDGET', 256 * 1024 * 1024)) # In-memory upload bytes across all connections
+UPLOAD_SPOOL_DIR = os.getenv('UPLOAD_SPOOL_DIR') or None # Defaults to the system temp dir
+ATTACHMENT_STORE_MAX_BYTES = int(os.getenv('ATTACHMENT_STORE_MAX_BYTES', 256 * 1024 * 1024)) # Prepared parts kept for reuse by hash
+PREPROCESS_ENABLED = os.getenv('PREPROCESS_ENABLED', 'true').lower() == 'true' # Shrink new attachments in worker processes before sending
+PREPROCESS_WORKERS = int(os.getenv('PREPROCESS_WORKERS', 2))
+PREPROCESS_TIMEOUT = float(os.getenv('PREPROCESS_TIMEOUT', 30)) # Seconds per file before it is sent as-is
+PREPROCESS_CACHE_MAX_BYTES = int(os.getenv('PREPROCESS_CACHE_MAX_BYTES', 64 * 1024 * 1024)) # Results kept by content hash
+PREPROCESS_MIN_BYTES = int(os.getenv('PREPROCESS_MIN_BYTES', 256 * 1024)) # Smaller images and audio are sent as they are
+PREPROCESS_IMAGE_MAX_SIDE = int(os.getenv('PREPROCESS_IMAGE_MAX_SIDE', 1536)) # Pixels; 0 leaves images alone
+PREPROCESS_IMAGE_QUALITY = int(os.getenv('PREPROCESS_IMAGE_QUALITY', 85))
+PREPROCESS_IMAGE_MAX_PIXELS = int(os.getenv('PREPROCESS_IMAGE_MAX_PIXELS', 64_000_000)) # Larger images are sent as-is without decoding
+PREPROCESS_AUDIO_SAMPLE_RATE = int(os.getenv('PREPROCESS_AUDIO_SAMPLE_RATE', 16000)) # Mono; 0 leaves audio alone
+PREPROCESS_AUDIO_FORMAT = os.getenv('PREPROCESS_AUDIO_FORMAT', 'mp3').lower() # mp3 or ogg (ffmpeg), or wav
+PREPROCESS_AUDIO_BITRATE = os.getenv('PREPROCESS_AUDIO_BITRATE', '32k')
+PREPROCESS_DOCUMENT_TEXT = os.getenv('PREPROCESS_DOCUMENT_TEXT', 'true').lower() == 'true' # Send PDF/DOCX/PPTX as their text
+PREPROCESS_PDF_MAX_PAGES = int(os.getenv('PREPROCESS_PDF_MAX_PAGES', 300)) # Longer PDFs are sent as-is
+AUDIO_OUTPUT_FORMAT = os.getenv('AUDIO_OUTPUT_FORMAT', 'pcm').lower() # pcm (passthrough), mp3 or opus
+AUDIO_SAMPLE_RATE = int(os.getenv('AUDIO_SAMPLE_RATE', 24000)) # Live API output is 16-bit mono PCM
+AUDIO_FRAME_MS = int(os.getenv('AUDIO_FRAME_MS', 20))
+AUDIO_BUFFER_MS = int(os.getenv('AUDIO_BUFFER_MS', 5000)) # Jitter buffer per connection; oldest audio is dropped beyond it
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 1000))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRY_BYTES', 4 * 1024 * 1024)) # Larger responses are not cached
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 3600))
+RESPONSE_CACHE_REPLAY_PACED = os.getenv('RESPONSE_CACHE_REPLAY', 'instant').lower() == 'paced' # 'paced' keeps the original chunk timing
+CONVERSATION_HISTORY = os.getenv('CONVERSATION_HISTORY', 'true').lower() == 'true' # Send earlier turns with each message
+CONVERSATION_MAX_TOKENS = int(os.getenv('CONVERSATION_MAX_TOKENS', 8000)) # Recent turns kept verbatim; older ones are summarized
+CONVERSATION_SUMMARY_TOKENS = int(os.getenv('CONVERSATION_SUMMARY_TOKENS', 512))
+CONVERSATION_MAX_COUNT = int(os.getenv('CONVERSATION_MAX_COUNT', 10000)) # Conversations kept per worker (LRU)
+CONVERSATION_IDLE_TTL = float(os.getenv('CONVERSATION_IDLE_TTL', 1800)) # Seconds history is kept for a reconnect with its resume token (sent in hello_ack)
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv('UPSTREAM_MAX_ATTEMPTS', 3)) # Per connect or message, only before anything was streamed
+UPSTREAM_RETRY_RATIO = float(os.getenv('UPSTREAM_RETRY_RATIO', 0.2)) # Retries + hedges allowed per upstream request (budget)
+UPSTREAM_BREAKER_THRESHOLD = int(os.getenv('UPSTREAM_BREAKER_THRESHOLD', 5)) # Consecutive failures that open the circuit
+UPSTREAM_BREAKER_RESET = float(os.getenv('UPSTREAM_BREAKER_RESET', 30)) # Seconds the circuit stays open before a probe
+UPSTREAM_HEDGE_DELAY_MS = float(os.getenv('UPSTREAM_HEDGE_DELAY_MS', 0)) # Hedge a request with no first chunk after this long; 0 disables
+SESSION_POOL_MIN_SIZE = int(os.getenv('SESSION_POOL_MIN_SIZE', 2))
+SESSION_POOL_MAX_SIZE = int(os.getenv('SESSION_POOL_MAX_SIZE', 50))
+SESSION_POOL_IDLE_TIMEOUT = float(os.getenv('SESSION_POOL_IDLE_TIMEOUT', 300))
+SESSION_POOL_HEALTH_INTERVAL = float(os.getenv('SESSION_POOL_HEALTH_INTERVAL', 30))
+SESSION_POOL_ACQUIRE_TIMEOUT = float(os.getenv('SESSION_POOL_ACQUIRE_TIMEOUT', 10))
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'false').lower() == 'true' # Per-message stage spans; off costs a no-op context manager per stage
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0.1)) # Fraction of messages traced
+TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', 'file').lower() # file (JSON lines) or otlp (OTLP/HTTP JSON, see trace_collector.py)
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+SESSION_RECORDING = os.getenv('SESSION_RECORDING', 'false').lower() == 'true' # Record /ws frames for session_replay.py; recordings hold user text and attachments unredacted
+SESSION_RECORD_REDACT = os.getenv('SESSION_RECORD_REDACT', 'false').lower() == 'true' # Mask inbound text and attachment bytes (sizes kept) before they are written
+SESSION_RECORD_DIR = os.getenv('SESSION_RECORD_DIR', 'recordings')
+SESSION_RECORD_SAMPLE_RATE = float(os.getenv('SESSION_RECORD_SAMPLE_RATE', 1.0)) # Fraction of connections recorded
+SESSION_RECORD_MAX_FILE_BYTES = int(os.getenv('SESSION_RECORD_MAX_FILE_BYTES', 64 * 1024 * 1024)) # Rotate to a new file beyond this
+SESSION_RECORD_MAX_FILES = int(os.getenv('SESSION_RECORD_MAX_FILES', 10)) # Per worker run; its oldest files are deleted beyond this
+SESSION_RECORD_OUTBOUND_BYTES = int(os.getenv('SESSION_RECORD_OUTBOUND_BYTES', 64)) # Prefix kept of each outbound frame (its size is always kept)
 API_VERSION = "0.2.0" 
 
+if MEMORY_TRACEMALLOC:
+    import tracemalloc
+    tracemalloc.start() # Traces allocations from here on (state created below, and every connection)
+
 # --- Verify Critical Config --- 
 GOOGLE_API_KEY_LOADED = bool(os.getenv("GOOGLE_API_KEY"))
-logger.info(f"GOOGLE_API_KEY is loaded: {GOOGLE_API_KEY_LOADED}")
-if not GOOGLE_API_KEY_LOADED:
+GOOGLE_API_KEY_REQUIRED = GEMINI_BACKEND == "live"
+logger.info(f"GOOGLE_API_KEY is loaded: {GOOGLE_API_KEY_LOADED} (backend: {GEMINI_BACKEND})")
+if GOOGLE_API_KEY_REQUIRED and not GOOGLE_API_KEY_LOADED:
     logger.error("CRITICAL: GOOGLE_API_KEY environment variable not found!")
 
 # --- Pydantic Models --- 
 class FileData(BaseModel):
-    mime_type: str
-    data: str = Field(..., description="Base64 encoded file data")
+    mime_type: Optional[str] = None
+    data: Optional[str] = Field(None, description="Base64 encoded file data")
+    upload_id: Optional[int] = Field(None, description="Id of a file sent as binary FILE_CHUNK frames")
+    sha256: Optional[str] = Field(None, pattern="^[0-9a-f]{64}$", description="Hex SHA-256 of a file already sent on this server")
+    filename: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_source(self):
+        if sum(source is not None for source in (self.data, self.upload_id, self.sha256)) != 1:
+            raise ValueError("Exactly one of 'data', 'upload_id' or 'sha256' is required")
+        if self.sha256 is None and not self.mime_type:
+            raise ValueError("'mime_type' is required when sending file content")
+        return self
+
+class UploadStart(BaseModel):
+    type: str
+    upload_id: int
+    mime_type: Optional[str] = None
     filename: Optional[str] = None
+    size: Optional[int] = Field(None, ge=0)
 
 class TextMessage(BaseModel):
     type: str 
@@ -61,23 +182,127 @@ class MultimodalMessage(BaseModel):
     enableTTS: bool = True
 
 # --- State Management --- 
-connections: Dict[str, Tuple[WebSocket, Optional[GeminiClient]]] = {} # Client can be None now
+connections: ConnectionRegistry = create_registry(REGISTRY_BACKEND, REDIS_URL) # Local sockets + cluster-wide ownership
 last_activity: Dict[str, float] = {}
+idle_reaper: Optional[IdleReaper] = None
+startup: Dict[str, Any] = {"ready": False, "stopping": False} # Warm-up progress, reported by /ready
+admission = AdmissionController(MAX_CONNECTIONS, MAX_INFLIGHT_GENERATIONS, CLIENT_RATE_LIMIT, CLIENT_RATE_BURST)
+session_pool: Optional[SessionPool] = None
+upload_ram_budget = RamBudget(UPLOAD_RAM_BUDGET)
+memory_budget = MemoryBudget(WS_MEMORY_BUDGET, WS_CONNECTION_MEMORY)
+attachment_store = AttachmentStore(ATTACHMENT_STORE_MAX_BYTES)
+preprocessor: Optional[AttachmentPreprocessor] = AttachmentPreprocessor(
+    PREPROCESS_WORKERS, PREPROCESS_CACHE_MAX_BYTES, PREPROCESS_MIN_BYTES, PREPROCESS_TIMEOUT, image_max_side=PREPROCESS_IMAGE_MAX_SIDE,
+    image_max_pixels=PREPROCESS_IMAGE_MAX_PIXELS, image_quality=PREPROCESS_IMAGE_QUALITY, audio_sample_rate=PREPROCESS_AUDIO_SAMPLE_RATE,
+    audio_format=PREPROCESS_AUDIO_FORMAT, audio_bitrate=PREPROCESS_AUDIO_BITRATE, document_text=PREPROCESS_DOCUMENT_TEXT,
+    pdf_max_pages=PREPROCESS_PDF_MAX_PAGES) if PREPROCESS_ENABLED else None
+response_cache: Optional[ResponseCache] = InMemoryResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL) if RESPONSE_CACHE_ENABLED else None
+codec = create_codec(JSON_CODEC) # Frame encoding for every connection
+resilience = UpstreamResilience(UPSTREAM_MAX_ATTEMPTS, retry_budget=RetryBudget(UPSTREAM_RETRY_RATIO),
+                                 breaker=CircuitBreaker(UPSTREAM_BREAKER_THRESHOLD, UPSTREAM_BREAKER_RESET),
+                                 hedge_delay=UPSTREAM_HEDGE_DELAY_MS / 1000 if UPSTREAM_HEDGE_DELAY_MS > 0 else None)
+conversations: Optional[ConversationStore] = ConversationStore(CONVERSATION_MAX_TOKENS, CONVERSATION_SUMMARY_TOKENS, CONVERSATION_MAX_COUNT, CONVERSATION_IDLE_TTL) if CONVERSATION_HISTORY else None
+tracer = create_tracer(TRACING_ENABLED, TRACE_EXPORTER, TRACE_SAMPLE_RATE, TRACE_FILE, TRACE_OTLP_ENDPOINT)
+session_recorder: Optional[SessionRecorder] = SessionRecorder(
+    SESSION_RECORD_DIR, SESSION_RECORD_MAX_FILE_BYTES, SESSION_RECORD_MAX_FILES, SESSION_RECORD_SAMPLE_RATE,
+    SESSION_RECORD_OUTBOUND_BYTES, redact=mask_user_content if SESSION_RECORD_REDACT else None) if SESSION_RECORDING else None
+
+def _pipelines() -> List[ConnectionPipeline]:
+    return [entry.pipeline for _, entry in connections.items() if entry.pipeline]
+
+# Sampled when /metrics is scraped, so they cost nothing per message
+METRICS.gauge_func("gemini_ws_active_connections", "WebSocket connections open on this worker", lambda: len(connections))
+METRICS.gauge_func("gemini_ws_outbound_queue_depth", "Frames queued for sending, summed over connections", lambda: sum(p.outbound_depth for p in _pipelines()))
+METRICS.gauge_func("gemini_ws_outbound_queue_depth_max", "Deepest outbound queue of any connection", lambda: max((p.outbound_depth for p in _pipelines()), default=0))
+METRICS.gauge_func("gemini_ws_inbound_queue_depth", "Client messages waiting for the worker, summed over connections", lambda: sum(p.inbound_depth for p in _pipelines()))
+METRICS.gauge_func("gemini_upload_ram_bytes", "Upload bytes held in memory across connections", lambda: upload_ram_budget.in_use)
+METRICS.stats_gauges("gemini_ws_memory", "Outbound buffer memory budget", memory_budget.stats)
+METRICS.stats_gauges("gemini_session_pool", "Session pool", lambda: session_pool.stats() if session_pool else None)
+METRICS.stats_gauges("gemini_response_cache", "Response cache", lambda: response_cache.stats() if response_cache else None)
+METRICS.stats_gauges("gemini_attachment_store", "Attachment store", attachment_store.stats)
+METRICS.stats_gauges("gemini_attachment_preprocess", "Attachment preprocessing", lambda: preprocessor.stats() if preprocessor else None)
+METRICS.stats_gauges("gemini_admission", "Admission control", admission.stats)
+METRICS.stats_gauges("gemini_idle_reaper", "Idle reaper", lambda: idle_reaper.stats() if idle_reaper else None)
+METRICS.stats_gauges("gemini_tracing", "Tracing", tracer.stats)
+METRICS.stats_gauges("gemini_session_recorder", "Session recorder", lambda: session_recorder.stats() if session_recorder else None)
+METRICS.stats_gauges("gemini_upstream_resilience", "Upstream retries, hedging and circuit breaker", resilience.stats)
+METRICS.stats_gauges("gemini_conversations", "Conversation store", lambda: conversations.stats() if conversations else None)
+METRICS.stats_gauges("gemini_summary_cache", "Conversation summary cache", lambda: conversations.summary_cache.stats() if conversations else None)
+
+async def hash_file(data: Any) -> str:
+    """Content hash for cache keys and the attachment store; large buffers are hashed off the event loop"""
+    if memoryview(data).nbytes > 1024 * 1024: return await asyncio.to_thread(content_hash, data)
+    return content_hash(data)
+
+async def release_client(client: Optional[GeminiClient], owner: Optional[str] = None, discard: bool = False):
+    """Hand a turn's Gemini client back to the pool, parked for `owner` (or close it if there is no pool)"""
+    if not client: return
+    if session_pool: await session_pool.release(client, discard=discard, owner=owner)
+    else: await client.close()
+
+async def warm_up():
+    """Start-up work that can finish after the server is listening: /ready answers 503 until it has"""
+    started = time.time()
+    try:
+        startup["preloaded_ms"] = await asyncio.to_thread(preload) # SDK imports, off the event loop
+        if session_pool: await session_pool.start() # Pre-warm failures are logged; sessions are created on demand instead
+    except Exception as e:
+        logger.exception(f"Warm-up failed: {e}") # Still ready: everything it does also happens on demand
+    now = time.time()
+    startup.update(ready=True, warmup_ms=round((now - started) * 1000, 1), ready_after_ms=round((now - STARTED_AT) * 1000, 1))
+    logger.info(f"Warm-up finished in {startup['warmup_ms']}ms; ready {startup['ready_after_ms']}ms after start")
+
+async def reap_idle(client_id: str):
+    entry = connections.get(client_id)
+    if entry is not None and entry.close: entry.close(1001, "Idle timeout")
 
 # --- Lifespan Management --- 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global session_pool, idle_reaper
     logger.info("Lifespan startup: Initializing service...")
+    if preprocessor: preprocessor.start() # Forks its workers before any threads exist
+    await connections.start()
+    idle_reaper = IdleReaper(last_activity, WS_IDLE_TIMEOUT, reap_idle, is_busy=admission.is_generating)
+    idle_reaper.start()
+    tracer.start()
+    if session_recorder: session_recorder.start()
+    api_key = os.getenv("GOOGLE_API_KEY")
+    if api_key or not GOOGLE_API_KEY_REQUIRED:
+        gemini_backend = create_backend(GEMINI_BACKEND, api_key) # Shared by every pooled client
+        session_pool = SessionPool(
+            client_factory=lambda: GeminiClient(attachment_store=attachment_store, backend=gemini_backend, resilience=resilience,
+                                                preprocessor=preprocessor),
+            default_key=voice_key(DEFAULT_VOICE, DEFAULT_LANGUAGE),
+            min_size=SESSION_POOL_MIN_SIZE,
+            max_size=SESSION_POOL_MAX_SIZE,
+            idle_timeout=SESSION_POOL_IDLE_TIMEOUT,
+            health_check_interval=SESSION_POOL_HEALTH_INTERVAL,
+            acquire_timeout=SESSION_POOL_ACQUIRE_TIMEOUT,
+        )
+    # Serve right away; pre-warming continues in the background (connections meanwhile create sessions on demand)
+    warmup_task = asyncio.create_task(warm_up(), name="warm-up")
+    startup["listening_after_ms"] = round((time.time() - STARTED_AT) * 1000, 1)
+    logger.info(f"Accepting connections {startup['listening_after_ms']}ms after start")
     yield
     logger.info("Lifespan shutdown: Cleaning up resources...")
+    startup["stopping"] = True # /ready fails first, so load balancers stop routing here
+    warmup_task.cancel()
+    await idle_reaper.close(); idle_reaper = None
+    await tracer.close() # Flushes buffered spans
     logger.info(f"Closing {len(connections)} remaining connections...")
-    for client_id, (ws, client_instance) in list(connections.items()):
+    for client_id, entry in connections.items():
         logger.info(f"Closing connection for client {client_id} during shutdown...")
-        if client_instance: await client_instance.close()
-        if ws.client_state != WebSocketState.DISCONNECTED: 
-            try: await ws.close(code=1001)
+        if entry.close: entry.close(1001, "Server shutting down") # Its handler cancels the turn and releases the lease
+        elif entry.websocket.client_state != WebSocketState.DISCONNECTED:
+            try: await entry.websocket.close(code=1001)
             except Exception: pass
-    connections.clear(); last_activity.clear()
+    await connections.close(); last_activity.clear()
+    if session_recorder: await session_recorder.close() # Flushes buffered records
+    if session_pool:
+        await session_pool.close()
+        session_pool = None
+    if preprocessor: preprocessor.close()
     logger.info("Lifespan shutdown complete.")
 
 # --- FastAPI App Setup --- 
@@ -91,6 +316,7 @@ app = FastAPI(
 app.add_middleware(CORSMiddleware, allow_origins=ALLOWED_ORIGINS, allow_credentials=True, allow_methods=["*"], allow_headers=["*"],)
 logger.info(f"Starting Gemini WebSocket Service v{API_VERSION}")
 logger.info(f"Allowed Origins: {ALLOWED_ORIGINS}")
+logger.info(f"JSON codec: {codec.name}")
 
 # --- API Endpoints --- 
 @app.get("/version", tags=["Meta"])
@@ -98,9 +324,65 @@ async def get_version(): return {"version": API_VERSION}
 
 @app.get("/health", tags=["Meta"])
 async def health_check():
-    if not GOOGLE_API_KEY_LOADED:
+    if GOOGLE_API_KEY_REQUIRED and not GOOGLE_API_KEY_LOADED:
         raise HTTPException(status_code=503, detail="Service Unavailable: GOOGLE_API_KEY not configured")
-    return {"status": "healthy", "version": API_VERSION, "timestamp": datetime.now().isoformat()}
+    worker_counts = await connections.worker_counts()
+    return {"status": "healthy", "version": API_VERSION, "timestamp": datetime.now().isoformat(), "backend": GEMINI_BACKEND, "json_codec": codec.name,
+            "connections": {**connections.stats(), "total": sum(worker_counts.values()), "workers": worker_counts},
+            "session_pool": session_pool.stats() if session_pool else None,
+            "response_cache": response_cache.stats() if response_cache else None,
+            "attachment_store": attachment_store.stats(),
+            "attachment_preprocess": preprocessor.stats() if preprocessor else None,
+            "upstream": resilience.stats(),
+            "conversations": conversations.stats() if conversations else None,
+            "admission": admission.stats(),
+            "idle_reaper": idle_reaper.stats() if idle_reaper else None,
+            "tracing": tracer.stats(),
+            "session_recorder": session_recorder.stats() if session_recorder else None}
+
+@app.get("/ready", tags=["Meta"])
+async def readiness_check():
+    """Readiness, as opposed to /health's liveness: 503 while warming up, misconfigured or shutting down"""
+    misconfigured = GOOGLE_API_KEY_REQUIRED and not GOOGLE_API_KEY_LOADED
+    ready = startup["ready"] and not startup["stopping"] and not misconfigured and connections.healthy
+    status = ("ready" if ready else "stopping" if startup["stopping"] else "warming_up" if not startup["ready"]
+              else "misconfigured" if misconfigured else "registry_disconnected") # Messages routed from other workers would be lost
+    return JSONResponse({"status": status, **{k: v for k, v in startup.items() if k not in ("ready", "stopping")},
+                         "session_pool": session_pool.stats() if session_pool else None,
+                         "registry": connections.stats()}, status_code=200 if ready else 503)
+
+@app.get("/metrics", tags=["Meta"])
+async def get_metrics():
+    """Prometheus text exposition of this worker's counters, histograms and gauges"""
+    return Response(METRICS.render(), media_type=METRICS_CONTENT_TYPE)
+
+@app.get("/debug/memory", tags=["Meta"])
+async def debug_memory(x_admin_token: Optional[str] = Header(None)):
+    """Where this worker's memory goes: process RSS, connection buffers, caches and (with MEMORY_TRACEMALLOC) allocation sites"""
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    pipelines = _pipelines()
+    process = process_memory()
+    return {"process": process, "gc": gc_report(),
+            "connections": {"count": len(connections), "outbound_frames": sum(p.outbound_depth for p in pipelines),
+                            "inbound_messages": sum(p.inbound_depth for p in pipelines), "last_activity_entries": len(last_activity)},
+            "buffers": memory_budget.stats(), "top_connections": memory_budget.top(10),
+            "uploads": {"ram_bytes": upload_ram_budget.in_use, "limit_bytes": upload_ram_budget.limit_bytes},
+            "attachment_store": attachment_store.stats(),
+            "attachment_preprocess": preprocessor.stats() if preprocessor else None,
+            "response_cache": response_cache.stats() if response_cache else None,
+            "conversations": conversations.stats() if conversations else None,
+            "session_pool": session_pool.stats() if session_pool else None, # Live sessions are held per turn, not per socket
+            "allocations": allocation_report()}
+
+@app.post("/connections/{client_id}/messages", tags=["WebSocket"])
+async def send_to_connection(client_id: str, message: Dict[str, Any], x_admin_token: Optional[str] = Header(None)):
+    """Push a JSON message to a connected client, on whichever worker owns it"""
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    if not await connections.send_to(client_id, message):
+        raise HTTPException(status_code=404, detail=f"Client {client_id} is not connected")
+    return {"status": "queued", "client_id": client_id}
 
 # --- WebSocket Endpoint --- 
 @app.websocket("/ws/{client_id}")
@@ -108,108 +390,305 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
     logger.info(f"Connection request from {client_id} @ {websocket.client.host}:{websocket.client.port}")
     await websocket.accept()
     logger.info(f"Connection accepted for {client_id}")
-    client = None
+    session_owner = uuid.uuid4().hex # Parks this connection's used session between turns
+    resume_token, keep_history = None, False # Conversation history key, and whether it outlives this connection
+    close_code, close_reason = 1000, ""
+    if not admission.admit_connection(client_id):
+        WS_CONNECTIONS.inc(outcome="rejected_capacity")
+        logger.warning(f"[ws/{client_id}] Rejected: {admission.connections} connections open (max {MAX_CONNECTIONS})")
+        await websocket.close(code=CLOSE_TRY_AGAIN_LATER, reason="Server at capacity, try again later")
+        return
     try:
-        # --- Client Initialization (TEMPORARILY COMMENTED OUT) ---
-        api_key = os.getenv("GOOGLE_API_KEY")
-        logger.info(f"[ws/{client_id}] Checking API Key. Found: {bool(api_key)}") 
-        if not api_key:
+        # --- Client Initialization ---
+        if not session_pool: # Only created when GOOGLE_API_KEY is set (or the backend needs none)
             logger.error(f"[ws/{client_id}] Closing: Missing GOOGLE_API_KEY configuration")
+            WS_CONNECTIONS.inc(outcome="misconfigured")
             await websocket.close(code=1008, reason="Missing GOOGLE_API_KEY configuration")
             return
-        
-        # --- TEMPORARY: Skip Gemini Client Init --- 
-        logger.warning(f"[ws/{client_id}] TEMPORARY DEBUG: Skipping GeminiClient initialization.")
-        # try:
-        #     logger.info(f"[ws/{client_id}] Initializing GeminiClient...")
-        #     client = GeminiClient(api_key)
-        #     logger.info(f"[ws/{client_id}] Initializing Gemini Session...")
-        #     await client.initialize_session(DEFAULT_VOICE, DEFAULT_LANGUAGE)
-        #     logger.info(f"[ws/{client_id}] Gemini session initialized successfully.")
-        # except Exception as init_error:
-        #     logger.exception(f"[ws/{client_id}] Gemini initialization failed: {init_error}")
-        #     await websocket.close(code=1011, reason=f"Failed to initialize Gemini session: {init_error}")
-        #     return
-        # --- END TEMPORARY SKIP --- 
-
-        connections[client_id] = (websocket, client) # Store websocket, client will be None
+
+        # No Gemini session yet: one is leased from the pool for each turn that needs it
+        voice = VoiceConfig(DEFAULT_VOICE, DEFAULT_LANGUAGE)
+        WS_CONNECTIONS.inc(outcome="accepted")
+        connection = ConnectionEntry(websocket, None)
+        await connections.register(client_id, connection)
         last_activity[client_id] = asyncio.get_event_loop().time()
-        logger.info(f"Client {client_id} connected (NO GEMINI CLIENT). Active connections: {len(connections)}")
+        logger.info(f"Client {client_id} connected. Active connections: {len(connections)}")
 
-        # --- Audio Callback Setup (Will do nothing if client is None) ---
-        async def audio_callback(audio_data: bytes):
-             pass # No client to call
-        if client: client.set_audio_callback(audio_callback)
+        # --- Message Handling (runs as the pipeline's cancellable generation task) ---
+        async def handle_message(message_data: Dict[str, Any]):
+            nonlocal voice, audio_framer, active_recorder, conversation_started, keep_history
+            message_type = message_data.get("type")
+            logger.info(f"Received type '{message_type}' from {client_id}")
+            trace = current_trace()
+            taken_uploads: List[StreamingUpload] = []
+            processed_files: Optional[List[Dict[str, Any]]] = None
+            client: Optional[GeminiClient] = None # Leased for this turn only
+            leased = False
+            def for_message(reply: Dict[str, Any]) -> Dict[str, Any]: return ConnectionPipeline.for_message(reply, message_data) # Replies that end this message
+            try:
+                if message_type == "text_message":
+                    with trace.span("validate", model="TextMessage"): message = TextMessage.model_validate(message_data)
+                elif message_type == "multimodal_message":
+                    with trace.span("validate", model="MultimodalMessage"): message = MultimodalMessage.model_validate(message_data)
+                    processed_files = []
+                    missing = []
+                    for file_info in message.files:
+                        if file_info.sha256 is not None:
+                            # Only digests this client uploaded: "missing" must not tell another user's files from evicted ones
+                            stored = attachment_store.get(file_info.sha256) if file_info.sha256 in uploaded_digests else None
+                            if stored is None: missing.append(file_info.sha256); continue
+                            pin_attachment(stored.digest)
+                            processed_files.append({"mime_type": stored.mime_type, "data": None, "filename": file_info.filename or stored.filename, "sha256": stored.digest})
+                            continue
+                        if file_info.upload_id is not None:
+                            upload = uploads.take(file_info.upload_id)
+                            taken_uploads.append(upload)
+                            file_entry = {"mime_type": upload.mime_type or file_info.mime_type, "data": upload.buffer,
+                                          "filename": file_info.filename or upload.filename, "path": upload.path}
+                        else:
+                            with trace.span("decode_base64", chars=len(file_info.data)):
+                                file_entry = {"mime_type": file_info.mime_type, "data": base64.b64decode(file_info.data), "filename": file_info.filename}
+                        with trace.span("hash_file", bytes=memoryview(file_entry["data"]).nbytes):
+                            file_entry["sha256"] = await hash_file(file_entry["data"])
+                        uploaded_digests.add(file_entry["sha256"]) # Sent with its content, so the client may refer to it by hash from now on
+                        WS_UPLOAD_SIZE.observe(memoryview(file_entry["data"]).nbytes)
+                        processed_files.append(file_entry)
+                    if missing:
+                        # Client must re-send these files with their content
+                        for upload in taken_uploads: upload.close()
+                        await pipeline.send_json(for_message({"type": "attachment_missing", "sha256": missing})); return
+                elif message_type == "update_settings":
+                    logger.info(f"Settings update from {client_id}")
+                    # Takes effect on the next turn's lease; a session parked for the old voice is replaced then
+                    voice = VoiceConfig(*voice_key(message_data.get("voice", voice["name"]), message_data.get("language", voice["language"]),
+                                                   message_data.get("rate", voice["rate"]), message_data.get("pitch", voice["pitch"])))
+                    await pipeline.send_json(for_message({"type": "settings_ack"})); return
+                elif message_type == "hello":
+                    binary = PROTOCOL_NAME in (message_data.get("protocols") or [])
+                    audio_framer = AudioFramer() if binary else None
+                    logger.info(f"[ws/{client_id}] Protocol negotiated: {'binary' if binary else 'json'}")
+                    await pipeline.send_json({"type": "hello_ack", "protocols": [PROTOCOL_NAME] if binary else [],
+                                              "version": PROTOCOL_VERSION, "header_size": HEADER_SIZE, "max_upload_bytes": MAX_UPLOAD_BYTES,
+                                              "audio": audio_egress.format_info, "resume_token": resume_token})
+                    keep_history = bool(resume_token) # The client can now reconnect with ?resume=<token>
+                    return
+                else: logger.warning(f"Unknown type '{message_type}' from {client_id}"); await pipeline.send_json(for_message({"type": "error", "error": f"Unknown type: {message_type}"})); return
+            except (ValidationError, ValueError, base64.binascii.Error) as data_err:
+                for upload in taken_uploads: upload.close()
+                logger.error(f"Data/Validation error for {client_id}: {data_err}", exc_info=False)
+                await pipeline.send_json(for_message({"type": "error", "error": f"Invalid message format or data: {data_err}"}))
+                return
+
+            full_response_text = ""
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            server_ttft: Optional[float] = None
+            async def emit(response: Dict[str, Any]):
+                nonlocal full_response_text, server_ttft
+                await pipeline.send_json(response)
+                if response.get("type") == "text":
+                    full_response_text = response.get("content", full_response_text)
+                    if server_ttft is None:
+                        server_ttft = loop.time() - started
+                        WS_TTFT.observe(server_ttft)
 
-        # --- Main Receive Loop (Will error if trying to use client) ---
-        while True:
-            raw_data = None
+            response_stream = None
+            generating = False
             try:
-                raw_data = await asyncio.wait_for(websocket.receive_text(), timeout=WS_PING_INTERVAL * 1.5)
-                message_data = json.loads(raw_data)
-                message_type = message_data.get("type")
-                last_activity[client_id] = asyncio.get_event_loop().time()
-
-                if message_type == 'ping': await websocket.send_json({"type": "pong"}); continue
-                logger.info(f"Received type '{message_type}' from {client_id}")
-
-                # --- TEMPORARY: Send simple ack instead of processing --- 
-                logger.warning(f"[ws/{client_id}] TEMPORARY DEBUG: Received message, sending ack (no processing).")
-                await websocket.send_json({"type": "ack", "received_type": message_type})
-                # --- END TEMPORARY --- 
-
-                # --- Original Processing Logic (Commented Out) ---
-                # response_stream = None
-                # if message_type == "text_message":
-                #     message = TextMessage.model_validate(message_data)
-                #     if client: response_stream = client.send_message(message.text, role=message.role, enable_tts=message.enableTTS, files_data=None)
-                # elif message_type == "multimodal_message":
-                #     message = MultimodalMessage.model_validate(message_data)
-                #     processed_files = []
-                #     for file_info in message.files:
-                #         decoded_bytes = base64.b64decode(file_info.data)
-                #         processed_files.append({"mime_type": file_info.mime_type, "data": decoded_bytes, "filename": file_info.filename})
-                #     if client: response_stream = client.send_message(message.text, role=message.role, enable_tts=message.enableTTS, files_data=processed_files)
-                # elif message_type == "update_settings": logger.info(f"Settings update from {client_id}"); await websocket.send_json({"type": "settings_ack"}); continue
-                # else: logger.warning(f"Unknown type '{message_type}' from {client_id}"); await websocket.send_json({"type": "error", "error": f"Unknown type: {message_type}"}); continue
-                # 
-                # if response_stream:
-                #     full_response_text = ""
-                #     async for response in response_stream:
-                #         if websocket.client_state != WebSocketState.CONNECTED: break
-                #         await websocket.send_json(response)
-                #         if response.get("type") == "text": full_response_text = response.get("content", full_response_text)
-                #     if websocket.client_state == WebSocketState.CONNECTED: await websocket.send_json({"type": "complete", "text": full_response_text, "role": "assistant"})
-                # --- End Original Processing --- 
-
-            except asyncio.TimeoutError: logger.warning(f"Receive timeout for {client_id}. Closing."); break
-            except WebSocketDisconnect: logger.info(f"{client_id} disconnected gracefully."); break
-            except (json.JSONDecodeError, ValidationError, ValueError, base64.binascii.Error) as data_err:
-                logger.error(f"Data/Validation error for {client_id}: {data_err} - Data: {raw_data[:200] if raw_data else 'N/A'}...", exc_info=False)
-                try: await websocket.send_json({"type": "error", "error": f"Invalid message format or data: {data_err}"})
-                except Exception: pass
-            except Exception as loop_e:
-                logger.exception(f"Error processing message for {client_id}: {loop_e}")
-                try: await websocket.send_json({"type": "error", "error": "Internal server error"})
-                except Exception: pass
-                break 
+                if audio_framer: audio_framer.start_stream()
+                # Only first turns are cached: later answers depend on the conversation history
+                key, cached = None, None
+                if response_cache and not conversation_started:
+                    file_hashes = [f["sha256"] for f in processed_files or ()]
+                    key = cache_key(message.text, message.role, message.enableTTS, voice, file_hashes)
+                    with trace.span("cache_lookup") as span:
+                        cached = response_cache.get(key)
+                        span.set(hit=bool(cached))
+                    if cached:
+                        logger.info(f"[ws/{client_id}] Response cache hit ({len(cached.events)} events)")
+                        with trace.span("cache_replay", events=len(cached.events)):
+                            await replay(cached, emit, audio_callback, paced=RESPONSE_CACHE_REPLAY_PACED)
+                        if conversation:
+                            await record_exchange(conversation, message.role, message.text, full_response_text,
+                                                  [f.get("filename") or "file" for f in processed_files or ()])
+                        conversation_started = True # Later turns depend on this answer too
+                if not cached:
+                    if not admission.start_generation(client_id):
+                        logger.warning(f"[ws/{client_id}] Rejected generation: {admission.inflight} in flight (max {MAX_INFLIGHT_GENERATIONS})")
+                        await pipeline.send_json(for_message({"type": "error", "code": "overloaded", "error": "Server busy, please retry shortly"}))
+                        return
+                    generating = True
+                    try:
+                        with trace.span("session_lease"):
+                            client = await session_pool.acquire(*voice_key(voice.name, voice.language, voice.rate, voice.pitch), owner=session_owner)
+                    except SessionPoolExhausted as pool_error:
+                        logger.warning(f"[ws/{client_id}] {pool_error}")
+                        await pipeline.send_json(for_message({"type": "error", "code": "overloaded", "error": "Server busy, please retry shortly"}))
+                        return
+                    except UpstreamUnavailable as upstream_error:
+                        logger.warning(f"[ws/{client_id}] {upstream_error}")
+                        await pipeline.send_json(for_message({"type": "error", "code": "upstream_unavailable", "error": str(upstream_error),
+                                                              "retry_after": round(upstream_error.retry_after, 1)}))
+                        return
+                    except Exception as init_error:
+                        logger.exception(f"[ws/{client_id}] Gemini initialization failed: {init_error}")
+                        await pipeline.send_json(for_message({"type": "error", "error": f"Failed to initialize Gemini session: {init_error}"}))
+                        return
+                    leased = True
+                    client.set_audio_callback(audio_callback)
+                    connection.client = client
+                    response_stream = client.send_message(message.text, role=message.role, enable_tts=message.enableTTS, files_data=processed_files,
+                                                          conversation=conversation)
+                    conversation_started = True
+                    active_recorder = ResponseRecorder(RESPONSE_CACHE_MAX_ENTRY_BYTES, dumps=codec.dumps) if key else None
+                    async for response in response_stream:
+                        if response.get("type") == "complete": continue # Sent once below, with the full text
+                        if active_recorder: active_recorder.record_json(response)
+                        await emit(response)
+                    if active_recorder:
+                        recorded = active_recorder.finish()
+                        if recorded: response_cache.put(key, recorded)
+                    stored_digests = [f["sha256"] for f in processed_files or () if f["data"] is not None and pin_attachment(f["sha256"])]
+                    if stored_digests: await pipeline.send_json({"type": "attachment_stored", "sha256": stored_digests})
+                with trace.span("audio_drain"): await audio_egress.end_stream()
+                if audio_framer: await pipeline.send_bytes(audio_framer.end_stream())
+                # Server-side timings let clients split their end-to-end latency into upstream, relay and network
+                timing = {"server_ms": round((loop.time() - started) * 1000, 1), "cached": bool(cached)}
+                if server_ttft is not None: timing["server_ttft_ms"] = round(server_ttft * 1000, 1)
+                if not cached: timing.update(client.last_timing)
+                await pipeline.send_json(for_message({"type": "complete", "text": full_response_text, "role": "assistant", "timing": timing}))
+            except asyncio.CancelledError:
+                audio_egress.reset() # Interrupted: don't keep playing the abandoned answer
+                raise
+            finally:
+                if generating: admission.finish_generation(client_id)
+                active_recorder = None
+                if response_stream: await response_stream.aclose() # Drops the generator's references to upload buffers
+                if leased:
+                    connection.client = None
+                    await release_client(client, owner=session_owner)
+                processed_files = None
+                for upload in taken_uploads: upload.close()
+
+        active_recorder: Optional[ResponseRecorder] = None # Captures the in-flight response for the cache
+        pinned_attachments: Set[str] = set() # Digests this connection can reference; released on disconnect
+
+        def pin_attachment(digest: str) -> bool:
+            if digest in pinned_attachments: return True
+            if not attachment_store.acquire(digest): return False
+            pinned_attachments.add(digest)
+            return True
+        # History outlives the connection only for clients given the resume token: a client id alone doesn't resume it
+        conversation = None
+        if conversations:
+            resume_token = websocket.query_params.get("resume")
+            conversation = conversations.find(resume_token) if resume_token else None
+            keep_history = conversation is not None
+            if conversation is None: resume_token, conversation = conversations.open()
+        uploaded_digests: Set[str] = conversation.attachments if conversation else set() # What this client may reference by hash
+        conversation_started = bool(conversation and (conversation.turns or conversation.summary))
+
+        # --- Streaming Uploads (binary FILE_CHUNK frames), handled inline on the reader task ---
+        uploads = UploadManager(MAX_UPLOAD_BYTES, MAX_PENDING_UPLOADS, UPLOAD_SPILL_THRESHOLD, upload_ram_budget, UPLOAD_SPOOL_DIR)
+        audio_framer: Optional[AudioFramer] = None # Set once the client negotiates binary-v1
+
+        async def handle_binary(data: bytes) -> Optional[Dict[str, Any]]:
+            upload = await uploads.add(decode_frame(data))
+            if upload is None: return None
+            return {"type": "upload_complete", "upload_id": upload.upload_id, "mime_type": upload.mime_type, "size": upload.size}
+
+        def handle_upload_start(message_data: Dict[str, Any]) -> Dict[str, Any]:
+            try: start = UploadStart.model_validate(message_data)
+            except ValidationError as e: raise ValueError(f"Invalid upload_start: {e}")
+            uploads.start(start.upload_id, start.mime_type, start.filename, start.size)
+            return {"type": "upload_ready", "upload_id": start.upload_id}
+
+        def handle_upload_cancel(message_data: Dict[str, Any]) -> Dict[str, Any]:
+            uploads.discard(message_data.get("upload_id"))
+            return {"type": "upload_cancelled", "upload_id": message_data.get("upload_id")}
+
+        def touch():
+            last_activity[client_id] = asyncio.get_event_loop().time()
+
+        def admit(message_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+            rejection = admission.check_rate(client_id)
+            if rejection and admission.should_disconnect(client_id):
+                logger.warning(f"[ws/{client_id}] Closing: rate limit exceeded repeatedly")
+                pipeline.stop(CLOSE_POLICY_VIOLATION, "Rate limit exceeded")
+            return rejection
+
+        memory_account = memory_budget.account(client_id)
+        recording = session_recorder.session(client_id, websocket.url.path, websocket.url.query, version=API_VERSION) if session_recorder else None
+        pipeline = ConnectionPipeline(
+            websocket, client_id, handle_message,
+            receive_timeout=None if idle_reaper else WS_IDLE_TIMEOUT, # The reaper replaces a timer per receive
+            send_queue_size=WS_SEND_QUEUE_SIZE,
+            recv_queue_size=WS_RECV_QUEUE_SIZE,
+            send_timeout=WS_SEND_TIMEOUT,
+            on_activity=touch,
+            on_binary=handle_binary,
+            inline_handlers={"upload_start": handle_upload_start, "upload_cancel": handle_upload_cancel},
+            admit=admit,
+            tracer=tracer,
+            codec=codec,
+            memory=memory_account,
+            recording=recording,
+        )
+
+        async def deliver(message: Dict[str, Any]):
+            pipeline.send_control(message)
+        connection.deliver = deliver
+        connection.close = pipeline.stop
+        connection.pipeline = pipeline
+        if idle_reaper: idle_reaper.track(client_id)
+
+        # --- Audio Egress (jitter buffer + optional transcoding on its own task, so text never waits on audio) ---
+        async def send_audio(audio_data: bytes):
+            await pipeline.send_bytes(audio_framer.frame(audio_data) if audio_framer else audio_data)
+
+        audio_egress = AudioEgress(send_audio, AUDIO_OUTPUT_FORMAT, sample_rate=AUDIO_SAMPLE_RATE,
+                                   frame_ms=AUDIO_FRAME_MS, max_buffer_ms=AUDIO_BUFFER_MS)
+
+        async def audio_callback(audio_data: bytes):
+            if active_recorder: active_recorder.record_audio(audio_data)
+            audio_egress.submit(audio_data)
+
+        audio_egress.start()
+        try:
+            await pipeline.run()
+        finally:
+            await audio_egress.close()
+            uploads.clear()
+            memory_account.close()
+            for digest in pinned_attachments: attachment_store.release(digest)
+            if recording: recording.close(pipeline.close_code, pipeline.close_reason)
+        close_code, close_reason = pipeline.close_code, pipeline.close_reason
+        WS_CLOSES.inc(code=str(close_code))
 
     except Exception as handler_e: 
         logger.exception(f"Unhandled exception in WebSocket handler setup for {client_id}: {handler_e}")
     finally:
-        # --- Cleanup (Remains the same) ---
+        # --- Cleanup ---
         logger.info(f"Cleaning up connection for client {client_id}")
-        if client_id in connections:
-            ws, client_instance = connections.pop(client_id)
-            if client_instance: await client_instance.close()
-            if ws.client_state != WebSocketState.DISCONNECTED: 
-                try: await ws.close(code=1000)
-                except Exception: pass
-        if client_id in last_activity: del last_activity[client_id]
+        entry = connections.get(client_id)
+        owns_entry = entry is not None and entry.websocket is websocket # A reconnect may already own this client id
+        if owns_entry:
+            await connections.unregister(client_id)
+            if client_id in last_activity: del last_activity[client_id]
+            if idle_reaper: idle_reaper.forget(client_id)
+        admission.release_connection(client_id, forget_client=owns_entry)
+        if session_pool: await session_pool.forget(session_owner) # The turn's lease itself was released when the pipeline ended
+        if conversations and resume_token and not keep_history: conversations.discard(resume_token)
+        if websocket.client_state != WebSocketState.DISCONNECTED: 
+            try: await websocket.close(code=close_code, reason=close_reason)
+            except Exception: pass
         logger.info(f"Finished cleanup for {client_id}. Active connections: {len(connections)}")
 
 # --- Run Server --- 
 if __name__ == "__main__":
     import uvicorn
     logger.info(f"Starting Uvicorn server on {HOST}:{PORT}")
-    uvicorn.run("main:app", host=HOST, port=PORT, log_level=LOG_LEVEL.lower(), reload=False)
+    if WORKERS > 1 and REGISTRY_BACKEND == "memory":
+        logger.warning("WORKERS > 1 with REGISTRY_BACKEND=memory: connection counts and routing are per worker")
+    uvicorn.run("main:app", host=HOST, port=PORT, log_level=LOG_LEVEL.lower(), reload=False, workers=WORKERS,
+                ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE)
@@ -0,0 +1,132 @@
+# backend/gemini_service/memory.py
+import gc
+import heapq
+import logging
+import sys
+import tracemalloc
+from array import array
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+class RingBuffer:
+    """Fixed-capacity numeric samples in a typed array: the newest `capacity` values are kept,
+    older ones overwritten, so memory stays at capacity * itemsize however long it runs"""
+
+    __slots__ = ("_data", "_capacity", "_next", "total")
+
+    def __init__(self, capacity: int, typecode: str = "d"):
+        self._data = array(typecode)
+        self._capacity = capacity
+        self._next = 0 # Slot the next value goes into once full
+        self.total = 0 # Values ever appended
+
+    def append(self, value: float):
+        if len(self._data) < self._capacity: self._data.append(value)
+        else: self._data[self._next] = value
+        self._next = (self._next + 1) % self._capacity
+        self.total += 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __iter__(self) -> Iterator[float]:
+        """Oldest to newest"""
+        if len(self._data) < self._capacity: return iter(self._data)
+        return iter(self._data[self._next:] + self._data[:self._next])
+
+    def __bool__(self) -> bool:
+        return bool(self._data)
+
+    @property
+    def nbytes(self) -> int:
+        return self._data.itemsize * self._capacity
+
+class MemoryAccount:
+    """Bytes one connection holds in buffers (queued outbound frames), charged against its own
+    limit and the shared MemoryBudget. Released as the buffers drain, and all at once on close()."""
+
+    __slots__ = ("budget", "name", "in_use", "peak")
+
+    def __init__(self, budget: "MemoryBudget", name: str):
+        self.budget = budget
+        self.name = name
+        self.in_use = 0
+        self.peak = 0
+
+    def try_charge(self, nbytes: int) -> bool:
+        """Charge unless it would exceed this account's or the worker's limit. An empty account may
+        always take one item, so a single frame larger than the limit can still be sent."""
+        budget = self.budget
+        if self.in_use and (self.in_use + nbytes > budget.per_account_bytes or budget.in_use + nbytes > budget.limit_bytes):
+            budget.counters["denied"] += 1
+            return False
+        self.charge(nbytes)
+        return True
+
+    def charge(self, nbytes: int):
+        """Charge without checking limits (small control frames that must not block)"""
+        self.in_use += nbytes
+        if self.in_use > self.peak: self.peak = self.in_use
+        self.budget._charged(nbytes)
+
+    def release(self, nbytes: int):
+        nbytes = min(nbytes, self.in_use)
+        self.in_use -= nbytes
+        self.budget.in_use -= nbytes
+
+    def close(self):
+        self.release(self.in_use)
+        if self.budget._accounts.get(self.name) is self: del self.budget._accounts[self.name]
+
+class MemoryBudget:
+    """Worker-wide cap on connection buffer bytes, split into per-connection accounts"""
+
+    def __init__(self, limit_bytes: int, per_account_bytes: int):
+        self.limit_bytes = limit_bytes
+        self.per_account_bytes = per_account_bytes
+        self.in_use = 0
+        self.peak = 0
+        self._accounts: Dict[str, MemoryAccount] = {}
+        self.counters = {"denied": 0}
+
+    def account(self, name: str) -> MemoryAccount:
+        """A new account; one opened under a name still in use (a reconnect) replaces it in the report"""
+        account = self._accounts[name] = MemoryAccount(self, name)
+        return account
+
+    def _charged(self, nbytes: int):
+        self.in_use += nbytes
+        if self.in_use > self.peak: self.peak = self.in_use
+
+    def top(self, n: int = 10) -> List[Dict[str, Any]]:
+        """Accounts holding the most bytes"""
+        largest = heapq.nlargest(n, self._accounts.values(), key=lambda account: account.in_use)
+        return [{"name": a.name, "in_use": a.in_use, "peak": a.peak} for a in largest]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"limit_bytes": self.limit_bytes, "per_account_bytes": self.per_account_bytes, "in_use": self.in_use,
+                "peak": self.peak, "accounts": len(self._accounts), **self.counters}
+
+def process_memory() -> Dict[str, Any]:
+    """Resident set size (current and peak) of this process, from /proc where available"""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            fields = dict(line.split(":", 1) for line in f if line.startswith(("VmRSS", "VmHWM")))
+        return {"rss_bytes": int(fields["VmRSS"].split()[0]) * 1024, "peak_rss_bytes": int(fields["VmHWM"].split()[0]) * 1024}
+    except (OSError, KeyError, ValueError):
+        import resource # Not on Windows, where /proc is missing too
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {"rss_bytes": None, "peak_rss_bytes": peak if sys.platform == "darwin" else peak * 1024}
+
+def allocation_report(limit: int = 15) -> Optional[Dict[str, Any]]:
+    """Python heap totals and the largest allocation sites; None unless tracemalloc is tracing"""
+    if not tracemalloc.is_tracing(): return None
+    current, peak = tracemalloc.get_traced_memory()
+    stats = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics("lineno")
+    return {"traced_bytes": current, "traced_peak_bytes": peak,
+            "top": [{"site": str(stat.traceback[0]), "bytes": stat.size, "blocks": stat.count} for stat in stats[:limit]]}
+
+def gc_report() -> Dict[str, Any]:
+    return {"objects": len(gc.get_objects()), "counts": list(gc.get_count()),
+            "collections": [generation["collections"] for generation in gc.get_stats()]}
@@ -0,0 +1,197 @@
+# backend/gemini_service/metrics.py
+import bisect
+import math
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Minimal Prometheus text-format (0.0.4) metrics. Everything is updated from the event loop
+# thread, so plain ints/floats need no locks; histograms use fixed buckets (one bisect per
+# observation) and are only made cumulative when scraped.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+LabelValues = Tuple[str, ...]
+
+# Client-supplied message types are mapped onto this set so label cardinality stays bounded
+MESSAGE_TYPES = frozenset({"text_message", "multimodal_message", "update_settings", "hello"})
+
+def message_type_label(message_type: object) -> str:
+    return message_type if message_type in MESSAGE_TYPES else "other"
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra: pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if math.isinf(value): return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer(): return str(int(value))
+    return repr(float(value))
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    @abstractmethod
+    def render(self) -> List[str]:
+        """Exposition lines for this metric, header included"""
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelValues, float] = {} if labelnames else {(): 0}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in self._values.items()]
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelValues, float] = {} if labelnames else {(): 0}
+
+    def set(self, value: float, **labels: str): self._values[self._key(labels)] = value
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+    def dec(self, amount: float = 1, **labels: str): self.inc(-amount, **labels)
+
+    def render(self):
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in self._values.items()]
+
+class GaugeFunc(Metric):
+    """Gauge computed at scrape time (queue depths, pool sizes): no cost on the hot path"""
+    kind = "gauge"
+
+    def __init__(self, name, help, func: Callable[[], float]):
+        super().__init__(name, help)
+        self.func = func
+
+    def render(self):
+        try: value = self.func()
+        except Exception: return [] # A broken source must not fail the whole scrape
+        if value is None: return []
+        return self.header() + [f"{self.name} {_format_value(value)}"]
+
+class StatsGauges(Metric):
+    """Exports the numeric fields of a component's stats() dict as `<prefix>_<field>` gauges"""
+
+    def __init__(self, prefix: str, help: str, func: Callable[[], Optional[Dict[str, object]]]):
+        super().__init__(prefix, help)
+        self.func = func
+
+    def render(self):
+        try: stats = self.func()
+        except Exception: return []
+        lines = []
+        for field, value in (stats or {}).items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)): continue
+            name = f"{self.name}_{field}"
+            lines += [f"# HELP {name} {self.help} ({field})", f"# TYPE {name} gauge", f"{name} {_format_value(value)}"]
+        return lines
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [per-bucket counts (+Inf last), sum]
+        self._series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    def count(self, **labels: str) -> int:
+        series = self._series.get(self._key(labels))
+        return sum(series[0]) if series else 0
+
+    def render(self):
+        lines = self.header()
+        for key, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="%s"' % _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric. Registering an identical (type, name, help) again replaces the earlier one,
+        since `python main.py` runs main's module-level registrations twice; any other clash is an error."""
+        existing = self._metrics.get(metric.name)
+        if existing is not None and (type(existing), existing.help) != (type(metric), metric.help):
+            raise ValueError(f"Metric '{metric.name}' already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()) -> Counter: return self.register(Counter(name, help, labelnames))
+    def gauge(self, name, help, labelnames=()) -> Gauge: return self.register(Gauge(name, help, labelnames))
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram: return self.register(Histogram(name, help, labelnames, buckets))
+    def gauge_func(self, name, help, func) -> GaugeFunc: return self.register(GaugeFunc(name, help, func))
+    def stats_gauges(self, prefix, help, func) -> StatsGauges: return self.register(StatsGauges(prefix, help, func))
+
+    def unregister(self, name: str): self._metrics.pop(name, None)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values(): lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+# --- Service metrics (shared by main.py, connection_pipeline.py and gemini_client.py) ---
+WS_CONNECTIONS = REGISTRY.counter("gemini_ws_connections_total", "WebSocket connection attempts by outcome", ["outcome"])
+WS_CLOSES = REGISTRY.counter("gemini_ws_closes_total", "WebSocket connections closed, by close code", ["code"])
+WS_MESSAGES = REGISTRY.counter("gemini_ws_messages_total", "Client messages handled, by type", ["type"])
+WS_REJECTED = REGISTRY.counter("gemini_ws_rejected_messages_total", "Client messages refused before processing, by reason", ["reason"])
+WS_BYTES_RECEIVED = REGISTRY.counter("gemini_ws_received_bytes_total", "Bytes received from clients, by frame kind", ["kind"])
+WS_BYTES_SENT = REGISTRY.counter("gemini_ws_sent_bytes_total", "Bytes sent to clients, by frame kind", ["kind"])
+WS_MESSAGE_LATENCY = REGISTRY.histogram("gemini_ws_message_duration_seconds", "Time from dequeuing a client message to its last reply, by type", ["type"])
+WS_TTFT = REGISTRY.histogram("gemini_ws_time_to_first_token_seconds", "Time from dequeuing a chat message to its first text chunk being queued")
+WS_UPLOAD_SIZE = REGISTRY.histogram("gemini_ws_upload_size_bytes", "Size of files attached to messages", buckets=BYTES_BUCKETS)
+
+UPSTREAM_REQUESTS = REGISTRY.counter("gemini_upstream_requests_total", "Streaming requests sent to Gemini")
+UPSTREAM_ERRORS = REGISTRY.counter("gemini_upstream_errors_total", "Failed Gemini requests, by stage", ["stage"])
+UPSTREAM_TTFT = REGISTRY.histogram("gemini_upstream_time_to_first_chunk_seconds", "Time from sending a request to Gemini's first streamed chunk")
+UPSTREAM_LATENCY = REGISTRY.histogram("gemini_upstream_stream_duration_seconds", "Time from sending a request to the end of Gemini's stream")
+UPSTREAM_CHUNKS = REGISTRY.counter("gemini_upstream_chunks_total", "Streamed chunks received from Gemini, by kind", ["kind"])
+UPSTREAM_AUDIO_BYTES = REGISTRY.counter("gemini_upstream_audio_bytes_total", "Audio bytes received from Gemini")
@@ -0,0 +1,125 @@
+# backend/gemini_service/resilience.py
+import logging
+import random
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class UpstreamUnavailable(RuntimeError):
+    """Raised without calling upstream while the circuit breaker is open"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Gemini is unavailable, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class RetryBudget:
+    """Caps retries (and hedges) to a fraction of recent requests, so retrying can't multiply load
+    during an incident. Each request deposits `ratio` tokens; each retry spends one. A trickle of
+    `min_per_second` keeps low-traffic workers able to retry at all."""
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 1.0, max_tokens: float = 50.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self.updated) * self.min_per_second)
+        self.updated = now
+
+    def deposit(self):
+        self._refill()
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        self._refill()
+        if self.tokens < 1: return False
+        self.tokens -= 1
+        return True
+
+class CircuitBreaker:
+    """closed -> open after `failure_threshold` consecutive failures; open rejects calls for
+    `reset_timeout` seconds, then half_open lets one probe through: success closes, failure reopens.
+    A probe that never reports back (e.g. an interrupted message) is replaced after `reset_timeout`."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started = None # Set while a half_open probe is in flight
+        self.counters = {"opened": 0, "rejected": 0}
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == "closed": return True
+        if self.state == "open" and self.retry_after() == 0:
+            self.state, self.probe_started = "half_open", None
+        if self.state == "half_open" and (self.probe_started is None or time.monotonic() - self.probe_started > self.reset_timeout):
+            self.probe_started = time.monotonic()
+            return True
+        self.counters["rejected"] += 1
+        return False
+
+    def check(self):
+        """allow(), raising UpstreamUnavailable instead of returning False"""
+        if not self.allow(): raise UpstreamUnavailable(self.retry_after() or self.reset_timeout)
+
+    def record_success(self):
+        if self.state != "closed": logger.info("Upstream circuit closed")
+        self.state, self.failures, self.probe_started = "closed", 0, None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            if self.state == "closed": logger.warning(f"Upstream circuit opened after {self.failures} consecutive failures")
+            self.state, self.opened_at, self.probe_started = "open", time.monotonic(), None
+            self.counters["opened"] += 1
+
+class UpstreamResilience:
+    """Retry, hedging and circuit-breaking policy shared by every GeminiClient of a worker"""
+
+    def __init__(self,
+                 max_attempts: int = 3,
+                 backoff_base: float = 0.2,
+                 backoff_max: float = 2.0,
+                 retry_budget: Optional[RetryBudget] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 hedge_delay: Optional[float] = None):
+        self.max_attempts = max_attempts # Per connect or per message, including the first try
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_budget = retry_budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge_delay = hedge_delay # Seconds without a first chunk before a hedged request; None disables
+        self.counters = {"attempts": 0, "retries": 0, "retries_denied": 0, "reconnects": 0, "hedges": 0, "hedge_wins": 0}
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff before retry number `attempt` (1-based)"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def start_attempt(self, first: bool):
+        """Count an upstream call (checking the breaker first); retries must also fit the budget"""
+        self.breaker.check()
+        self.counters["attempts"] += 1
+        if first: self.retry_budget.deposit()
+
+    def can_retry(self, attempt: int) -> bool:
+        if attempt >= self.max_attempts: return False
+        if not self.retry_budget.try_spend():
+            self.counters["retries_denied"] += 1
+            return False
+        self.counters["retries"] += 1
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {"breaker_state": self.breaker.state, "breaker_open": int(self.breaker.state != "closed"),
+                "consecutive_failures": self.breaker.failures, "breaker_opened": self.breaker.counters["opened"],
+                "breaker_rejected": self.breaker.counters["rejected"], "retry_tokens": round(self.retry_budget.tokens, 2),
+                **self.counters}
@@ -0,0 +1,139 @@
+# backend/gemini_service/response_cache.py
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Recorded stream event: (seconds since the request was sent, "json" | "audio", payload)
+CacheEvent = Tuple[float, str, Any]
+
+def normalize_text(text: Optional[str]) -> str:
+    """Collapse whitespace and case so trivially different prompts share an entry"""
+    return " ".join((text or "").split()).casefold()
+
+def content_hash(data: Any) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def cache_key(text: Optional[str], role: str, enable_tts: bool, voice_config: Dict[str, Any], file_hashes: Sequence[str] = ()) -> str:
+    """Stable key over everything that changes the upstream answer"""
+    material = json.dumps({
+        "text": normalize_text(text),
+        "role": role,
+        "tts": bool(enable_tts),
+        "voice": [voice_config.get("name"), voice_config.get("language"), voice_config.get("rate"), voice_config.get("pitch")],
+        "files": list(file_hashes),
+    }, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+class CachedResponse:
+    def __init__(self, events: List[CacheEvent], created_at: float, size_bytes: Optional[int] = None):
+        self.events = events
+        self.created_at = created_at
+        self.size_bytes = size_bytes if size_bytes is not None else sum(len(p) if kind == "audio" else len(json.dumps(p)) for _, kind, p in events)
+
+class ResponseRecorder:
+    """Captures one streamed response (JSON chunks and raw audio) with relative timing"""
+
+    def __init__(self, max_bytes: int, dumps: Callable[[Any], Any] = json.dumps):
+        self.max_bytes = max_bytes
+        self.dumps = dumps # Only used to size JSON chunks; pass the connection codec's encoder
+        self.started = time.monotonic()
+        self.events: List[CacheEvent] = []
+        self.size_bytes = 0
+        self.cacheable = True
+
+    def record_json(self, response: Dict[str, Any]):
+        if response.get("type") in ("error", "warning"):
+            self.cacheable = False # Never replay failures or skipped-file warnings
+        self._add("json", response, len(self.dumps(response)))
+
+    def record_audio(self, audio: Any):
+        self._add("audio", bytes(audio), len(audio))
+
+    def _add(self, kind: str, payload: Any, size: int):
+        if not self.cacheable: return
+        self.size_bytes += size
+        if self.size_bytes > self.max_bytes:
+            self.cacheable = False; self.events.clear(); return
+        self.events.append((time.monotonic() - self.started, kind, payload))
+
+    def finish(self) -> Optional[CachedResponse]:
+        if not self.cacheable or not self.events:
+            return None
+        return CachedResponse(self.events, time.time(), self.size_bytes)
+
+class ResponseCache(ABC):
+    """Interface for response caches; InMemoryResponseCache is the default backend"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[CachedResponse]: ...
+    @abstractmethod
+    def put(self, key: str, response: CachedResponse): ...
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]: ...
+
+class InMemoryResponseCache(ResponseCache):
+    """LRU cache with per-entry TTL and bounds on entry count and total bytes"""
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 3600.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._bytes = 0
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expirations": 0, "rejected": 0}
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+        if time.time() - entry.created_at > self.ttl_seconds:
+            self._remove(key)
+            self.counters["expirations"] += 1; self.counters["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.counters["hits"] += 1
+        return entry
+
+    def put(self, key: str, response: CachedResponse):
+        if response.size_bytes > self.max_bytes:
+            self.counters["rejected"] += 1
+            return
+        if key in self._entries: self._remove(key)
+        self._entries[key] = response
+        self._bytes += response.size_bytes
+        self.counters["stores"] += 1
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.counters["evictions"] += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size_bytes
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                "hit_ratio": self.counters["hits"] / lookups if lookups else 0.0, **self.counters}
+
+async def replay(response: CachedResponse,
+                 send_json: Callable[[Dict[str, Any]], Awaitable[None]],
+                 send_audio: Callable[[bytes], Awaitable[None]],
+                 paced: bool = False):
+    """Re-send a cached response, either as fast as possible or with its original timing"""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    for offset, kind, payload in response.events:
+        if paced:
+            delay = started + offset - loop.time()
+            if delay > 0: await asyncio.sleep(delay)
+        if kind == "audio": await send_audio(payload)
+        else: await send_json(payload)
@@ -0,0 +1,329 @@
+# backend/gemini_service/session_pool.py
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional, Tuple, AsyncIterator
+
+from gemini_client import GeminiClient
+
+logger = logging.getLogger(__name__)
+
+# (voice name, language, rate, pitch) - sessions are only interchangeable within one key
+VoiceKey = Tuple[str, str, float, float]
+
+def voice_key(voice_name: str = "Charon", language: str = "en-US", rate: float = 1.0, pitch: float = 0.0) -> VoiceKey:
+    """Build the pool key for a voice config, clamped the same way GeminiClient clamps it"""
+    return (voice_name, language, max(0.25, min(4.0, float(rate))), max(-20.0, min(20.0, float(pitch))))
+
+class SessionPoolExhausted(RuntimeError):
+    """Raised when no session could be leased within the acquire timeout"""
+
+class PooledSession:
+    def __init__(self, client: GeminiClient, key: VoiceKey, now: float):
+        self.client = client
+        self.key = key
+        self.created_at = now
+        self.last_used = now
+        self.leases = 0
+
+class SessionPool:
+    """Keeps pre-warmed GeminiClient live sessions and leases them out per voice config, one turn
+    at a time, so the number of sockets a worker can hold is not bounded by `max_size`.
+
+    `max_size` caps the number of upstream sessions (idle + parked + leased + being created);
+    idle sessions above `min_size` are closed after `idle_timeout` seconds. A live session
+    carries its conversation, so only sessions that never sent a turn go back to the shared
+    pool. One that did is parked for the `owner` it was leased to and reused by that owner's
+    next turn; parked sessions are the first to go when the pool needs room.
+    """
+
+    def __init__(self,
+                 client_factory: Callable[[], GeminiClient],
+                 default_key: VoiceKey,
+                 min_size: int = 1,
+                 max_size: int = 20,
+                 idle_timeout: float = 300.0,
+                 health_check_interval: float = 30.0,
+                 acquire_timeout: float = 10.0):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError(f"Invalid pool bounds: min_size={min_size}, max_size={max_size}")
+        self.client_factory = client_factory
+        self.default_key = default_key
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+
+        self._idle: Dict[VoiceKey, List[PooledSession]] = {}
+        self._leased: Dict[int, PooledSession] = {} # id(client) -> entry
+        self._parked: Dict[str, PooledSession] = {} # owner -> its used session, idle between turns
+        self._size = 0 # idle + parked + leased + in-flight creations
+        self._cond = asyncio.Condition()
+        self._maintenance_task: Optional[asyncio.Task] = None
+        self._refill_task: Optional[asyncio.Task] = None
+        self._closed = False
+        self.stats_counters = {"created": 0, "reused": 0, "evicted": 0, "unhealthy": 0, "create_failures": 0, "exhausted": 0,
+                              "parked_reused": 0, "probe_failures": 0}
+
+    # --- Lifecycle ---
+    async def start(self):
+        """Pre-warm `min_size` sessions for the default voice and start the maintenance loop"""
+        logger.info(f"Starting session pool (min={self.min_size}, max={self.max_size}, default voice={self.default_key})")
+        await self._fill_to_min()
+        self._maintenance_task = asyncio.create_task(self._maintenance_loop(), name="session-pool-maintenance")
+
+    async def close(self):
+        self._closed = True
+        if self._maintenance_task:
+            self._maintenance_task.cancel()
+            try: await self._maintenance_task
+            except asyncio.CancelledError: pass
+            self._maintenance_task = None
+        if self._refill_task:
+            self._refill_task.cancel()
+            self._refill_task = None
+        async with self._cond:
+            entries = [e for bucket in self._idle.values() for e in bucket] + list(self._parked.values()) + list(self._leased.values())
+            self._idle.clear(); self._parked.clear(); self._leased.clear(); self._size = 0
+            self._cond.notify_all()
+        logger.info(f"Closing {len(entries)} pooled Gemini sessions...")
+        await asyncio.gather(*(e.client.close() for e in entries), return_exceptions=True)
+
+    # --- Lease / Return ---
+    async def acquire(self, voice_name: str, language: str, rate: float = 1.0, pitch: float = 0.0, owner: Optional[str] = None) -> GeminiClient:
+        """Lease a live session for the given voice config: the one parked for `owner`, a pooled one,
+        or a new one if the pool has room"""
+        key = voice_key(voice_name, language, rate, pitch)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.acquire_timeout
+        while True:
+            victim: Optional[PooledSession] = None
+            async with self._cond:
+                if self._closed:
+                    raise RuntimeError("Session pool is closed")
+                entry = self._pop_parked(owner, key) if owner else None
+                if entry:
+                    entry.leases += 1
+                    self._leased[id(entry.client)] = entry
+                    self.stats_counters["parked_reused"] += 1
+                    return entry.client
+                entry = self._pop_idle(key)
+                if entry:
+                    entry.leases += 1
+                    entry.last_used = loop.time()
+                    self._leased[id(entry.client)] = entry
+                    self.stats_counters["reused"] += 1
+                    if key == self.default_key: self._schedule_refill()
+                    return entry.client
+                if self._size >= self.max_size:
+                    # Full: make room by dropping the least recently used parked session or idle one held for a different voice
+                    victim = self._pop_oldest_idle()
+                    if victim is None:
+                        remaining = deadline - loop.time()
+                        if remaining <= 0:
+                            self.stats_counters["exhausted"] += 1
+                            raise SessionPoolExhausted(f"No Gemini session available within {self.acquire_timeout}s (max_size={self.max_size})")
+                        try: await asyncio.wait_for(self._cond.wait(), timeout=remaining)
+                        except asyncio.TimeoutError: pass
+                        continue
+                    self._size -= 1
+                    self.stats_counters["evicted"] += 1
+                self._size += 1 # reserve a slot for the session created below
+            if victim:
+                asyncio.ensure_future(victim.client.close()) # Not awaited: a cancelled caller must not strand the reserved slot
+            entry = await self._create(key)
+            entry.leases += 1 # No await between creation and registration, so the session can't be lost
+            self._leased[id(entry.client)] = entry
+            return entry.client
+
+    async def release(self, client: GeminiClient, discard: bool = False, owner: Optional[str] = None):
+        """Return a leased session. One that sent a turn is parked for `owner` (or closed without one);
+        unhealthy or discarded sessions are closed instead of pooled."""
+        to_close: List[GeminiClient] = []
+        async with self._cond:
+            entry = self._leased.pop(id(client), None)
+            if entry is None:
+                if not self._closed: # close() already closed every session it held
+                    logger.warning("Released a client that is not leased from this pool. Closing it.")
+                    to_close.append(client)
+            elif discard or self._closed or not client.is_healthy() or (client.has_history and not owner):
+                self._size -= 1
+                if not discard and not client.has_history: self.stats_counters["unhealthy"] += 1
+                to_close.append(client)
+            else:
+                client.set_audio_callback(None)
+                entry.last_used = asyncio.get_running_loop().time()
+                if client.has_history:
+                    previous = self._parked.pop(owner, None)
+                    if previous is not None:
+                        self._size -= 1
+                        to_close.append(previous.client)
+                    self._parked[owner] = entry
+                else:
+                    self._idle.setdefault(entry.key, []).append(entry)
+            self._cond.notify()
+        if to_close:
+            await asyncio.gather(*(c.close() for c in to_close), return_exceptions=True)
+            self._schedule_refill()
+
+    async def forget(self, owner: str):
+        """Close the session parked for `owner` (e.g. its connection ended)"""
+        async with self._cond:
+            entry = self._parked.pop(owner, None)
+            if entry is None: return
+            self._size -= 1
+            self._cond.notify()
+        await entry.client.close()
+
+    @asynccontextmanager
+    async def lease(self, voice_name: str, language: str, rate: float = 1.0, pitch: float = 0.0) -> AsyncIterator[GeminiClient]:
+        client = await self.acquire(voice_name, language, rate, pitch)
+        try:
+            yield client
+        except BaseException:
+            await self.release(client, discard=True)
+            raise
+        else:
+            await self.release(client)
+
+    # --- Internals ---
+    async def _create(self, key: VoiceKey) -> PooledSession:
+        """Create and initialize a session for a slot already reserved in `_size`; the slot is given back
+        if that fails or the caller is cancelled meanwhile"""
+        client = None
+        try:
+            client = self.client_factory()
+            await client.initialize_session(*key)
+        except BaseException as e:
+            if not isinstance(e, asyncio.CancelledError): self.stats_counters["create_failures"] += 1
+            self._size -= 1 # Synchronously: acquiring the lock could itself be cancelled
+            asyncio.ensure_future(self._notify()) # Wakes acquirers waiting for room
+            if client is not None and client.session is not None: asyncio.ensure_future(client.close())
+            raise
+        self.stats_counters["created"] += 1
+        return PooledSession(client, key, asyncio.get_running_loop().time())
+
+    async def _notify(self):
+        async with self._cond: self._cond.notify_all()
+
+    def _pop_parked(self, owner: str, key: VoiceKey) -> Optional[PooledSession]:
+        """The owner's parked session if it still fits the voice config; otherwise it is closed"""
+        entry = self._parked.pop(owner, None)
+        if entry is None: return None
+        if entry.key == key and entry.client.is_healthy(): return entry
+        self._size -= 1
+        asyncio.ensure_future(entry.client.close())
+        return None
+
+    def _pop_idle(self, key: VoiceKey) -> Optional[PooledSession]:
+        bucket = self._idle.get(key)
+        while bucket:
+            entry = bucket.pop() # LIFO keeps the most recently used sessions warm
+            if entry.client.is_healthy():
+                return entry
+            self._size -= 1
+            self.stats_counters["unhealthy"] += 1
+            asyncio.ensure_future(entry.client.close())
+        return None
+
+    def _pop_oldest_idle(self) -> Optional[PooledSession]:
+        """Least recently used parked session, or idle session of another voice (the caller found none for its own)"""
+        oldest: Optional[PooledSession] = None
+        for bucket in self._idle.values():
+            if bucket and (oldest is None or bucket[0].last_used < oldest.last_used):
+                oldest = bucket[0]
+        parked_owner = None
+        for owner, entry in self._parked.items():
+            if oldest is None or entry.last_used < oldest.last_used:
+                oldest, parked_owner = entry, owner
+        if parked_owner is not None: del self._parked[parked_owner]
+        elif oldest is not None: self._idle[oldest.key].pop(0)
+        return oldest
+
+    def _schedule_refill(self):
+        """Top the default-voice bucket back up to `min_size` off the caller's critical path"""
+        if self._closed or (self._refill_task and not self._refill_task.done()):
+            return
+        self._refill_task = asyncio.create_task(self._refill(), name="session-pool-refill")
+
+    async def _refill(self):
+        try: await self._fill_to_min()
+        except Exception as e: logger.error(f"Session pool refill failed: {e}")
+
+    def _idle_count(self) -> int:
+        return sum(len(bucket) for bucket in self._idle.values())
+
+    async def _fill_to_min(self):
+        missing = 0
+        async with self._cond:
+            warm = len(self._idle.get(self.default_key, []))
+            missing = max(0, min(self.min_size - warm, self.max_size - self._size))
+            self._size += missing
+        if not missing:
+            return
+        results = await asyncio.gather(*(self._create(self.default_key) for _ in range(missing)), return_exceptions=True)
+        async with self._cond:
+            for result in results:
+                if isinstance(result, PooledSession):
+                    self._idle.setdefault(self.default_key, []).append(result)
+                else:
+                    logger.error(f"Failed to pre-warm Gemini session: {result}")
+            self._cond.notify_all()
+        logger.info(f"Session pool warm: {self._idle_count()} idle, {len(self._leased)} leased")
+
+    async def _probe_idle(self):
+        """Round-trip every idle session (is_healthy() only knows about failures a turn ran into); failed ones are dropped"""
+        async with self._cond:
+            entries = [e for bucket in self._idle.values() for e in bucket] + list(self._parked.values())
+        results = await asyncio.gather(*(e.client.probe() for e in entries), return_exceptions=True)
+        failed = {id(e) for e, ok in zip(entries, results) if ok is not True}
+        if not failed: return
+        self.stats_counters["probe_failures"] += len(failed)
+        logger.warning(f"Session pool: {len(failed)} idle sessions failed their health probe")
+        # Sessions leased meanwhile are left alone: their turn reconnects if needed, and release drops them if not healthy
+
+    async def _evict_idle(self):
+        await self._probe_idle() # Marks failed sessions unhealthy, so the pass below closes them
+        now = asyncio.get_running_loop().time()
+        to_close: List[PooledSession] = []
+        async with self._cond:
+            keep_default = self.min_size
+            for key, bucket in self._idle.items():
+                kept = []
+                for entry in reversed(bucket): # newest first
+                    healthy = entry.client.is_healthy()
+                    if healthy and key == self.default_key and keep_default > 0:
+                        keep_default -= 1; kept.append(entry); continue
+                    if healthy and now - entry.last_used < self.idle_timeout:
+                        kept.append(entry); continue
+                    to_close.append(entry)
+                    self.stats_counters["evicted" if healthy else "unhealthy"] += 1
+                bucket[:] = list(reversed(kept))
+            self._idle = {k: b for k, b in self._idle.items() if b}
+            for owner, entry in list(self._parked.items()):
+                healthy = entry.client.is_healthy()
+                if healthy and now - entry.last_used < self.idle_timeout: continue
+                del self._parked[owner]
+                to_close.append(entry)
+                self.stats_counters["evicted" if healthy else "unhealthy"] += 1
+            self._size -= len(to_close)
+            if to_close: self._cond.notify_all()
+        if to_close:
+            logger.info(f"Session pool evicted {len(to_close)} idle/unhealthy sessions")
+            await asyncio.gather(*(e.client.close() for e in to_close), return_exceptions=True)
+
+    async def _maintenance_loop(self):
+        while not self._closed:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                await self._evict_idle()
+                await self._fill_to_min()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Session pool maintenance failed: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": self._size, "idle": self._idle_count(), "parked": len(self._parked), "leased": len(self._leased),
+                "min_size": self.min_size, "max_size": self.max_size, **self.stats_counters}
@@ -0,0 +1,200 @@
+# backend/gemini_service/session_recorder.py
+#
+# Opt-in capture of /ws sessions (SESSION_RECORDING=true) for replay with session_replay.py.
+#
+# Recordings are append-only binary files, rotated by size; only the newest `max_files` of each run are kept.
+#   file:    MAGIC (b"GWSR") | version (u8)
+#   record:  kind (u8) | session (u32) | time (u64, microseconds since the epoch) | length (u32) | payload
+# Inbound frames are kept whole (a replay re-sends them). Outbound frames are kept as their
+# size (u32) plus the first `outbound_bytes` bytes, which is enough to tell "text" from
+# "complete" without storing every answer and audio chunk. Open and close payloads are JSON.
+# Session numbers are unique within a run; a run is one recorder (worker process) and is
+# part of the file name, so replays group records by (run, session). Each new file starts with
+# the open records of sessions still connected, so deleting old files never orphans them.
+#
+# Inbound frames hold everything users send: message text and attachment bytes are written to
+# disk as they arrived. Treat the directory as user data, or pass `redact` (mask_user_content
+# keeps frame sizes and message structure, so replays still exercise the same code paths).
+import asyncio
+import json
+import logging
+import os
+import random
+import struct
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from binary_protocol import HEADER_SIZE
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"GWSR"
+VERSION = 1
+FILE_HEADER = MAGIC + bytes([VERSION])
+RECORD = struct.Struct("<BIQI")
+OUT_SIZE = struct.Struct("<I")
+OPEN, IN_TEXT, IN_BINARY, OUT_TEXT, OUT_BINARY, CLOSE = range(6)
+SUFFIX = ".gwsr"
+
+def mask_user_content(kind: int, payload: bytes) -> bytes:
+    """Redaction for inbound frames: message text becomes "x"s and attachment bytes become zeros, lengths unchanged"""
+    if kind == IN_BINARY: return payload[:HEADER_SIZE] + bytes(max(len(payload) - HEADER_SIZE, 0))
+    try: message = json.loads(payload)
+    except ValueError: return b"x" * len(payload)
+    if not isinstance(message, dict): return b"x" * len(payload)
+    if isinstance(message.get("text"), str): message["text"] = "x" * len(message["text"])
+    for file_info in message.get("files") or ():
+        if isinstance(file_info, dict) and isinstance(file_info.get("data"), str): file_info["data"] = "A" * len(file_info["data"]) # Valid base64 of zeros
+    return json.dumps(message).encode("utf-8")
+
+class SessionRecording:
+    """Records one connection's frames; handed to its ConnectionPipeline"""
+
+    __slots__ = ("recorder", "session")
+
+    def __init__(self, recorder: "SessionRecorder", session: int):
+        self.recorder = recorder
+        self.session = session
+
+    def inbound(self, frame: Dict[str, Any]):
+        """An ASGI websocket.receive message"""
+        if frame.get("bytes") is not None: kind, payload = IN_BINARY, frame["bytes"]
+        elif frame.get("text") is not None: kind, payload = IN_TEXT, frame["text"].encode("utf-8")
+        else: return
+        if self.recorder.redact: payload = self.recorder.redact(kind, payload)
+        self.recorder._append(kind, self.session, payload)
+
+    def outbound(self, kind: str, payload: bytes):
+        """A frame the writer sent: kind "text" (codec bytes) or "bytes" """
+        head = OUT_SIZE.pack(len(payload)) + payload[:self.recorder.outbound_bytes]
+        self.recorder._append(OUT_TEXT if kind == "text" else OUT_BINARY, self.session, head)
+
+    def close(self, code: int, reason: str = ""):
+        self.recorder._append(CLOSE, self.session, json.dumps({"code": code, "reason": reason}).encode("utf-8"))
+        self.recorder._open.pop(self.session, None)
+
+class SessionRecorder:
+    """Buffers records in memory and appends them to the current file from a background task,
+    so the event loop never waits on the disk. If the disk falls behind by more than
+    `max_buffer_bytes`, records are dropped (and counted) instead of buffered."""
+
+    def __init__(self,
+                 directory: str = "recordings",
+                 max_file_bytes: int = 64 * 1024 * 1024,
+                 max_files: int = 10,
+                 sample_rate: float = 1.0, # Fraction of connections recorded
+                 outbound_bytes: int = 64,
+                 flush_interval: float = 1.0,
+                 max_buffer_bytes: int = 16 * 1024 * 1024,
+                 redact: Optional[Callable[[int, bytes], bytes]] = None): # (kind, payload) -> payload to store, for inbound frames
+        self.directory = Path(directory)
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.sample_rate = sample_rate
+        self.outbound_bytes = outbound_bytes
+        self.flush_interval = flush_interval
+        self.max_buffer_bytes = max_buffer_bytes
+        self.redact = redact
+        self.run = f"{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+        self._buffer = bytearray()
+        self._sessions = 0
+        self._open: Dict[int, bytes] = {} # Open record of each connected session, repeated at the start of every file
+        self._file_seq = 0
+        self._file: Optional[Path] = None
+        self._file_bytes = 0
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock() # One writer thread at a time: they append to and rotate the same file
+        self.counters = {"sessions": 0, "records": 0, "bytes_written": 0, "dropped_records": 0, "files_rotated": 0, "write_failures": 0}
+
+    def start(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._task = asyncio.create_task(self._run(), name="session-recorder")
+        logger.info(f"Recording {self.sample_rate:.0%} of sessions to {self.directory}/ (run {self.run})")
+
+    async def close(self):
+        if self._task:
+            async with self._flush_lock: # A flush already in its writer thread finishes first; the task is then asleep or waiting here
+                self._task.cancel()
+                try: await self._task
+                except asyncio.CancelledError: pass
+            self._task = None
+        await self.flush()
+
+    def session(self, client_id: str, path: str, query: str = "", **meta: Any) -> Optional[SessionRecording]:
+        """Start recording a connection, or None when it is not sampled"""
+        if self._task is None or (self.sample_rate < 1 and random.random() >= self.sample_rate): return None
+        self._sessions += 1
+        self.counters["sessions"] += 1
+        opened = json.dumps({"client_id": client_id, "path": path, "query": query, "run": self.run, **meta}).encode("utf-8")
+        self._open[self._sessions] = RECORD.pack(OPEN, self._sessions, time.time_ns() // 1000, len(opened)) + opened
+        self._buffer += self._open[self._sessions]
+        self.counters["records"] += 1
+        return SessionRecording(self, self._sessions)
+
+    def _append(self, kind: int, session: int, payload: bytes):
+        if len(self._buffer) + RECORD.size + len(payload) > self.max_buffer_bytes:
+            self.counters["dropped_records"] += 1
+            return
+        self._buffer += RECORD.pack(kind, session, time.time_ns() // 1000, len(payload))
+        self._buffer += payload
+        self.counters["records"] += 1
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._buffer: return
+            data, self._buffer = self._buffer, bytearray()
+            rotate = self._file is None or self._file_bytes + len(data) > self.max_file_bytes
+            opens = list(self._open.values()) # Snapshot on the loop; the writer thread starts a new file with them if it rotates
+            try:
+                await asyncio.to_thread(self._write, data, opens, rotate)
+            except OSError as e:
+                self.counters["write_failures"] += 1
+                logger.warning(f"Session recording write failed ({len(data)} bytes dropped): {e}")
+
+    def _write(self, data: bytes, opens: List[bytes], rotate: bool):
+        if rotate or not self._file.exists(): # Also when the current file was deleted from under us
+            self._rotate()
+            data = b"".join(opens) + data # Replays skip the repeats of opens already seen
+        with open(self._file, "ab") as f: f.write(data)
+        self._file_bytes += len(data)
+        self.counters["bytes_written"] += len(data)
+
+    def _rotate(self):
+        if self._file is not None: self.counters["files_rotated"] += 1
+        self._file_seq += 1
+        self._file = self.directory / f"ws-{self.run}-{self._file_seq:06d}{SUFFIX}"
+        self._file.write_bytes(FILE_HEADER)
+        self._file_bytes = len(FILE_HEADER)
+        # Oldest first by name. Only this run's files: other workers sharing the directory manage their own
+        for old in sorted(self.directory.glob(f"ws-{self.run}-*{SUFFIX}"))[:-self.max_files]:
+            try: old.unlink()
+            except OSError: pass
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"sample_rate": self.sample_rate, "buffered_bytes": len(self._buffer), "file_seq": self._file_seq, **self.counters}
+
+def read_records(path: Path) -> Iterator[Tuple[int, int, int, bytes]]:
+    """(kind, session, time_us, payload) of every complete record in one file; a torn last record is skipped"""
+    data = path.read_bytes()
+    if not data.startswith(MAGIC): raise ValueError(f"{path} is not a session recording")
+    if data[len(MAGIC)] != VERSION: raise ValueError(f"{path}: unsupported recording version {data[len(MAGIC)]}")
+    offset = len(FILE_HEADER)
+    while offset + RECORD.size <= len(data):
+        kind, session, time_us, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data): break
+        yield kind, session, time_us, data[offset:offset + length]
+        offset += length
+
+def recording_files(paths: List[str]) -> List[Path]:
+    """Recording files named directly or found in the given directories, oldest first"""
+    files: List[Path] = []
+    for path in map(Path, paths):
+        files.extend(sorted(path.glob(f"*{SUFFIX}")) if path.is_dir() else [path])
+    return files
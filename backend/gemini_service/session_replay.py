@@ -0,0 +1,261 @@
+# backend/gemini_service/session_replay.py
+#
+# Replays /ws sessions captured by the session recorder (SESSION_RECORDING=true, see session_recorder.py)
+# and reports per-message latency: the replay against the recording, or one replay against another.
+#
+#   python session_replay.py recordings/ --list                      (run from backend/gemini_service)
+#   python session_replay.py recordings/ --url ws://localhost:8000 --output replay.json
+#   python session_replay.py recordings/ --spawn --speed 4 --output new.json
+#   python session_replay.py recordings/ --spawn --server-dir /path/to/old/backend/gemini_service --output old.json
+#   python session_replay.py --compare old.json new.json
+#
+# Every recorded session is opened again at its original offset from the first one, and its
+# inbound frames (JSON messages and binary uploads/audio) are re-sent with their original gaps,
+# divided by --speed (0 sends them back to back). Client ids get a "-replay-<run>" suffix.
+# --spawn starts `python main.py` from --server-dir (another checkout = another build) with
+# GEMINI_BACKEND=simulated and the per-client rate limit lifted, on a free port, and stops it afterwards.
+#
+# Each inbound JSON message is a turn. Messages with a dedicated reply (ping -> pong, hello ->
+# hello_ack, ...) end with it; the rest are generations, matched in order with "complete"/"error".
+#   first_ms  until the turn's first reply frame (first text/audio chunk of a generation)
+#   done_ms   until its last one ("complete" or "error" for generations)
+# The recording is analysed the same way as the "original" column; its timestamps are taken on
+# the server, so they leave out the network time a replay includes.
+import argparse
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from lazy_imports import lazy_module
+from load_test import percentile
+from session_recorder import CLOSE, IN_BINARY, IN_TEXT, OPEN, OUT_BINARY, OUT_SIZE, OUT_TEXT, read_records, recording_files
+from startup_benchmark import free_port, http_status, port_open
+
+websockets = lazy_module("websockets")
+
+HERE = Path(__file__).resolve().parent
+TYPE_PATTERN = re.compile(rb'"type"\s*:\s*"([A-Za-z_]+)"')
+# Inbound message types with a dedicated reply; all others are generations, ended by TERMINAL
+REPLIES = {"ping": "pong", "interrupt": "interrupted", "upload_start": "upload_ready", "upload_cancel": "upload_cancelled",
+           "hello": "hello_ack", "update_settings": "settings_ack"}
+TERMINAL = {"complete", "error"}
+UNPAIRED = {"upload_complete"} # Acknowledges binary upload frames, not a message
+OUTCOMES = ("ok", "error", "unanswered")
+
+class Frame:
+    __slots__ = ("t", "inbound", "type", "size", "payload")
+
+    def __init__(self, t: float, inbound: bool, frame_type: str, size: int, payload: Optional[bytes] = None):
+        self.t = t # Seconds
+        self.inbound = inbound
+        self.type = frame_type # JSON "type", or "binary"
+        self.size = size
+        self.payload = payload # Inbound frames only, as recorded (text frames UTF-8 encoded)
+
+class RecordedSession:
+    def __init__(self, key: str, meta: Dict[str, Any], started: float):
+        self.key = key
+        self.meta = meta
+        self.started = started
+        self.frames: List[Frame] = []
+        self.close: Optional[Dict[str, Any]] = None
+
+def outbound_type(head: bytes) -> str:
+    match = TYPE_PATTERN.search(head)
+    return match.group(1).decode("ascii") if match else "unknown"
+
+def inbound_type(text: bytes) -> str:
+    try: message = json.loads(text)
+    except ValueError: return "invalid"
+    return str(message.get("type")) if isinstance(message, dict) else "invalid"
+
+def load_sessions(paths: List[str]) -> List[RecordedSession]:
+    """Sessions in the recordings, by start time. Sessions cut by rotation keep only the frames in the remaining files."""
+    sessions: Dict[str, RecordedSession] = {}
+    for path in recording_files(paths):
+        run = path.stem.rsplit("-", 1)[0] # ws-<run>-<seq>
+        for kind, number, time_us, payload in read_records(path):
+            key = f"{run}/{number}"
+            t = time_us / 1e6
+            if kind == OPEN:
+                if key not in sessions: sessions[key] = RecordedSession(key, json.loads(payload), t) # Repeated at the start of each file
+                continue
+            session = sessions.get(key)
+            if session is None: continue
+            if kind == IN_TEXT: session.frames.append(Frame(t, True, inbound_type(payload), len(payload), payload))
+            elif kind == IN_BINARY: session.frames.append(Frame(t, True, "binary", len(payload), payload))
+            elif kind in (OUT_TEXT, OUT_BINARY):
+                size = OUT_SIZE.unpack_from(payload)[0]
+                session.frames.append(Frame(t, False, outbound_type(payload[OUT_SIZE.size:]) if kind == OUT_TEXT else "binary", size))
+            elif kind == CLOSE: session.close = json.loads(payload)
+    return sorted((s for s in sessions.values() if any(f.inbound for f in s.frames)), key=lambda s: s.started)
+
+def turns(frames: List[Frame]) -> List[Dict[str, Any]]:
+    """Pair inbound JSON messages with the frames answering them (see the header for the rules)"""
+    result: List[Dict[str, Any]] = []
+    pending: List[Dict[str, Any]] = []
+    for frame in frames:
+        if frame.inbound:
+            if frame.type == "binary": continue # Upload chunks and audio; answered via the messages that use them
+            turn = {"type": frame.type, "start": frame.t, "first": None, "done": None, "outcome": "unanswered"}
+            result.append(turn); pending.append(turn)
+            continue
+        if frame.type in UNPAIRED: continue
+        if frame.type in REPLIES.values():
+            turn = next((t for t in pending if REPLIES.get(t["type"]) == frame.type), None)
+        else:
+            turn = next((t for t in pending if t["type"] not in REPLIES), None) # Oldest open generation
+        if turn is None: continue
+        if turn["first"] is None: turn["first"] = frame.t
+        if turn["type"] in REPLIES or frame.type in TERMINAL:
+            turn["done"], turn["outcome"] = frame.t, "error" if frame.type == "error" else "ok"
+            pending.remove(turn)
+    return result
+
+def summarize(all_turns: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Per message type: outcome counts and first/done latency percentiles (ms)"""
+    summary: Dict[str, Any] = {}
+    for message_type in sorted({t["type"] for t in all_turns}):
+        of_type = [t for t in all_turns if t["type"] == message_type]
+        first = sorted((t["first"] - t["start"]) * 1000 for t in of_type if t["first"] is not None)
+        done = sorted((t["done"] - t["start"]) * 1000 for t in of_type if t["done"] is not None)
+        ms = lambda values, pct: round(percentile(values, pct), 1) if values else None
+        summary[message_type] = {"count": len(of_type), **{o: sum(t["outcome"] == o for t in of_type) for o in OUTCOMES},
+                                 "first_ms": {"p50": ms(first, 50), "p95": ms(first, 95), "p99": ms(first, 99)},
+                                 "done_ms": {"p50": ms(done, 50), "p95": ms(done, 95), "p99": ms(done, 99), "max": ms(done, 100)}}
+    return summary
+
+def replay_path(session: RecordedSession, tag: str) -> str:
+    meta = session.meta
+    path = meta["path"].rsplit("/", 1)[0] + f"/{meta['client_id']}-replay-{tag}"
+    return path + (f"?{meta['query']}" if meta.get("query") else "")
+
+async def replay_session(session: RecordedSession, url: str, speed: float, delay: float, tag: str, tail_timeout: float) -> Dict[str, Any]:
+    """Re-send one session's inbound frames and time the answers; returns its frames (seconds from connect) and any failure"""
+    await asyncio.sleep(delay)
+    timeline: List[Frame] = []
+    error = None
+    try:
+        async with websockets.connect(url.rstrip("/") + replay_path(session, tag), max_size=None, open_timeout=10) as ws:
+            started = time.perf_counter()
+            async def receive():
+                async for message in ws:
+                    now = time.perf_counter() - started
+                    if isinstance(message, bytes): timeline.append(Frame(now, False, "binary", len(message)))
+                    else:
+                        data = message.encode("utf-8")
+                        timeline.append(Frame(now, False, outbound_type(data[:256]), len(data)))
+            receiver = asyncio.create_task(receive())
+            try:
+                for frame in (f for f in session.frames if f.inbound):
+                    if speed > 0: await asyncio.sleep(max(0.0, (frame.t - session.started) / speed - (time.perf_counter() - started)))
+                    if receiver.done(): break # Server closed the socket
+                    timeline.append(Frame(time.perf_counter() - started, True, frame.type, frame.size))
+                    await ws.send(frame.payload if frame.type == "binary" else frame.payload.decode("utf-8"))
+                deadline = time.perf_counter() + tail_timeout
+                while time.perf_counter() < deadline and not receiver.done():
+                    if all(t["outcome"] != "unanswered" for t in turns(timeline)): break
+                    await asyncio.sleep(0.05)
+            finally:
+                receiver.cancel()
+                await asyncio.gather(receiver, return_exceptions=True)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return {"session": session.key, "client_id": session.meta.get("client_id"), "frames": timeline, "error": error}
+
+async def replay(sessions: List[RecordedSession], url: str, speed: float, tail_timeout: float) -> List[Dict[str, Any]]:
+    tag = uuid.uuid4().hex[:6]
+    first = sessions[0].started
+    return await asyncio.gather(*(replay_session(s, url, speed, (s.started - first) / speed if speed > 0 else 0.0, tag, tail_timeout)
+                                  for s in sessions))
+
+def start_server(server_dir: Path, env: Dict[str, str], timeout: float = 60.0) -> Tuple[subprocess.Popen, str]:
+    """Start a simulated-backend server from `server_dir` and wait until it is ready"""
+    port = free_port()
+    server_env = {"GEMINI_BACKEND": "simulated", "CLIENT_RATE_LIMIT": "1000", "CLIENT_RATE_BURST": "1000",
+                  "SESSION_RECORDING": "false", "LOG_LEVEL": "WARNING", **env, "PORT": str(port)}
+    process = subprocess.Popen([sys.executable, "main.py"], cwd=server_dir, env={**os.environ, **server_env},
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + timeout
+    while time.time() < deadline and process.poll() is None:
+        if port_open(port):
+            status = http_status(f"http://127.0.0.1:{port}/ready")
+            if status == 200 or (status == 404 and http_status(f"http://127.0.0.1:{port}/health") == 200): # Builds without /ready
+                return process, f"ws://127.0.0.1:{port}"
+        time.sleep(0.1)
+    stop_server(process)
+    raise RuntimeError(f"Server in {server_dir} did not become ready within {timeout}s")
+
+def stop_server(process: subprocess.Popen):
+    process.terminate()
+    try: process.wait(timeout=10)
+    except subprocess.TimeoutExpired: process.kill()
+
+def format_comparison(before: Dict[str, Any], after: Dict[str, Any], labels: List[str]) -> str:
+    """Side-by-side latency per message type, with the change in done_ms"""
+    a, b = labels
+    header = f"{'type':<20}{'count':>7}{'first p50 ' + a:>18}{b:>10}{'done p50 ' + a:>18}{b:>10}{'done p95 ' + a:>18}{b:>10}{'p50 chg':>9}{'p95 chg':>9}"
+    lines = [header, "-" * len(header)]
+    fmt = lambda v: f"{v:.1f}" if v is not None else "-"
+    def change(x, y): return f"{(y - x) / x * 100:+.0f}%" if x and y is not None else "-"
+    for message_type in sorted(set(before) | set(after)):
+        x, y = before.get(message_type), after.get(message_type)
+        if not x or not y:
+            lines.append(f"{message_type:<20}{'(only in ' + (a if x else b) + ')':>30}")
+            continue
+        lines.append(f"{message_type:<20}{y['count']:>7}{fmt(x['first_ms']['p50']):>18}{fmt(y['first_ms']['p50']):>10}"
+                     f"{fmt(x['done_ms']['p50']):>18}{fmt(y['done_ms']['p50']):>10}{fmt(x['done_ms']['p95']):>18}{fmt(y['done_ms']['p95']):>10}"
+                     f"{change(x['done_ms']['p50'], y['done_ms']['p50']):>9}{change(x['done_ms']['p95'], y['done_ms']['p95']):>9}")
+        if y["error"] or y["unanswered"] or x["error"] or x["unanswered"]:
+            lines.append(f"    errors {x['error']} -> {y['error']}, unanswered {x['unanswered']} -> {y['unanswered']}")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded WebSocket sessions and compare latency")
+    parser.add_argument("recordings", nargs="*", help="Recording files or directories")
+    parser.add_argument("--url", default="ws://127.0.0.1:8000", help="Server to replay against (ignored with --spawn)")
+    parser.add_argument("--spawn", action="store_true", help="Start a simulated-backend server from --server-dir for the replay")
+    parser.add_argument("--server-dir", default=str(HERE), help="Directory with the main.py to spawn")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Extra spawned-server environment (repeatable)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Time compression: 1 = original pace, 4 = four times faster, 0 = no gaps")
+    parser.add_argument("--limit", type=int, help="Replay only the first N sessions")
+    parser.add_argument("--tail-timeout", type=float, default=30.0, help="Seconds to wait for outstanding answers after the last frame")
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--list", action="store_true", help="List the recorded sessions and exit")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare the replays in two reports instead")
+    args = parser.parse_args()
+
+    if args.compare:
+        reports = [json.loads(Path(path).read_text()) for path in args.compare]
+        print(format_comparison(reports[0]["replay"], reports[1]["replay"], [Path(path).stem[:8] for path in args.compare]))
+        sys.exit(0)
+    if not args.recordings: parser.error("recordings are required (or use --compare)")
+    sessions = load_sessions(args.recordings)[:args.limit]
+    if not sessions: sys.exit("No complete sessions in the recordings")
+    if args.list:
+        for s in sessions:
+            inbound = sum(f.inbound for f in s.frames)
+            duration = (s.frames[-1].t - s.started) if s.frames else 0.0
+            print(f"{s.key:<32}{s.meta.get('client_id', ''):<28}{inbound:>6} in{len(s.frames) - inbound:>7} out{duration:>9.1f}s  close {(s.close or {}).get('code', '-')}")
+        sys.exit(0)
+
+    server, url = start_server(Path(args.server_dir), dict(item.split("=", 1) for item in args.env)) if args.spawn else (None, args.url)
+    try:
+        results = asyncio.run(replay(sessions, url, args.speed, args.tail_timeout))
+    finally:
+        if server: stop_server(server)
+    original = [turn for s in sessions for turn in turns(s.frames)]
+    replayed = [turn for r in results for turn in turns(r["frames"])]
+    report = {"recordings": args.recordings, "url": url, "server_dir": args.server_dir if args.spawn else None, "speed": args.speed,
+              "sessions": len(sessions), "replayed_at": time.time(), "original": summarize(original), "replay": summarize(replayed),
+              "failures": [{"session": r["session"], "client_id": r["client_id"], "error": r["error"]} for r in results if r["error"]]}
+    print(format_comparison(report["original"], report["replay"], ["orig", "replay"]))
+    for failure in report["failures"]: print(f"    ! {failure['client_id']}: {failure['error']}")
+    if args.output: Path(args.output).write_text(json.dumps(report, indent=2))
@@ -0,0 +1,125 @@
+# backend/gemini_service/startup_benchmark.py
+#
+# Cold-start benchmark: how long a fresh server process takes to accept sockets and to report ready.
+#
+#   python startup_benchmark.py                       (run from backend/gemini_service)
+#   python startup_benchmark.py --runs 10 --output startup.json
+#   python startup_benchmark.py --importtime          (slowest imports of main.py, from python -X importtime)
+#
+# Each run starts `python main.py` with GEMINI_BACKEND=simulated (override with --env KEY=VALUE)
+# on a free port and polls until:
+#   listening   the port accepts TCP connections
+#   health      GET /health answers 200 (liveness)
+#   websocket   a /ws handshake completes and the socket gets a pong
+#   ready       GET /ready answers 200 (warm-up finished; skipped when the server has no /ready)
+# Times are ms from spawning the process. The server is stopped after each run.
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from lazy_imports import lazy_module
+
+websockets = lazy_module("websockets")
+
+HERE = Path(__file__).resolve().parent
+STAGES = ("listening", "health", "websocket", "ready")
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def http_status(url: str) -> Optional[int]:
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response: return response.status
+    except urllib.error.HTTPError as e: return e.code
+    except OSError: return None
+
+def port_open(port: int) -> bool:
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=0.2): return True
+    except OSError: return False
+
+async def websocket_ok(port: int) -> bool:
+    try:
+        async with websockets.connect(f"ws://127.0.0.1:{port}/ws/startup-bench-{port}", open_timeout=2) as ws:
+            await ws.send(json.dumps({"type": "ping"}))
+            return json.loads(await asyncio.wait_for(ws.recv(), 2)).get("type") == "pong"
+    except Exception:
+        return False
+
+async def measure(env: Dict[str, str], timeout: float) -> Dict[str, Optional[float]]:
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    process = subprocess.Popen([sys.executable, "main.py"], cwd=HERE, env={**os.environ, **env, "PORT": str(port), "LOG_LEVEL": "WARNING"},
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    started = time.perf_counter()
+    elapsed = lambda: round((time.perf_counter() - started) * 1000, 1)
+    times: Dict[str, Optional[float]] = dict.fromkeys(STAGES)
+    try:
+        while time.perf_counter() - started < timeout and process.poll() is None:
+            if times["listening"] is None and port_open(port): times["listening"] = elapsed()
+            if times["listening"] is not None:
+                if times["health"] is None and http_status(base + "/health") == 200: times["health"] = elapsed()
+                if times["websocket"] is None and await websocket_ok(port): times["websocket"] = elapsed()
+                if times["ready"] is None:
+                    status = http_status(base + "/ready")
+                    if status == 200: times["ready"] = elapsed()
+                    elif status == 404: times["ready"] = times["health"] # No readiness probe: ready once healthy
+            if all(value is not None for value in times.values()): break
+            await asyncio.sleep(0.01)
+    finally:
+        process.terminate()
+        try: process.wait(timeout=10)
+        except subprocess.TimeoutExpired: process.kill()
+    return times
+
+def summarize(runs: List[Dict[str, Optional[float]]]) -> Dict[str, Any]:
+    summary = {}
+    for stage in STAGES:
+        values = [run[stage] for run in runs if run[stage] is not None]
+        summary[stage] = {"min_ms": min(values), "median_ms": statistics.median(values), "max_ms": max(values), "runs": len(values)} if values else None
+    return summary
+
+def importtime(top: int) -> str:
+    """The slowest imports (cumulative) of main.py in a fresh interpreter"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=HERE, capture_output=True, text=True,
+                            env={**os.environ, "LOG_LEVEL": "WARNING"})
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line: continue
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|", 2)
+        rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+    rows.sort(reverse=True)
+    return "\n".join([f"{'cumulative ms':>14}{'self ms':>10}  module"] + [f"{c / 1000:>14.1f}{s / 1000:>10.1f}  {n}" for c, s, n in rows[:top]])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure cold-start time of the Gemini WebSocket service")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60.0, help="Give up on a run after this many seconds")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Extra server environment (repeatable)")
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--importtime", action="store_true", help="Show the slowest imports of main.py instead")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.importtime:
+        print(importtime(args.top))
+        sys.exit(0)
+    env = {"GEMINI_BACKEND": "simulated", **dict(item.split("=", 1) for item in args.env)}
+    runs = [asyncio.run(measure(env, args.timeout)) for _ in range(args.runs)]
+    report = {"env": env, "runs": runs, "summary": summarize(runs)}
+    print(f"{'stage':<12}{'min ms':>10}{'median ms':>12}{'max ms':>10}")
+    for stage, stats in report["summary"].items():
+        print(f"{stage:<12}" + (f"{stats['min_ms']:>10.1f}{stats['median_ms']:>12.1f}{stats['max_ms']:>10.1f}" if stats else f"{'n/a':>10}"))
+    if args.output: Path(args.output).write_text(json.dumps(report, indent=2))
@@ -0,0 +1,6 @@
+# backend/gemini_service/tests/conftest.py
+import os
+import sys
+
+# The service modules import each other by bare name (they run from backend/gemini_service)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,73 @@
+# backend/gemini_service/tests/test_admission.py
+import asyncio
+
+import pytest
+
+import admission
+from admission import AdmissionController
+from idle_reaper import IdleReaper
+
+def controller(**kwargs) -> AdmissionController:
+    kwargs = {"max_connections": 2, "max_inflight_generations": 1, "client_rate": 1.0, "client_burst": 2, "max_rate_violations": 2, **kwargs}
+    return AdmissionController(**kwargs)
+
+def test_connections_are_capped_and_released():
+    limits = controller()
+    assert limits.admit_connection("a") and limits.admit_connection("b")
+    assert not limits.admit_connection("c")
+    limits.release_connection("a")
+    assert limits.admit_connection("c")
+    assert limits.stats()["rejected_connections"] == 1
+
+def test_rate_limit_rejects_after_the_burst_and_refills(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    limits = controller()
+    limits.admit_connection("a")
+    assert limits.check_rate("a") is None and limits.check_rate("a") is None
+    rejection = limits.check_rate("a")
+    assert rejection["code"] == "rate_limited" and rejection["retry_after"] == 1.0
+    now[0] += 1
+    assert limits.check_rate("a") is None
+
+def test_repeat_offenders_are_disconnected():
+    limits = controller(client_burst=1)
+    limits.admit_connection("a")
+    limits.check_rate("a")
+    for _ in range(2): limits.check_rate("a")
+    assert limits.should_disconnect("a")
+
+def test_overlapping_reconnect_keeps_its_bucket():
+    limits = controller(client_burst=1)
+    limits.admit_connection("a")
+    limits.check_rate("a")
+    limits.admit_connection("a") # New socket before the old one closed
+    limits.release_connection("a", forget_client=False)
+    assert limits.check_rate("a") is not None # Didn't start with a full bucket
+
+def test_inflight_generations_are_capped():
+    limits = controller()
+    assert limits.start_generation("a")
+    assert not limits.start_generation("b")
+    assert limits.is_generating("a") and not limits.is_generating("b")
+    limits.finish_generation("a")
+    assert not limits.is_generating("a") and limits.start_generation("b")
+
+@pytest.mark.asyncio
+async def test_reaper_closes_idle_connections_only():
+    loop = asyncio.get_running_loop()
+    last_activity = {"idle": loop.time(), "active": loop.time(), "busy": loop.time()}
+    reaped = []
+    async def on_idle(client_id): reaped.append(client_id)
+    reaper = IdleReaper(last_activity, idle_timeout=0.05, on_idle=on_idle, is_busy=lambda client_id: client_id == "busy")
+    for client_id in last_activity: reaper.track(client_id)
+    reaper.start()
+    for _ in range(4):
+        await asyncio.sleep(0.02)
+        last_activity["active"] = loop.time()
+    await asyncio.sleep(0.02)
+    assert reaped == ["idle"]
+    reaper.forget("active")
+    await asyncio.sleep(0.1)
+    assert reaped == ["idle"] and reaper.stats()["tracked"] == 1 # Only "busy" is still scheduled
+    await reaper.close()
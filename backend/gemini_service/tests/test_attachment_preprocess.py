@@ -0,0 +1,71 @@
+# backend/gemini_service/tests/test_attachment_preprocess.py
+import asyncio
+import hashlib
+import io
+import time
+import zipfile
+
+import pytest
+
+from attachment_preprocess import DOCX_MIME_TYPE, AttachmentPreprocessor, WorkerPool
+
+pytestmark = pytest.mark.asyncio
+
+def docx(text: str) -> bytes:
+    body = ('<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+            f'<w:p><w:r><w:t>{text}</w:t></w:r></w:p><w:p><w:r><w:t>Second</w:t><w:tab/><w:t>paragraph</w:t></w:r></w:p>'
+            '</w:body></w:document>')
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as archive: archive.writestr("word/document.xml", body)
+    return out.getvalue()
+
+def entry(data: bytes, mime_type: str = DOCX_MIME_TYPE):
+    return {"mime_type": mime_type, "data": data, "filename": "notes.docx", "path": None, "sha256": hashlib.sha256(data).hexdigest()}
+
+@pytest.fixture
+def preprocessor():
+    preprocessor = AttachmentPreprocessor(workers=1, timeout=30)
+    yield preprocessor
+    preprocessor.close()
+
+async def test_document_is_reduced_to_its_text(preprocessor):
+    prepared = await preprocessor.prepare(entry(docx("Hello")))
+    assert prepared["data"] == b"Hello\nSecond\tparagraph" and prepared["mime_type"] == "text/plain"
+    assert prepared["preprocessed"] == "docx text" and prepared["original_size"] > len(prepared["data"])
+
+async def test_results_are_cached_by_digest(preprocessor):
+    data = docx("Cached")
+    first = await preprocessor.prepare(entry(data))
+    second = await preprocessor.prepare({**entry(data), "filename": "copy.docx"})
+    assert second["data"] == first["data"] and second["filename"] == "copy.docx"
+    assert preprocessor.counters["processed"] == 1 and preprocessor.counters["cache_hits"] == 1
+    assert preprocessor.stats()["cached"] == 1
+
+async def test_concurrent_jobs_for_one_digest_share_a_run(preprocessor):
+    data = docx("Shared")
+    results = await asyncio.gather(*(preprocessor.prepare(entry(data)) for _ in range(3)))
+    assert all(result["data"] == results[0]["data"] for result in results)
+    assert preprocessor.counters["processed"] == 1 and preprocessor.counters["coalesced"] == 2
+    assert preprocessor.stats()["inflight"] == 0
+
+async def test_unhelpful_and_small_files_are_sent_as_they_are(preprocessor):
+    small_image = entry(b"\x89PNG" + bytes(100), mime_type="image/png")
+    assert await preprocessor.prepare(small_image) is small_image
+    broken = entry(b"not a zip")
+    assert await preprocessor.prepare(broken) is broken
+    assert preprocessor.counters["skipped"] == 1 and preprocessor.counters["failed"] == 1
+
+async def test_timeout_kills_only_that_jobs_worker():
+    pool = WorkerPool(2)
+    pool.start()
+    try:
+        stuck = asyncio.create_task(pool.run(time.sleep, 10, timeout=0.2))
+        other = asyncio.create_task(pool.run(time.sleep, 0.5, timeout=5))
+        with pytest.raises(asyncio.TimeoutError): await stuck
+        assert await other is None # Its worker kept running through the other one's kill
+        assert pool.counters == {"started": 2, "killed": 1}
+        assert await pool.run(len, b"abc", timeout=5) == 3 # The killed worker is replaced on demand
+        with pytest.raises(RuntimeError, match="TypeError"): await pool.run(len, 1, timeout=5)
+        assert pool.counters["killed"] == 1 # A job that raised leaves its worker usable
+    finally:
+        pool.close()
@@ -0,0 +1,42 @@
+# backend/gemini_service/tests/test_attachment_store.py
+from attachment_store import AttachmentStore
+
+def test_identical_content_is_stored_once():
+    store = AttachmentStore(max_bytes=100)
+    first = store.put("a", "part-a", "image/png", "a.png", 10)
+    assert store.put("a", "other", "image/png", "copy.png", 10) is first
+    assert store.get("a").part == "part-a"
+    assert store.stats()["stores"] == 1 and store.stats()["bytes"] == 10
+
+def test_lru_eviction_skips_pinned_entries():
+    store = AttachmentStore(max_bytes=30)
+    for digest in "abc": store.put(digest, digest, "image/png", None, 10)
+    assert store.acquire("a")
+    store.get("b") # "c" is now the least recently used unpinned entry
+    store.put("d", "d", "image/png", None, 10)
+    assert "a" in store and "b" in store and "c" not in store and "d" in store
+
+def test_put_is_rejected_when_pinned_entries_fill_the_store():
+    store = AttachmentStore(max_bytes=20)
+    store.put("a", "a", "image/png", None, 20)
+    store.acquire("a")
+    assert store.put("b", "b", "image/png", None, 10) is None
+    assert store.stats()["rejected"] == 1
+    store.release("a")
+    assert store.put("b", "b", "image/png", None, 10) is not None
+    assert "a" not in store
+
+def test_expired_entries_are_dropped_unless_pinned():
+    store = AttachmentStore(max_age=60)
+    store.put("a", "a", "image/png", None, 1)
+    store.put("b", "b", "image/png", None, 1)
+    store.acquire("b")
+    for digest in "ab": store._entries[digest].created_at -= 120
+    assert store.get("a") is None and "a" not in store
+    assert store.get("b") is not None
+
+def test_unknown_digests():
+    store = AttachmentStore()
+    assert not store.acquire("missing")
+    store.release("missing")
+    assert store.get("missing") is None and store.stats()["misses"] == 1
@@ -0,0 +1,59 @@
+# backend/gemini_service/tests/test_audio_pipeline.py
+import asyncio
+
+import pytest
+
+from audio_pipeline import AudioEgress
+
+pytestmark = pytest.mark.asyncio
+
+# 1 kHz mono 16-bit: one 10 ms frame is 20 bytes, the 50 ms buffer holds 100 bytes
+FRAME = 20
+
+def egress(sent, **kwargs):
+    async def send_audio(data): sent.append(data)
+    kwargs = {"sample_rate": 1000, "frame_ms": 10, "max_buffer_ms": 50, "max_packet_frames": 2, **kwargs}
+    return AudioEgress(send_audio, **kwargs)
+
+async def test_audio_is_sent_in_whole_frames_and_flushed_at_the_end():
+    sent = []
+    audio = egress(sent)
+    audio.start()
+    audio.submit(b"a" * 30)
+    audio.submit(b"b" * 25)
+    await audio.end_stream()
+    assert [len(packet) for packet in sent] == [20, 20, 15] # Two whole frames, then the flushed remainder
+    assert b"".join(sent) == b"a" * 30 + b"b" * 25
+    await audio.close()
+
+async def test_full_jitter_buffer_drops_the_oldest_audio():
+    sent = []
+    audio = egress(sent)
+    for tag in b"abcdef": audio.submit(bytes([tag]) * 2 * FRAME) # 240 bytes into a 100 byte buffer
+    assert audio.stats_counters["dropped_chunks"] == 4 and audio.buffered_bytes == 80
+    audio.start()
+    await audio.end_stream()
+    assert b"".join(sent) == b"e" * 40 + b"f" * 40 # Only the newest chunks survive
+
+async def test_single_oversized_chunk_is_kept():
+    sent = []
+    audio = egress(sent)
+    audio.submit(b"x" * 300)
+    assert audio.stats_counters["dropped_chunks"] == 0 and audio.buffered_bytes == 300
+
+async def test_reset_discards_the_current_response():
+    sent = []
+    audio = egress(sent)
+    audio.submit(b"a" * 15) # Less than a frame, so nothing is sent before the flush
+    audio.start()
+    await asyncio.sleep(0)
+    audio.reset()
+    assert audio.buffered_bytes == 0
+    audio.submit(b"b" * FRAME)
+    await audio.end_stream()
+    assert sent == [b"b" * FRAME]
+    await audio.close()
+
+async def test_unknown_output_format_is_rejected():
+    with pytest.raises(ValueError):
+        egress([], output_format="wav")
@@ -0,0 +1,36 @@
+# backend/gemini_service/tests/test_binary_protocol.py
+import pytest
+
+from binary_protocol import FRAME_AUDIO_CHUNK, FRAME_FILE_CHUNK, HEADER, HEADER_SIZE, AudioFramer, ProtocolError, decode_frame, encode_frame
+
+def test_header_fields_round_trip():
+    data = encode_frame(FRAME_FILE_CHUNK, 0xDEADBEEF, 7, b"payload", final=True)
+    assert len(data) == HEADER_SIZE + 7
+    frame = decode_frame(data)
+    assert (frame.frame_type, frame.stream_id, frame.seq) == (FRAME_FILE_CHUNK, 0xDEADBEEF, 7)
+    assert frame.final and bytes(frame.payload) == b"payload"
+
+def test_payload_is_a_view_into_the_frame():
+    data = bytearray(encode_frame(FRAME_FILE_CHUNK, 1, 0, b"abc"))
+    frame = decode_frame(data)
+    data[HEADER_SIZE] = ord("x")
+    assert bytes(frame.payload) == b"xbc" and not frame.final
+
+def test_short_frame_is_rejected():
+    with pytest.raises(ProtocolError, match="too short"):
+        decode_frame(encode_frame(FRAME_FILE_CHUNK, 1, 0)[:HEADER_SIZE - 1])
+
+def test_unknown_version_is_rejected():
+    with pytest.raises(ProtocolError, match="version 2"):
+        decode_frame(HEADER.pack(2, FRAME_FILE_CHUNK, 0, 1, 0) + b"data")
+
+def test_audio_framer_numbers_chunks_per_stream():
+    framer = AudioFramer()
+    framer.start_stream()
+    first, second = decode_frame(framer.frame(b"a")), decode_frame(framer.frame(b"b"))
+    end = decode_frame(framer.end_stream())
+    assert [f.seq for f in (first, second, end)] == [0, 1, 2]
+    assert all(f.frame_type == FRAME_AUDIO_CHUNK and f.stream_id == 1 for f in (first, second, end))
+    assert end.final and not second.final and bytes(end.payload) == b""
+    framer.start_stream()
+    assert decode_frame(framer.frame(b"c")).stream_id == 2 and framer.seq == 1
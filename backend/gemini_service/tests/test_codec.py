@@ -0,0 +1,46 @@
+# backend/gemini_service/tests/test_codec.py
+import json
+
+import pytest
+
+from codec import CODECS, JsonCodec, StdlibCodec, create_codec
+
+PAYLOAD = {"type": "text_chunk", "id": "m-1", "text": "naïve café ☕ \"quoted\"\n", "seq": 3, "final": False, "ratio": 0.25,
+           "parts": [None, 1, [2, 3]], "empty": {}}
+
+def codec(name):
+    try: return create_codec(name)
+    except RuntimeError as e: pytest.skip(str(e)) # Optional package not installed
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_payload_round_trips(name):
+    frame = codec(name).dumps(PAYLOAD)
+    assert isinstance(frame, bytes) and json.loads(frame) == PAYLOAD
+    assert codec(name).loads(frame) == PAYLOAD
+    assert codec(name).loads(frame.decode("utf-8")) == PAYLOAD
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_frames_are_interchangeable_between_codecs(name):
+    for other in CODECS:
+        try: encoded = create_codec(other).dumps(PAYLOAD)
+        except RuntimeError: continue
+        assert codec(name).loads(encoded) == PAYLOAD
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_invalid_json_raises_value_error(name):
+    with pytest.raises(ValueError):
+        codec(name).loads(b'{"type": ')
+
+def test_stdlib_frames_are_ascii():
+    frame = StdlibCodec().dumps(PAYLOAD)
+    assert frame.isascii() and b", " not in frame and b": " not in frame # Escaped and compact
+
+def test_unknown_codec_is_rejected():
+    with pytest.raises(ValueError):
+        create_codec("yaml")
+    assert create_codec("auto").name in CODECS
+
+def test_codec_without_dumps_fails_when_created():
+    class DecodeOnly(JsonCodec):
+        def loads(self, data): return json.loads(data)
+    with pytest.raises(TypeError): DecodeOnly()
@@ -0,0 +1,221 @@
+# backend/gemini_service/tests/test_connection_pipeline.py
+import asyncio
+import json
+
+import pytest
+from starlette.websockets import WebSocketState
+
+from connection_pipeline import ConnectionPipeline
+from memory import MemoryBudget
+
+pytestmark = pytest.mark.asyncio
+
+class FakeWebSocket:
+    """Feeds frames to the reader and collects what the writer sends; `can_send` cleared stalls the client"""
+
+    def __init__(self):
+        self.client_state = WebSocketState.CONNECTED
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.sent = []
+        self.can_send = asyncio.Event()
+        self.can_send.set()
+
+    def feed(self, message):
+        self.incoming.put_nowait({"type": "websocket.receive", "text": json.dumps(message)})
+
+    def disconnect(self):
+        self.incoming.put_nowait({"type": "websocket.disconnect"})
+
+    async def receive(self):
+        return await self.incoming.get()
+
+    async def send_text(self, text):
+        await self.can_send.wait()
+        self.sent.append(json.loads(text))
+
+    async def send_bytes(self, data):
+        await self.can_send.wait()
+        self.sent.append(data)
+
+    def types(self):
+        return [m["type"] for m in self.sent if isinstance(m, dict)]
+
+async def wait_for(condition, timeout=1.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "condition not met in time"
+        await asyncio.sleep(0.005)
+
+async def test_interrupt_cancels_the_generation_and_keeps_the_connection():
+    ws = FakeWebSocket()
+    started, cancelled = asyncio.Event(), asyncio.Event()
+    async def handler(message):
+        if message["type"] == "slow":
+            started.set()
+            try: await asyncio.sleep(10)
+            except asyncio.CancelledError: cancelled.set(); raise
+        await pipeline.send_json({"type": "done", "for": message["type"]})
+    pipeline = ConnectionPipeline(ws, "c", handler, receive_timeout=None)
+    run = asyncio.create_task(pipeline.run())
+    ws.feed({"type": "slow"})
+    await asyncio.wait_for(started.wait(), 1)
+    ws.feed({"type": "interrupt"})
+    await asyncio.wait_for(cancelled.wait(), 1)
+    ws.feed({"type": "fast"})
+    await wait_for(lambda: "done" in ws.types())
+    assert {"type": "interrupted", "cancelled": True} in ws.sent
+    assert {"type": "done", "for": "fast"} in ws.sent and {"type": "done", "for": "slow"} not in ws.sent
+    ws.disconnect()
+    await asyncio.wait_for(run, 1)
+
+async def test_interrupt_drops_unsent_chunks_of_the_cancelled_generation():
+    ws = FakeWebSocket()
+    ws.can_send.clear()
+    queued = asyncio.Event()
+    async def handler(message):
+        for i in range(5): await pipeline.send_json({"type": "text", "i": i})
+        queued.set()
+        await asyncio.sleep(10)
+    pipeline = ConnectionPipeline(ws, "c", handler, receive_timeout=None)
+    run = asyncio.create_task(pipeline.run())
+    ws.feed({"type": "text_message"})
+    await asyncio.wait_for(queued.wait(), 1)
+    ws.feed({"type": "interrupt"})
+    await wait_for(lambda: pipeline._generation_task is None)
+    ws.can_send.set()
+    await wait_for(lambda: "interrupted" in ws.types())
+    await asyncio.sleep(0.02)
+    assert ws.types().count("text") <= 1 # At most the chunk the writer was already sending
+    ws.disconnect()
+    await asyncio.wait_for(run, 1)
+
+async def test_interrupt_after_the_generation_finished_keeps_its_unsent_tail():
+    ws = FakeWebSocket()
+    ws.can_send.clear()
+    async def handler(message):
+        for i in range(3): await pipeline.send_json({"type": "text", "i": i})
+        await pipeline.send_json({"type": "complete"})
+    pipeline = ConnectionPipeline(ws, "c", handler, receive_timeout=None)
+    run = asyncio.create_task(pipeline.run())
+    ws.feed({"type": "text_message"})
+    await wait_for(lambda: pipeline._generation_seq == 1 and pipeline._generation_task is None)
+    ws.feed({"type": "interrupt"})
+    await wait_for(lambda: pipeline._control)
+    ws.can_send.set()
+    await wait_for(lambda: "complete" in ws.types())
+    assert {"type": "interrupted", "cancelled": False} in ws.sent and ws.types().count("text") == 3
+    ws.disconnect()
+    await asyncio.wait_for(run, 1)
+
+async def test_control_frames_skip_ahead_of_streamed_output():
+    ws = FakeWebSocket()
+    ws.can_send.clear()
+    queued = asyncio.Event()
+    async def handler(message):
+        for i in range(3): await pipeline.send_json({"type": "text", "i": i})
+        queued.set()
+    pipeline = ConnectionPipeline(ws, "c", handler, receive_timeout=None)
+    run = asyncio.create_task(pipeline.run())
+    ws.feed({"type": "text_message"})
+    await asyncio.wait_for(queued.wait(), 1)
+    ws.feed({"type": "ping"})
+    await wait_for(lambda: pipeline._control)
+    ws.can_send.set()
+    await wait_for(lambda: len(ws.sent) == 4)
+    assert ws.types().index("pong") <= 1 # Behind at most the chunk already in flight
+    ws.disconnect()
+    await asyncio.wait_for(run, 1)
+
+async def test_full_inbound_queue_rejects_with_the_message_id():
+    ws = FakeWebSocket()
+    started, release = asyncio.Event(), asyncio.Event()
+    async def handler(message):
+        started.set()
+        await release.wait()
+    pipeline = ConnectionPipeline(ws, "c", handler, receive_timeout=None, recv_queue_size=1)
+    run = asyncio.create_task(pipeline.run())
+    ws.feed({"type": "text_message", "id": 0})
+    await asyncio.wait_for(started.wait(), 1)
+    for i in (1, 2): ws.feed({"type": "text_message", "id": i}) # One queued, one rejected
+    await wait_for(lambda: ws.sent)
+    assert ws.sent[0]["code"] == "queue_full" and ws.sent[0]["id"] == 2
+    release.set()
+    ws.disconnect()
+    await asyncio.wait_for(run, 1)
+
+async def test_admission_rejection_is_sent_without_running_the_handler():
+    ws = FakeWebSocket()
+    handled = []
+    async def handler(message):
+        handled.append(message)
+    pipeline = ConnectionPipeline(ws, "c", handler, receive_timeout=None,
+                                  admit=lambda message: {"type": "error", "code": "rate_limited", "error": "slow down"})
+    run = asyncio.create_task(pipeline.run())
+    ws.feed({"type": "text_message", "id": "m1"})
+    await wait_for(lambda: ws.sent)
+    assert ws.sent[0] == {"type": "error", "code": "rate_limited", "error": "slow down", "id": "m1"}
+    assert not handled
+    ws.disconnect()
+    await asyncio.wait_for(run, 1)
+
+async def test_stalled_client_is_dropped_as_a_slow_consumer():
+    ws = FakeWebSocket()
+    ws.can_send.clear() # Never reads
+    async def handler(message):
+        for i in range(10): await pipeline.send_json({"type": "text", "i": i})
+    pipeline = ConnectionPipeline(ws, "c", handler, receive_timeout=None, send_queue_size=2, send_timeout=0.05)
+    run = asyncio.create_task(pipeline.run())
+    ws.feed({"type": "text_message"})
+    await asyncio.wait_for(run, 1)
+    assert pipeline.close_code == 1008
+
+async def test_control_frames_are_never_dropped_the_client_is_closed_instead():
+    ws = FakeWebSocket()
+    ws.can_send.clear()
+    pipeline = ConnectionPipeline(ws, "c", lambda message: None, receive_timeout=None, control_queue_size=2)
+    run = asyncio.create_task(pipeline.run())
+    for _ in range(4): ws.feed({"type": "ping"})
+    await wait_for(lambda: pipeline._stopped.is_set())
+    ws.can_send.set()
+    await asyncio.wait_for(run, 2)
+    assert pipeline.close_code == 1008
+    assert not pipeline._control and ws.types() == ["pong"] * len(ws.sent) and len(ws.sent) >= 2 # What fit was sent before closing
+
+async def test_memory_budget_blocks_producers_and_is_released_on_drain():
+    ws = FakeWebSocket()
+    ws.can_send.clear()
+    budget = MemoryBudget(limit_bytes=1 << 20, per_account_bytes=64)
+    account = budget.account("c")
+    sent_all = asyncio.Event()
+    async def handler(message):
+        for i in range(10): await pipeline.send_json({"type": "text", "content": "x" * 20})
+        sent_all.set()
+    pipeline = ConnectionPipeline(ws, "c", handler, receive_timeout=None, send_timeout=1, memory=account)
+    run = asyncio.create_task(pipeline.run())
+    ws.feed({"type": "text_message"})
+    await asyncio.sleep(0.05)
+    assert not sent_all.is_set() and account.in_use <= 64 + 64 # Waiting on the budget, not the queue
+    ws.can_send.set()
+    await asyncio.wait_for(sent_all.wait(), 1)
+    await wait_for(lambda: account.in_use == 0)
+    ws.disconnect()
+    await asyncio.wait_for(run, 1)
+    assert budget.counters["denied"] > 0
+
+async def test_run_waits_for_the_cancelled_generation_to_clean_up():
+    ws = FakeWebSocket()
+    started, cleaned = asyncio.Event(), []
+    async def handler(message):
+        started.set()
+        try: await asyncio.sleep(10)
+        finally:
+            await asyncio.sleep(0.01) # e.g. handing a session lease back
+            cleaned.append(True)
+    pipeline = ConnectionPipeline(ws, "c", handler, receive_timeout=None)
+    run = asyncio.create_task(pipeline.run())
+    ws.feed({"type": "text_message"})
+    await asyncio.wait_for(started.wait(), 1)
+    ws.disconnect()
+    await asyncio.wait_for(run, 1)
+    assert cleaned == [True]
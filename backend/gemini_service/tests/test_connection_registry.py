@@ -0,0 +1,123 @@
+# backend/gemini_service/tests/test_connection_registry.py
+import asyncio
+import json
+
+import pytest
+
+from connection_registry import ConnectionEntry, InMemorySharedBackend, InProcessRegistry, SharedBackend, SharedRegistry
+
+pytestmark = pytest.mark.asyncio
+
+def entry(received):
+    async def deliver(message): received.append(message)
+    return ConnectionEntry(websocket=None, client=None, deliver=deliver)
+
+async def workers(*names, backend=None):
+    backend = backend or InMemorySharedBackend()
+    registries = [SharedRegistry(backend, worker_id=name, heartbeat_interval=60) for name in names]
+    for registry in registries: await registry.start()
+    return backend, registries
+
+async def settle():
+    for _ in range(5): await asyncio.sleep(0)
+
+async def test_incomplete_shared_backend_fails_when_created():
+    class NoPubSub(SharedBackend):
+        async def hset(self, key, field, value): pass
+        async def hget(self, key, field): return None
+        async def hdel(self, key, *fields): pass
+        async def hgetall(self, key): return {}
+    with pytest.raises(TypeError): NoPubSub()
+
+async def test_in_process_registry_delivers_locally():
+    registry = InProcessRegistry("w")
+    received = []
+    await registry.register("c", entry(received))
+    assert await registry.send_to("c", {"type": "note"})
+    assert received == [{"type": "note"}]
+    assert not await registry.send_to("missing", {"type": "note"})
+    assert await registry.worker_counts() == {"w": 1}
+
+async def test_message_is_routed_to_the_owning_worker():
+    _, (a, b) = await workers("a", "b")
+    received = []
+    await b.register("c", entry(received))
+    assert await a.send_to("c", {"type": "note"})
+    await settle()
+    assert received == [{"type": "note"}]
+    assert await a.total_count() == 1 and await a.worker_counts() == {"a": 0, "b": 1}
+    for registry in (a, b): await registry.close()
+
+async def test_unknown_or_departed_clients_are_not_routed():
+    _, (a, b) = await workers("a", "b")
+    received = []
+    await b.register("c", entry(received))
+    await b.unregister("c")
+    assert not await a.send_to("c", {"type": "note"})
+    assert not await a.send_to("never", {"type": "note"})
+    for registry in (a, b): await registry.close()
+
+async def test_stale_worker_is_ignored():
+    backend, (a, b) = await workers("a", "b")
+    await b.register("c", entry([]))
+    await backend.hset(SharedRegistry.WORKERS_KEY, "b", json.dumps({"connections": 1, "updated": 0}))
+    assert await a.worker_counts() == {"a": 0}
+    assert not await a.send_to("c", {"type": "note"}) # Owner looks crashed
+    for registry in (a, b): await registry.close()
+
+async def test_reconnect_elsewhere_keeps_the_new_owner():
+    backend, (a, b) = await workers("a", "b")
+    await a.register("c", entry([]))
+    received = []
+    await b.register("c", entry(received)) # Reconnected to b before a noticed the old socket close
+    await a.unregister("c")
+    assert await backend.hget(SharedRegistry.OWNERS_KEY, "c") == "b"
+    assert await a.send_to("c", {"type": "note"})
+    await settle()
+    assert received == [{"type": "note"}]
+    for registry in (a, b): await registry.close()
+
+async def test_close_releases_owned_clients_and_the_heartbeat():
+    backend, (a, b) = await workers("a", "b")
+    await a.register("c", entry([]))
+    await a.close()
+    assert await backend.hget(SharedRegistry.OWNERS_KEY, "c") is None
+    assert await b.worker_counts() == {"b": 0}
+    await b.close()
+
+class FlakyBackend(InMemorySharedBackend):
+    """The first subscription to `channel` raises once `reset` is set, like a dropped Redis connection"""
+
+    def __init__(self, channel):
+        super().__init__()
+        self.channel, self.reset, self.subscribes = channel, asyncio.Event(), 0
+
+    async def subscribe(self, channel):
+        messages = await super().subscribe(channel)
+        if channel != self.channel: return messages
+        self.subscribes += 1
+        if self.subscribes > 1: return messages
+        async def broken():
+            await self.reset.wait()
+            await messages.aclose()
+            raise ConnectionError("connection reset")
+            yield
+        return broken()
+
+async def test_listener_resubscribes_after_the_subscription_fails():
+    backend = FlakyBackend(SharedRegistry.CHANNEL_PREFIX + "b")
+    a = SharedRegistry(backend, worker_id="a", heartbeat_interval=60)
+    b = SharedRegistry(backend, worker_id="b", heartbeat_interval=60, listener_backoff=0.05)
+    for registry in (a, b): await registry.start()
+    received = []
+    await b.register("c", entry(received))
+    backend.reset.set()
+    await settle()
+    assert not b.healthy and b.stats()["listener_failures"] == 1
+    assert not await a.send_to("c", {"type": "lost"}) # Reported as unreachable rather than published to nobody
+    await asyncio.sleep(0.1)
+    assert b.healthy and b.stats()["listener_reconnects"] == 1
+    assert await a.send_to("c", {"type": "note"})
+    await settle()
+    assert received == [{"type": "note"}]
+    for registry in (a, b): await registry.close()
@@ -0,0 +1,87 @@
+# backend/gemini_service/tests/test_conversation.py
+import pytest
+
+from conversation import SUMMARY_PREFIX, Conversation, ConversationStore, ExtractiveSummarizer, Summarizer, SummaryCache, Turn, estimate_tokens
+from gemini_client import record_exchange
+
+pytestmark = pytest.mark.asyncio
+
+def exchange(n: int, words: int = 20):
+    question = f"Question {n}. " + "word " * words
+    answer = f"Answer {n}. " + "word " * words
+    return Turn("user", [{"text": question}], question), Turn("model", [{"text": answer}], answer)
+
+def conversation(max_tokens: int = 100, summary_tokens: int = 50, cache=None) -> Conversation:
+    return Conversation(max_tokens, summary_tokens, ExtractiveSummarizer(), cache)
+
+async def test_short_history_is_sent_verbatim():
+    history = conversation()
+    await history.append(*exchange(1, words=2))
+    assert [c["role"] for c in history.window()] == ["user", "model"]
+    assert not history.summary
+
+async def test_compaction_folds_whole_exchanges_into_the_summary():
+    history = conversation(max_tokens=100)
+    for n in range(5): await history.append(*exchange(n))
+    assert history.tokens <= 100
+    assert history.turns[0].role == "user" # Never starts mid-exchange
+    assert history.summarized_turns % 2 == 0 and history.summarized_turns > 0
+    assert "user: Question 0." in history.summary and "model: Answer 0." in history.summary
+    window = history.window()
+    assert window[0] == {"role": "user", "parts": [{"text": SUMMARY_PREFIX + history.summary}]}
+    assert history.window_tokens == history.tokens + estimate_tokens(SUMMARY_PREFIX + history.summary)
+
+async def test_latest_turn_is_kept_even_over_budget():
+    history = conversation(max_tokens=10)
+    await history.append(*exchange(1, words=100))
+    assert history.turns and history.turns[-1].role == "model"
+
+async def test_summary_stays_within_its_budget():
+    history = conversation(max_tokens=60, summary_tokens=20)
+    for n in range(10): await history.append(*exchange(n))
+    assert estimate_tokens(history.summary) <= 20
+    assert "Question 0." not in history.summary # The oldest lines are dropped first
+
+async def test_summaries_are_shared_through_the_cache():
+    cache = SummaryCache()
+    for _ in range(2):
+        history = conversation(cache=cache)
+        for n in range(5): await history.append(*exchange(n))
+    assert cache.stats()["hits"] > 0
+
+async def test_attachments_are_named_in_the_summary():
+    history = conversation(max_tokens=10)
+    await history.append(Turn("user", [], "See this.", attachments=["plan.pdf"]), Turn("model", [], "Done."))
+    await history.append(*exchange(2, words=2))
+    assert "[attached: plan.pdf]" in history.summary
+
+async def test_cached_exchange_is_recorded_with_attachment_placeholders():
+    history = conversation(max_tokens=1000) # Each attachment counts ATTACHMENT_TOKENS
+    await record_exchange(history, "user", "What is in it?", "A floor plan.", ["plan.pdf"])
+    question, answer = history.turns
+    assert [part.text for part in question.parts] == ["What is in it?", "[plan.pdf is no longer attached]"]
+    assert question.attachments == ["plan.pdf"] and answer.text == "A floor plan."
+
+async def test_store_resumes_only_with_the_issued_token():
+    store = ConversationStore(max_conversations=2, idle_ttl=60)
+    token, history = store.open()
+    assert store.find(token) is history
+    assert store.find("client-1") is None # A client id is not a token
+    other_token, _ = store.open()
+    assert other_token != token
+    store.discard(token)
+    assert store.find(token) is None
+
+async def test_store_evicts_least_recently_used_and_idle_conversations():
+    store = ConversationStore(max_conversations=2, idle_ttl=60)
+    first, _ = store.open()
+    second, history = store.open()
+    store.find(first)
+    store.open()
+    assert store.find(second) is None and store.find(first) is not None
+    store.find(first).last_used -= 61
+    assert store.find(first) is None
+
+async def test_summarizer_without_summarize_fails_when_created():
+    class Unfinished(Summarizer): pass
+    with pytest.raises(TypeError): Unfinished()
@@ -0,0 +1,50 @@
+# backend/gemini_service/tests/test_memory.py
+from memory import MemoryBudget, RingBuffer
+
+def test_ring_buffer_keeps_the_newest_values_in_order():
+    ring = RingBuffer(3)
+    assert not ring and list(ring) == []
+    for value in range(1, 6): ring.append(value)
+    assert list(ring) == [3, 4, 5] and len(ring) == 3 and ring.total == 5
+    assert ring.nbytes == 3 * 8 # Fixed however many values pass through
+
+def test_ring_buffer_before_it_fills():
+    ring = RingBuffer(4, typecode="i")
+    for value in (7, 8): ring.append(value)
+    assert list(ring) == [7, 8] and ring.nbytes == 4 * ring._data.itemsize
+
+def test_account_is_limited_by_its_own_cap_and_the_budget():
+    budget = MemoryBudget(limit_bytes=150, per_account_bytes=100)
+    a, b = budget.account("a"), budget.account("b")
+    assert a.try_charge(60) and not a.try_charge(50) # Over a's own 100
+    assert b.try_charge(80) and not b.try_charge(20) # Over the shared 150
+    assert budget.in_use == 140 and budget.counters["denied"] == 2
+    a.release(60)
+    assert b.try_charge(20) and budget.in_use == 100 and budget.peak == 140
+
+def test_empty_account_may_take_one_oversized_item():
+    budget = MemoryBudget(limit_bytes=100, per_account_bytes=50)
+    account = budget.account("a")
+    assert account.try_charge(500) and not account.try_charge(1)
+    account.charge(1) # Control frames are charged without a check
+    assert account.in_use == 501 and account.peak == 501
+
+def test_close_releases_everything_and_leaves_the_report():
+    budget = MemoryBudget(limit_bytes=1000, per_account_bytes=1000)
+    a, b = budget.account("a"), budget.account("b")
+    a.charge(300); b.charge(100)
+    assert [entry["name"] for entry in budget.top()] == ["a", "b"]
+    a.release(1000) # Never releases more than was charged
+    assert a.in_use == 0 and budget.in_use == 100
+    b.close()
+    assert budget.in_use == 0 and budget.stats()["accounts"] == 1
+
+def test_reconnect_replaces_the_account_in_the_report():
+    budget = MemoryBudget(limit_bytes=1000, per_account_bytes=1000)
+    old = budget.account("client")
+    old.charge(10)
+    new = budget.account("client")
+    old.close() # The old socket closes after the new one opened
+    assert budget.stats()["accounts"] == 1 and budget.top() == [{"name": "client", "in_use": 0, "peak": 0}]
+    new.charge(5)
+    assert budget.in_use == 5
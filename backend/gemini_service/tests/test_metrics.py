@@ -0,0 +1,60 @@
+# backend/gemini_service/tests/test_metrics.py
+import pytest
+
+from metrics import Counter, Histogram, Metric, MetricsRegistry, message_type_label
+
+def bucket_lines(histogram):
+    return [line for line in histogram.render() if "_bucket" in line]
+
+def test_histogram_buckets_are_inclusive_and_cumulative():
+    histogram = Histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    for value in (0.1, 0.5, 1.0, 2.0): histogram.observe(value)
+    assert bucket_lines(histogram) == [
+        'latency_seconds_bucket{le="0.1"} 1', # A value on a boundary counts as <= that bound
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+    ]
+    assert "latency_seconds_sum 3.6" in histogram.render() and "latency_seconds_count 4" in histogram.render()
+
+def test_histogram_series_are_kept_per_label_set():
+    histogram = Histogram("message_seconds", "Message latency", ["type"], buckets=(1.0,))
+    histogram.observe(0.5, type="text_message")
+    histogram.observe(5, type="hello")
+    assert histogram.count(type="text_message") == 1 and histogram.count(type="other") == 0
+    assert 'message_seconds_bucket{type="hello",le="1"} 0' in histogram.render()
+
+def test_counter_escapes_label_values():
+    counter = Counter("closes_total", "Closes", ["reason"])
+    counter.inc(reason='say "bye"\n')
+    assert counter.render()[-1] == 'closes_total{reason="say \\"bye\\"\\n"} 1'
+
+def test_identical_registration_replaces_the_metric():
+    registry = MetricsRegistry()
+    first = registry.counter("requests_total", "Requests")
+    second = registry.counter("requests_total", "Requests")
+    second.inc()
+    assert second is not first and "requests_total 1" in registry.render()
+
+@pytest.mark.parametrize("register", [
+    lambda registry: registry.gauge("requests_total", "Requests"),
+    lambda registry: registry.counter("requests_total", "Something else"),
+])
+def test_conflicting_registration_is_rejected(register):
+    registry = MetricsRegistry()
+    registry.counter("requests_total", "Requests")
+    with pytest.raises(ValueError, match="already registered"):
+        register(registry)
+
+def test_broken_gauge_source_is_left_out_of_the_scrape():
+    registry = MetricsRegistry()
+    registry.gauge_func("queue_depth", "Queue depth", lambda: 1 / 0)
+    registry.stats_gauges("pool", "Pool", lambda: {"size": 2, "healthy": True, "name": "x"})
+    assert registry.render().splitlines() == ["# HELP pool_size Pool (size)", "# TYPE pool_size gauge", "pool_size 2"]
+
+def test_unknown_message_types_share_one_label():
+    assert message_type_label("text_message") == "text_message"
+    assert message_type_label("anything") == message_type_label(None) == "other"
+
+def test_metric_without_render_fails_when_created():
+    class Unrendered(Metric): kind = "gauge"
+    with pytest.raises(TypeError): Unrendered("unrendered", "Missing render")
@@ -0,0 +1,171 @@
+# backend/gemini_service/tests/test_resilience.py
+import asyncio
+
+import pytest
+
+import resilience
+from gemini_backends import GeminiBackend, SimulatedBackendError, SimulatedResponse
+from gemini_client import GeminiClient
+from resilience import CircuitBreaker, RetryBudget, UpstreamResilience, UpstreamUnavailable
+
+class Clock:
+    def __init__(self): self.now = 1000.0
+    def __call__(self): return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resilience.time, "monotonic", clock)
+    return clock
+
+def test_retry_budget_is_a_fraction_of_requests(clock):
+    budget = RetryBudget(ratio=0.5, min_per_second=0, max_tokens=10)
+    budget.tokens = 0
+    budget.deposit()
+    assert not budget.try_spend()
+    budget.deposit()
+    assert budget.try_spend() and not budget.try_spend()
+
+def test_retry_budget_trickle_refill_is_capped(clock):
+    budget = RetryBudget(ratio=0, min_per_second=1, max_tokens=2)
+    budget.tokens = 0
+    clock.now += 10
+    assert budget.try_spend() and budget.try_spend() and not budget.try_spend()
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for _ in range(2): breaker.record_failure()
+    breaker.record_success()
+    for _ in range(2): breaker.record_failure()
+    assert breaker.state == "closed" # The success reset the count
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(UpstreamUnavailable) as rejected:
+        breaker.check()
+    assert rejected.value.retry_after == 30
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow() and breaker.state == "half_open"
+    assert not breaker.allow() # Only one probe at a time
+    breaker.record_failure()
+    assert breaker.state == "open"
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+def test_lost_probe_is_replaced_after_the_reset_timeout(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+    clock.now += 31
+    assert breaker.allow()
+
+def test_retries_stop_at_max_attempts_or_the_budget(clock):
+    policy = UpstreamResilience(max_attempts=3, retry_budget=RetryBudget(min_per_second=0, max_tokens=1))
+    assert policy.can_retry(1)
+    assert not policy.can_retry(2) # Budget spent
+    assert not policy.can_retry(3)
+    assert policy.counters["retries"] == 1 and policy.counters["retries_denied"] == 1
+
+# --- GeminiClient retry and hedging, against a backend that counts what it was asked to do ---
+
+class FailingSession:
+    def __init__(self, backend, fail: bool, delay: float = 0.0):
+        self.backend, self.fail, self.delay, self.closed = backend, fail, delay, False
+
+    async def send_message_streaming(self, request):
+        await asyncio.sleep(self.delay)
+        if self.fail: raise SimulatedBackendError("upstream failed before the first response")
+        yield SimulatedResponse(text="ok")
+
+    def close(self):
+        self.closed = True
+
+class ScriptedBackend(GeminiBackend):
+    """connect() hands out sessions built by `script(index)`; None makes that connect fail"""
+
+    requires_api_key = False
+
+    def __init__(self, script):
+        self.script = script
+        self.sessions = []
+        self.connects = 0
+
+    def connect(self, model, config):
+        self.connects += 1
+        session = self.script(self.connects)
+        if session is None: raise SimulatedBackendError("connect failed")
+        self.sessions.append(session)
+        return session
+
+    async def upload_file(self, path, mime_type, display_name=None):
+        raise AssertionError("not used by these tests")
+
+async def collect(client):
+    return [response async for response in client._stream({"contents": []})]
+
+@pytest.mark.asyncio
+async def test_failure_before_the_first_response_is_retried_on_a_new_session():
+    backend = ScriptedBackend(lambda i: FailingSession(backend, fail=i == 1))
+    policy = UpstreamResilience(max_attempts=3, backoff_base=0)
+    client = GeminiClient(backend=backend, resilience=policy)
+    await client.initialize_session()
+    responses = await collect(client)
+    assert [r.text for r in responses] == ["ok"]
+    assert client.session is backend.sessions[1] and policy.counters["retries"] == 1
+
+@pytest.mark.asyncio
+async def test_stream_retries_make_one_connect_per_attempt():
+    backend = ScriptedBackend(lambda i: FailingSession(backend, fail=True))
+    policy = UpstreamResilience(max_attempts=3, backoff_base=0, breaker=CircuitBreaker(failure_threshold=100))
+    client = GeminiClient(backend=backend, resilience=policy)
+    await client.initialize_session()
+    with pytest.raises(SimulatedBackendError):
+        await collect(client)
+    assert backend.connects == 3 # The initial session plus one reconnect per retry
+    assert policy.counters["attempts"] == 4 and policy.counters["retries"] == 2 and policy.counters["reconnects"] == 2
+
+@pytest.mark.asyncio
+async def test_failed_reconnect_uses_up_an_attempt_instead_of_retrying_itself():
+    backend = ScriptedBackend(lambda i: FailingSession(backend, fail=True) if i == 1 else None)
+    policy = UpstreamResilience(max_attempts=3, backoff_base=0, breaker=CircuitBreaker(failure_threshold=100))
+    client = GeminiClient(backend=backend, resilience=policy)
+    await client.initialize_session()
+    with pytest.raises(SimulatedBackendError):
+        await collect(client)
+    assert backend.connects == 3 and policy.counters["retries"] == 2
+
+@pytest.mark.asyncio
+async def test_hedge_that_fails_is_closed_and_the_primary_answers():
+    def script(i):
+        if i == 1: return FailingSession(backend, fail=False, delay=0.05) # Slow primary
+        return FailingSession(backend, fail=True) # Hedge fails
+    backend = ScriptedBackend(script)
+    policy = UpstreamResilience(hedge_delay=0.01)
+    client = GeminiClient(backend=backend, resilience=policy)
+    await client.initialize_session()
+    responses = await collect(client)
+    assert [r.text for r in responses] == ["ok"]
+    primary, hedge = backend.sessions
+    assert hedge.closed and not primary.closed and client.session is primary
+    assert policy.counters["hedges"] == 1 and policy.counters["hedge_wins"] == 0
+
+@pytest.mark.asyncio
+async def test_hedge_that_cannot_connect_leaves_the_primary_to_answer():
+    backend = ScriptedBackend(lambda i: FailingSession(backend, fail=False, delay=0.05) if i == 1 else None)
+    policy = UpstreamResilience(hedge_delay=0.01)
+    client = GeminiClient(backend=backend, resilience=policy)
+    await client.initialize_session()
+    responses = await collect(client)
+    assert [r.text for r in responses] == ["ok"]
+    assert backend.connects == 2 and client.session is backend.sessions[0]
+
+def test_incomplete_backend_fails_when_created():
+    class NoUploads(GeminiBackend):
+        def connect(self, model, config): return None
+    with pytest.raises(TypeError): NoUploads()
@@ -0,0 +1,63 @@
+# backend/gemini_service/tests/test_response_cache.py
+import time
+
+import pytest
+
+from gemini_client import VoiceConfig
+from response_cache import CachedResponse, InMemoryResponseCache, ResponseCache, ResponseRecorder, cache_key, replay
+
+VOICE = VoiceConfig("Charon", "en-US")
+
+def response(size: int, created_at: float = None) -> CachedResponse:
+    return CachedResponse([(0.0, "audio", bytes(size))], time.time() if created_at is None else created_at)
+
+def test_key_ignores_whitespace_and_case_but_not_inputs():
+    key = cache_key("Hello   World", "user", False, VOICE)
+    assert key == cache_key(" hello world ", "user", False, VOICE)
+    assert key != cache_key("hello world", "user", True, VOICE)
+    assert key != cache_key("hello world", "user", False, VoiceConfig("Puck", "en-US"))
+    assert key != cache_key("hello world", "user", False, VOICE, ["abc"])
+
+def test_lru_eviction_by_count_and_bytes():
+    cache = InMemoryResponseCache(max_entries=2, max_bytes=100)
+    cache.put("a", response(10)); cache.put("b", response(10))
+    assert cache.get("a") # "b" is now least recently used
+    cache.put("c", response(10))
+    assert cache.get("b") is None and cache.get("a") and cache.get("c")
+    cache.put("d", response(95))
+    assert cache.stats()["entries"] == 1 and cache.stats()["bytes"] == 95
+    cache.put("e", response(101))
+    assert cache.get("e") is None and cache.stats()["rejected"] == 1
+
+def test_expired_entries_miss():
+    cache = InMemoryResponseCache(ttl_seconds=60)
+    cache.put("a", response(1, created_at=0))
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1 and cache.stats()["entries"] == 0
+
+def test_incomplete_cache_backend_fails_when_created():
+    class NoStats(ResponseCache):
+        def get(self, key): return None
+        def put(self, key, response): pass
+    with pytest.raises(TypeError): NoStats()
+
+def test_recorder_skips_failed_and_oversized_responses():
+    recorder = ResponseRecorder(max_bytes=1000)
+    recorder.record_json({"type": "text", "content": "hi"})
+    recorder.record_json({"type": "error", "error": "boom"})
+    assert recorder.finish() is None
+    recorder = ResponseRecorder(max_bytes=10)
+    recorder.record_audio(bytes(11))
+    assert recorder.finish() is None and not recorder.events
+
+@pytest.mark.asyncio
+async def test_replay_sends_events_in_order():
+    recorder = ResponseRecorder(max_bytes=1000)
+    recorder.record_json({"type": "text", "content": "a"})
+    recorder.record_audio(b"pcm")
+    recorder.record_json({"type": "text", "content": "ab"})
+    sent = []
+    async def send_json(message): sent.append(message)
+    async def send_audio(audio): sent.append(audio)
+    await replay(recorder.finish(), send_json, send_audio, paced=True)
+    assert sent == [{"type": "text", "content": "a"}, b"pcm", {"type": "text", "content": "ab"}]
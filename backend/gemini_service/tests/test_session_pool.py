@@ -0,0 +1,131 @@
+# backend/gemini_service/tests/test_session_pool.py
+import asyncio
+
+import pytest
+
+from gemini_backends import SimulatedGeminiBackend, SimulationConfig
+from gemini_client import GeminiClient
+from session_pool import SessionPool, SessionPoolExhausted, voice_key
+
+pytestmark = pytest.mark.asyncio
+
+DEFAULT = voice_key("Charon", "en-US")
+
+def make_pool(client_cls=GeminiClient, **kwargs) -> SessionPool:
+    backend = SimulatedGeminiBackend(SimulationConfig(first_token_ms=0, token_latency_ms=0))
+    kwargs = {"min_size": 0, "max_size": 2, "acquire_timeout": 0.2, **kwargs}
+    return SessionPool(lambda: client_cls(backend=backend), DEFAULT, **kwargs)
+
+class SlowClient(GeminiClient):
+    async def initialize_session(self, *args, **kwargs):
+        await asyncio.sleep(10)
+
+async def test_fresh_session_returns_to_the_shared_pool():
+    pool = make_pool()
+    client = await pool.acquire("Charon", "en-US")
+    assert pool.stats()["leased"] == 1 and pool.stats()["size"] == 1
+    await pool.release(client)
+    assert pool.stats()["idle"] == 1
+    assert await pool.acquire("Charon", "en-US") is client
+    assert pool.stats()["reused"] == 1 and pool.stats()["size"] == 1
+    await pool.close()
+
+async def test_used_session_is_parked_for_its_owner_only():
+    pool = make_pool()
+    client = await pool.acquire("Charon", "en-US", owner="a")
+    client.has_history = True # It sent a turn
+    await pool.release(client, owner="a")
+    assert pool.stats()["parked"] == 1 and pool.stats()["idle"] == 0
+    other = await pool.acquire("Charon", "en-US", owner="b")
+    assert other is not client
+    assert await pool.acquire("Charon", "en-US", owner="a") is client
+    assert pool.stats()["parked_reused"] == 1
+    await pool.close()
+
+async def test_used_session_without_owner_is_closed():
+    pool = make_pool()
+    client = await pool.acquire("Charon", "en-US")
+    client.has_history = True
+    await pool.release(client)
+    assert client.session is None
+    assert pool.stats()["size"] == 0
+    await pool.close()
+
+async def test_forget_closes_the_parked_session_and_frees_its_slot():
+    pool = make_pool()
+    client = await pool.acquire("Charon", "en-US", owner="a")
+    client.has_history = True
+    await pool.release(client, owner="a")
+    await pool.forget("a")
+    assert client.session is None
+    assert pool.stats()["parked"] == 0 and pool.stats()["size"] == 0
+    await pool.close()
+
+async def test_voice_change_replaces_the_parked_session():
+    pool = make_pool()
+    client = await pool.acquire("Charon", "en-US", owner="a")
+    client.has_history = True
+    await pool.release(client, owner="a")
+    other = await pool.acquire("Puck", "en-US", owner="a")
+    assert other is not client and other.voice_config.name == "Puck"
+    await asyncio.sleep(0) # The stale session is closed in the background
+    assert client.session is None
+    assert pool.stats()["size"] == 1
+    await pool.close()
+
+async def test_exhausted_when_every_session_is_leased():
+    pool = make_pool(max_size=1)
+    await pool.acquire("Charon", "en-US")
+    with pytest.raises(SessionPoolExhausted):
+        await pool.acquire("Charon", "en-US")
+    assert pool.stats()["exhausted"] == 1 and pool.stats()["size"] == 1
+    await pool.close()
+
+async def test_parked_session_is_evicted_to_make_room():
+    pool = make_pool(max_size=1)
+    client = await pool.acquire("Charon", "en-US", owner="a")
+    client.has_history = True
+    await pool.release(client, owner="a")
+    other = await pool.acquire("Charon", "en-US", owner="b")
+    assert other is not client
+    assert pool.stats()["size"] == 1 and pool.stats()["evicted"] == 1
+    await pool.close()
+
+async def test_waiter_gets_the_released_session():
+    pool = make_pool(max_size=1, acquire_timeout=1)
+    client = await pool.acquire("Charon", "en-US")
+    waiter = asyncio.create_task(pool.acquire("Charon", "en-US"))
+    await asyncio.sleep(0.01)
+    await pool.release(client)
+    assert await waiter is client
+    await pool.close()
+
+async def test_cancelled_creation_gives_its_slot_back():
+    pool = make_pool(SlowClient, max_size=1)
+    task = asyncio.create_task(pool.acquire("Charon", "en-US"))
+    await asyncio.sleep(0.01)
+    assert pool.stats()["size"] == 1
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert pool.stats()["size"] == 0 and pool.stats()["create_failures"] == 0
+    await pool.close()
+
+async def test_probe_drops_dead_idle_sessions():
+    pool = make_pool(min_size=0)
+    client = await pool.acquire("Charon", "en-US")
+    await pool.release(client)
+    client.session.close() # Dies while idle; is_healthy() can't tell
+    assert client.is_healthy()
+    await pool._evict_idle()
+    assert pool.stats()["probe_failures"] == 1 and pool.stats()["unhealthy"] == 1
+    assert pool.stats()["size"] == 0 and client.session is None
+    await pool.close()
+
+async def test_release_after_close_does_not_close_twice():
+    pool = make_pool()
+    client = await pool.acquire("Charon", "en-US")
+    await pool.close()
+    assert client.session is None
+    await pool.release(client) # Shutdown already closed it; no warning, nothing left to close
+    assert pool.stats()["size"] == 0
@@ -0,0 +1,113 @@
+# backend/gemini_service/tests/test_session_recorder.py
+import asyncio
+import json
+import threading
+
+import pytest
+
+from session_recorder import CLOSE, IN_BINARY, IN_TEXT, OPEN, OUT_SIZE, OUT_TEXT, SUFFIX, SessionRecorder, mask_user_content, read_records, recording_files
+from session_replay import load_sessions, turns
+
+pytestmark = pytest.mark.asyncio
+
+def recorder(tmp_path, **kwargs):
+    recorder = SessionRecorder(str(tmp_path), flush_interval=60, **kwargs)
+    recorder.start()
+    return recorder
+
+def files(tmp_path):
+    return recording_files([str(tmp_path)])
+
+async def test_records_are_read_back_in_order(tmp_path):
+    rec = recorder(tmp_path, outbound_bytes=16)
+    session = rec.session("alice", "/ws/alice", "v=1")
+    session.inbound({"type": "websocket.receive", "text": '{"type": "ping"}'})
+    session.inbound({"type": "websocket.receive", "bytes": b"\x01binary"})
+    session.outbound("text", b'{"type":"pong","padding":"' + b"x" * 100 + b'"}')
+    session.close(1000, "bye")
+    await rec.close()
+    (path,) = files(tmp_path)
+    records = list(read_records(path))
+    assert [kind for kind, *_ in records] == [OPEN, IN_TEXT, IN_BINARY, OUT_TEXT, CLOSE]
+    assert {session for _, session, _, _ in records} == {1}
+    assert json.loads(records[0][3])["client_id"] == "alice" and records[1][3] == b'{"type": "ping"}'
+    out = records[3][3]
+    assert OUT_SIZE.unpack_from(out)[0] == 128 and out[OUT_SIZE.size:] == b'{"type":"pong","' # Size plus the first 16 bytes
+    assert json.loads(records[4][3]) == {"code": 1000, "reason": "bye"}
+    assert [t["type"] for t in turns(load_sessions([str(tmp_path)])[0].frames)] == ["ping"]
+
+async def test_torn_last_record_is_skipped(tmp_path):
+    rec = recorder(tmp_path)
+    session = rec.session("alice", "/ws/alice")
+    for n in range(3): session.inbound({"text": json.dumps({"type": "text_message", "text": str(n)})})
+    await rec.close()
+    (path,) = files(tmp_path)
+    data = path.read_bytes()
+    path.write_bytes(data[:-5]) # Crashed mid-write
+    assert [payload for kind, _, _, payload in read_records(path) if kind == IN_TEXT] == [b'{"type": "text_message", "text": "0"}', b'{"type": "text_message", "text": "1"}']
+
+async def test_rotation_repeats_open_records_and_keeps_max_files(tmp_path):
+    rec = recorder(tmp_path, max_file_bytes=200, max_files=2)
+    first, second = rec.session("a", "/ws/a"), rec.session("b", "/ws/b")
+    await rec.flush()
+    second.close(1000)
+    for n in range(3):
+        first.inbound({"text": json.dumps({"type": "text_message", "text": "x" * 150})})
+        await rec.flush() # Each flush overflows 200 bytes, so each starts a new file
+    await rec.close()
+    kept = files(tmp_path)
+    assert len(kept) == 2 and rec.counters["files_rotated"] == 3
+    for path in kept:
+        opens = [session for kind, session, _, _ in read_records(path) if kind == OPEN]
+        assert opens == [1] # Still connected; the closed session isn't repeated
+    assert len(load_sessions([str(tmp_path)])[0].frames) == 2 # The frames in the remaining files
+
+async def test_rotation_leaves_other_runs_alone(tmp_path):
+    other = tmp_path / f"ws-19990101000000-1-000001{SUFFIX}"
+    other.write_bytes(b"GWSR\x01")
+    rec = recorder(tmp_path, max_file_bytes=1, max_files=1)
+    session = rec.session("a", "/ws/a")
+    for _ in range(3):
+        session.inbound({"text": "{}"})
+        await rec.flush()
+    await rec.close()
+    assert other.exists() and len(files(tmp_path)) == 2
+
+async def test_close_waits_for_the_flush_in_progress(tmp_path):
+    rec = SessionRecorder(str(tmp_path), flush_interval=0.01)
+    rec.start()
+    writing, release, active = threading.Event(), threading.Event(), []
+    write = rec._write
+    def slow_write(*args):
+        active.append(1)
+        assert len(active) == 1 # Never two writer threads on the same file
+        writing.set()
+        release.wait(1)
+        write(*args)
+        active.pop()
+    rec._write = slow_write
+    session = rec.session("a", "/ws/a")
+    session.inbound({"text": "first"})
+    await asyncio.to_thread(writing.wait, 1) # The background flush is in its thread
+    session.inbound({"text": "second"})
+    closing = asyncio.create_task(rec.close())
+    await asyncio.sleep(0.02)
+    release.set()
+    await closing
+    (path,) = files(tmp_path)
+    assert [payload for kind, _, _, payload in read_records(path) if kind == IN_TEXT] == [b"first", b"second"]
+
+async def test_full_buffer_drops_records(tmp_path):
+    rec = recorder(tmp_path, max_buffer_bytes=200)
+    session = rec.session("a", "/ws/a")
+    session.inbound({"text": "x" * 300})
+    assert rec.counters["dropped_records"] == 1
+    await rec.close()
+
+async def test_masking_keeps_sizes_and_structure():
+    message = json.dumps({"type": "multimodal_message", "text": "secret", "files": [{"mime_type": "image/png", "data": "c2VjcmV0"}]}).encode()
+    masked = json.loads(mask_user_content(IN_TEXT, message))
+    assert masked == {"type": "multimodal_message", "text": "xxxxxx", "files": [{"mime_type": "image/png", "data": "AAAAAAAA"}]}
+    frame = b"\x01" * 12 + b"payload"
+    assert mask_user_content(IN_BINARY, frame) == b"\x01" * 12 + bytes(7)
+    assert mask_user_content(IN_TEXT, b"not json") == b"xxxxxxxx"
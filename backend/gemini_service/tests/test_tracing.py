@@ -0,0 +1,76 @@
+# backend/gemini_service/tests/test_tracing.py
+
+import pytest
+
+import tracing
+from tracing import NOOP_TRACE, SpanExporter, Trace, Tracer, current_trace, reset_trace, use_trace
+
+class Collector(SpanExporter):
+    def __init__(self): self.batches = []
+    async def export(self, spans): self.batches.append(spans)
+
+def by_name(spans):
+    return {span["name"]: span for span in spans}
+
+def test_nested_spans_are_parented_to_the_open_span():
+    trace = Trace("client", "m1")
+    with trace.span("handle"):
+        with trace.span("validate"): pass
+        with trace.span("upstream", model="flash") as span: span.set(chunks=3)
+    trace.add_span("queued", 0, 1_000_000)
+    spans = by_name(trace.finish())
+    assert spans["handle"]["parent_span_id"] is None
+    assert spans["validate"]["parent_span_id"] == spans["upstream"]["parent_span_id"] == spans["handle"]["span_id"]
+    assert spans["queued"]["parent_span_id"] is None and spans["queued"]["duration_ms"] == 1.0
+    assert spans["upstream"]["attributes"] == {"client_id": "client", "message_id": "m1", "model": "flash", "chunks": 3}
+    assert len({span["trace_id"] for span in spans.values()}) == 1
+
+def test_failed_span_records_the_error_and_unwinds():
+    trace = Trace("client")
+    with pytest.raises(KeyError):
+        with trace.span("outer"):
+            with trace.span("inner"): raise KeyError("x")
+    with trace.span("after"): pass
+    spans = by_name(trace.finish())
+    assert spans["inner"]["attributes"]["error"] == spans["outer"]["attributes"]["error"] == "KeyError"
+    assert spans["after"]["parent_span_id"] is None
+
+def test_accumulated_operations_become_one_span():
+    trace = Trace("client")
+    for _ in range(3): trace.accumulate("send", 1000)
+    (span,) = trace.finish()
+    assert span["name"] == "send" and span["attributes"]["count"] == 3 and span["end_unix_nano"] - span["start_unix_nano"] == 3000
+
+def test_sampling(monkeypatch):
+    assert Tracer(None).start_trace("client") is NOOP_TRACE # No exporter, no tracing
+    tracer = Tracer(Collector(), sample_rate=0.5)
+    monkeypatch.setattr(tracing.random, "random", lambda: 0.7)
+    assert tracer.start_trace("client") is NOOP_TRACE
+    monkeypatch.setattr(tracing.random, "random", lambda: 0.2)
+    assert tracer.start_trace("client").sampled
+
+def test_current_trace_is_scoped_to_the_context():
+    assert current_trace() is NOOP_TRACE
+    trace = Trace("client")
+    token = use_trace(trace)
+    assert current_trace() is trace
+    reset_trace(token)
+    assert current_trace() is NOOP_TRACE
+
+@pytest.mark.asyncio
+async def test_finished_traces_are_buffered_up_to_the_limit_and_flushed():
+    exporter = Collector()
+    tracer = Tracer(exporter, max_buffered_spans=2)
+    for _ in range(2):
+        trace = tracer.start_trace("client")
+        with trace.span("a"): pass
+        with trace.span("b"): pass
+        tracer.finish(trace, outcome="ok")
+    tracer.finish(NOOP_TRACE)
+    assert tracer.counters["spans"] == 2 and tracer.counters["dropped_spans"] == 2
+    await tracer.close()
+    assert [len(batch) for batch in exporter.batches] == [2] and exporter.batches[0][0]["attributes"]["outcome"] == "ok"
+
+def test_exporter_without_export_fails_when_created():
+    class Silent(SpanExporter): pass
+    with pytest.raises(TypeError): Silent()
@@ -0,0 +1,93 @@
+# backend/gemini_service/tests/test_upload_stream.py
+import errno
+import os
+
+import pytest
+
+from binary_protocol import FRAME_AUDIO_CHUNK, FRAME_FILE_CHUNK, ProtocolError, decode_frame, encode_frame
+from upload_stream import RamBudget, UploadManager, sniff_mime_type
+
+pytestmark = pytest.mark.asyncio
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(120)
+
+def chunk(upload_id, seq, payload, final=False):
+    return decode_frame(encode_frame(FRAME_FILE_CHUNK, upload_id, seq, payload, final))
+
+def manager(tmp_path, **kwargs):
+    kwargs = {"max_upload_bytes": 1024, "max_pending_uploads": 2, "spill_threshold": 64, "budget": RamBudget(1 << 20),
+              "spool_dir": str(tmp_path), **kwargs}
+    return UploadManager(**kwargs)
+
+async def test_small_upload_stays_in_ram(tmp_path):
+    uploads = manager(tmp_path, spill_threshold=1024)
+    uploads.start(1, "image/png")
+    assert await uploads.add(chunk(1, 0, PNG[:40])) is None
+    upload = await uploads.add(chunk(1, 1, PNG[40:], final=True))
+    assert upload.path is None and bytes(upload.buffer) == PNG
+    assert uploads.budget.in_use == len(PNG)
+    uploads.take(1).close()
+    assert uploads.budget.in_use == 0
+
+async def test_large_upload_spills_to_a_mapped_temp_file(tmp_path):
+    uploads = manager(tmp_path)
+    uploads.start(1, "image/png")
+    await uploads.add(chunk(1, 0, PNG[:40]))
+    upload = await uploads.add(chunk(1, 1, PNG[40:], final=True))
+    path = upload.path
+    assert path and os.path.dirname(path) == str(tmp_path)
+    assert bytes(upload.buffer) == PNG and upload.mime_type == "image/png"
+    assert uploads.budget.in_use == 0 # The RAM reservation went with the spill
+    uploads.take(1).close()
+    assert not os.path.exists(path)
+
+async def test_exhausted_ram_budget_spills_early(tmp_path):
+    uploads = manager(tmp_path, spill_threshold=1024, budget=RamBudget(16))
+    upload = await uploads.add(chunk(1, 0, PNG, final=True))
+    assert upload.path is not None and bytes(upload.buffer) == PNG
+    uploads.clear()
+
+async def test_declared_limits_are_checked_up_front(tmp_path):
+    uploads = manager(tmp_path)
+    with pytest.raises(ProtocolError): uploads.start(1, "application/x-msdownload")
+    with pytest.raises(ProtocolError): uploads.start(1, "image/png", size=4096)
+    uploads.start(1); uploads.start(2)
+    with pytest.raises(ProtocolError): uploads.start(3)
+
+async def test_oversized_upload_is_discarded(tmp_path):
+    uploads = manager(tmp_path, max_upload_bytes=100)
+    await uploads.add(chunk(1, 0, PNG[:64]))
+    with pytest.raises(ProtocolError):
+        await uploads.add(chunk(1, 1, PNG[64:]))
+    assert not os.listdir(tmp_path)
+    with pytest.raises(ProtocolError): # Gone: a later chunk can't resume it
+        await uploads.add(chunk(1, 2, b"x"))
+
+async def test_out_of_order_and_mismatched_content_are_rejected(tmp_path):
+    uploads = manager(tmp_path)
+    await uploads.add(chunk(1, 0, PNG[:10]))
+    with pytest.raises(ProtocolError): await uploads.add(chunk(1, 2, PNG[10:20]))
+    uploads.start(2, "application/pdf")
+    with pytest.raises(ProtocolError): await uploads.add(chunk(2, 0, PNG, final=True))
+    with pytest.raises(ProtocolError):
+        await uploads.add(decode_frame(encode_frame(FRAME_AUDIO_CHUNK, 3, 0, b"pcm")))
+
+async def test_disk_error_fails_only_that_upload(tmp_path):
+    uploads = manager(tmp_path)
+    await uploads.add(chunk(1, 0, PNG[:70])) # Spilled
+    await uploads.add(chunk(2, 0, b"hello"))
+    def full(_):
+        raise OSError(errno.ENOSPC, "No space left on device")
+    uploads._uploads[1]._file.write = full
+    with pytest.raises(OSError, match="Upload 1 failed"):
+        await uploads.add(chunk(1, 1, PNG[70:], final=True))
+    assert 1 not in uploads._uploads and not os.listdir(tmp_path)
+    upload = await uploads.add(chunk(2, 1, b" world", final=True))
+    assert bytes(upload.buffer) == b"hello world"
+    uploads.clear()
+
+async def test_sniffing():
+    assert sniff_mime_type(PNG) == "image/png"
+    assert sniff_mime_type(b"%PDF-1.7\n") == "application/pdf"
+    assert sniff_mime_type("héllo".encode("utf-8")[:2]) == "text/plain" # Cut mid-character
+    assert sniff_mime_type(b"\x00\x01\x02\x03binary") is None
@@ -0,0 +1,108 @@
+# backend/gemini_service/trace_collector.py
+#
+# Minimal stand-in for an OpenTelemetry collector, for looking at traces locally.
+#
+#   python trace_collector.py --port 4318 --output collected_spans.jsonl
+#   TRACING_ENABLED=true TRACE_EXPORTER=otlp TRACE_SAMPLE_RATE=1 python main.py
+#
+# Accepts OTLP/HTTP JSON on POST /v1/traces (what tracing.OtlpHttpExporter sends), appends
+# each span as one JSON line, and on Ctrl+C prints per-stage duration percentiles. Any real
+# collector listening on :4318 works the same way from the server's side.
+#
+# Summarize a file written by TRACE_EXPORTER=file (or by this collector) without serving:
+#
+#   python trace_collector.py --summarize traces.jsonl
+import argparse
+import json
+import logging
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, Iterable, List
+
+from load_test import percentile
+
+logger = logging.getLogger(__name__)
+
+def _attribute_value(value: Dict[str, Any]) -> Any:
+    if "intValue" in value: return int(value["intValue"])
+    for key in ("stringValue", "boolValue", "doubleValue"):
+        if key in value: return value[key]
+    return None
+
+def flatten_otlp(payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """OTLP/JSON export request -> span records in the same shape tracing.JsonlFileExporter writes"""
+    spans = []
+    for resource_spans in payload.get("resourceSpans", []):
+        for scope_spans in resource_spans.get("scopeSpans", []):
+            for span in scope_spans.get("spans", []):
+                start, end = int(span["startTimeUnixNano"]), int(span["endTimeUnixNano"])
+                spans.append({"trace_id": span["traceId"], "span_id": span["spanId"], "parent_span_id": span.get("parentSpanId") or None,
+                              "name": span["name"], "start_unix_nano": start, "end_unix_nano": end,
+                              "duration_ms": round((end - start) / 1e6, 3),
+                              "attributes": {a["key"]: _attribute_value(a["value"]) for a in span.get("attributes", [])}})
+    return spans
+
+def summarize(spans: Iterable[Dict[str, Any]]) -> str:
+    """Per-stage count and duration percentiles (ms), slowest p95 first"""
+    durations: Dict[str, List[float]] = defaultdict(list)
+    traces = set()
+    for span in spans:
+        durations[span["name"]].append(span["duration_ms"])
+        traces.add(span["trace_id"])
+    lines = [f"{len(traces)} traces", f"{'stage':<24}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}"]
+    for name, values in sorted(durations.items(), key=lambda item: -percentile(sorted(item[1]), 95)):
+        values.sort()
+        lines.append(f"{name:<24}{len(values):>8}{percentile(values, 50):>10.2f}{percentile(values, 95):>10.2f}"
+                     f"{percentile(values, 99):>10.2f}{values[-1]:>10.2f}")
+    return "\n".join(lines)
+
+class CollectorHandler(BaseHTTPRequestHandler):
+    output: Path
+    spans: List[Dict[str, Any]]
+
+    def do_POST(self):
+        if self.path != "/v1/traces":
+            self.send_error(404)
+            return
+        try:
+            spans = flatten_otlp(json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0)))))
+        except (ValueError, KeyError) as e:
+            self.send_error(400, f"Invalid OTLP JSON: {e}")
+            return
+        with self.output.open("a", encoding="utf-8") as f:
+            for span in spans: f.write(json.dumps(span, separators=(",", ":")) + "\n")
+        self.spans.extend(spans)
+        body = b"{}"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Receive OTLP/HTTP JSON traces from the Gemini WebSocket service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4318)
+    parser.add_argument("--output", default="collected_spans.jsonl", help="Append received spans here (JSON lines)")
+    parser.add_argument("--summarize", metavar="FILE", help="Print the stage summary of a span file and exit")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.summarize:
+        with open(args.summarize, encoding="utf-8") as f:
+            print(summarize(json.loads(line) for line in f if line.strip()))
+    else:
+        CollectorHandler.output, CollectorHandler.spans = Path(args.output), []
+        server = ThreadingHTTPServer((args.host, args.port), CollectorHandler)
+        logger.info(f"Collecting traces on http://{args.host}:{args.port}/v1/traces -> {args.output}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            print(summarize(CollectorHandler.spans))
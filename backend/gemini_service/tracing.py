@@ -0,0 +1,242 @@
+# backend/gemini_service/tracing.py
+import asyncio
+import contextvars
+import json
+import logging
+import random
+import time
+import urllib.request
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Opt-in per-message tracing. One Trace covers one client message, from parsing its frame
+# to the last reply; code on the hot path records spans on the trace in the current context:
+#
+#     with current_trace().span("validate"): ...
+#
+# When tracing is disabled or the message isn't sampled, current_trace() returns a shared
+# no-op trace, so instrumented code pays a ContextVar lookup and an empty `with`.
+
+class _NoopSpan:
+    __slots__ = ()
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+    def set(self, **attributes): pass
+
+_NOOP_SPAN = _NoopSpan()
+
+class NoopTrace:
+    sampled = False
+    def span(self, name: str, **attributes) -> _NoopSpan: return _NOOP_SPAN
+    def add_span(self, name: str, start_ns: int, end_ns: int, **attributes): pass
+    def accumulate(self, name: str, duration_ns: int): pass
+    def set(self, **attributes): pass
+
+NOOP_TRACE = NoopTrace()
+
+class _Span:
+    __slots__ = ("trace", "name", "attributes", "start_ns", "span_id", "parent_id")
+
+    def __init__(self, trace: "Trace", name: str, attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        trace = self.trace
+        self.span_id = trace._next_id()
+        self.parent_id = trace._stack[-1] if trace._stack else None
+        trace._stack.append(self.span_id)
+        self.start_ns = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end_ns = time.time_ns()
+        stack = self.trace._stack
+        if stack and stack[-1] == self.span_id: stack.pop()
+        elif self.span_id in stack: stack.remove(self.span_id) # Closed out of order (e.g. an abandoned async generator)
+        if exc_type is not None: self.attributes["error"] = exc_type.__name__
+        self.trace.spans.append((self.span_id, self.parent_id, self.name, self.start_ns, end_ns, self.attributes))
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+class Trace:
+    """Spans of one sampled message. Spans opened while another is open become its children."""
+
+    sampled = True
+
+    def __init__(self, client_id: str, message_id: Optional[str] = None):
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.client_id = client_id
+        self.message_id = message_id
+        self.attributes: Dict[str, Any] = {}
+        self.spans: List[Tuple[int, Optional[int], str, int, int, Dict[str, Any]]] = []
+        self._stack: List[int] = []
+        self._span_seq = 0
+        self._totals: Dict[str, List[int]] = {} # name -> [first start_ns, total ns, count]
+
+    def _next_id(self) -> int:
+        self._span_seq += 1
+        return self._span_seq
+
+    def span(self, name: str, **attributes) -> _Span:
+        return _Span(self, name, attributes)
+
+    def add_span(self, name: str, start_ns: int, end_ns: int, **attributes):
+        """Record a span measured elsewhere (e.g. time spent waiting in a queue)"""
+        self.spans.append((self._next_id(), self._stack[-1] if self._stack else None, name, start_ns, end_ns, attributes))
+
+    def accumulate(self, name: str, duration_ns: int):
+        """Sum many tiny operations (per-chunk sends) into one span instead of one span each"""
+        totals = self._totals.get(name)
+        if totals is None: self._totals[name] = [time.time_ns() - duration_ns, duration_ns, 1]
+        else: totals[1] += duration_ns; totals[2] += 1
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self) -> List[Dict[str, Any]]:
+        """Flatten into exportable span records (all share trace_id, client_id and message_id)"""
+        for name, (start_ns, total_ns, count) in self._totals.items():
+            self.add_span(name, start_ns, start_ns + total_ns, count=count, aggregated=True)
+        self._totals.clear()
+        base = {"client_id": self.client_id, "message_id": self.message_id, **self.attributes}
+        return [{"trace_id": self.trace_id, "span_id": f"{span_id:016x}", "parent_span_id": f"{parent:016x}" if parent else None,
+                 "name": name, "start_unix_nano": start_ns, "end_unix_nano": end_ns,
+                 "duration_ms": round((end_ns - start_ns) / 1e6, 3), "attributes": {**base, **attributes}}
+                for span_id, parent, name, start_ns, end_ns, attributes in self.spans]
+
+_current: contextvars.ContextVar = contextvars.ContextVar("gemini_trace", default=NOOP_TRACE)
+
+def current_trace():
+    return _current.get()
+
+def use_trace(trace) -> contextvars.Token:
+    """Make `trace` current for this context (and tasks created from it)"""
+    return _current.set(trace)
+
+def reset_trace(token: contextvars.Token):
+    _current.reset(token)
+
+# --- Exporters ---
+class SpanExporter(ABC):
+    @abstractmethod
+    async def export(self, spans: List[Dict[str, Any]]): ...
+    async def close(self): pass
+
+class JsonlFileExporter(SpanExporter):
+    """Appends one JSON span per line to a local file"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    async def export(self, spans):
+        lines = "".join(json.dumps(span, separators=(",", ":")) + "\n" for span in spans)
+        await asyncio.to_thread(self._append, lines)
+
+    def _append(self, lines: str):
+        with open(self.path, "a", encoding="utf-8") as f: f.write(lines)
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool): return {"boolValue": value}
+    if isinstance(value, int): return {"intValue": str(value)}
+    if isinstance(value, float): return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+class OtlpHttpExporter(SpanExporter):
+    """Posts spans as OTLP/HTTP JSON (e.g. to an OpenTelemetry collector on :4318, or trace_collector.py)"""
+
+    def __init__(self, endpoint: str, service_name: str = "gemini-ws-service", timeout: float = 5.0):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+
+    def _payload(self, spans: List[Dict[str, Any]]) -> bytes:
+        otlp_spans = [{
+            "traceId": span["trace_id"], "spanId": span["span_id"], "parentSpanId": span["parent_span_id"] or "",
+            "name": span["name"], "kind": 1, "startTimeUnixNano": str(span["start_unix_nano"]), "endTimeUnixNano": str(span["end_unix_nano"]),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span["attributes"].items() if v is not None],
+        } for span in spans]
+        return json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": "gemini_service.tracing"}, "spans": otlp_spans}],
+        }]}).encode("utf-8")
+
+    async def export(self, spans):
+        await asyncio.to_thread(self._post, self._payload(spans))
+
+    def _post(self, body: bytes):
+        request = urllib.request.Request(self.endpoint, data=body, headers={"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(request, timeout=self.timeout) as response: response.read()
+
+# --- Tracer ---
+class Tracer:
+    """Samples messages, and batches finished traces to an exporter from a background task"""
+
+    def __init__(self, exporter: Optional[SpanExporter], sample_rate: float = 1.0, flush_interval: float = 2.0, max_buffered_spans: int = 10000):
+        self.exporter = exporter
+        self.enabled = exporter is not None and sample_rate > 0
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.max_buffered_spans = max_buffered_spans
+        self._buffer: List[Dict[str, Any]] = []
+        self._task: Optional[asyncio.Task] = None
+        self.counters = {"traces": 0, "spans": 0, "dropped_spans": 0, "export_failures": 0}
+
+    def start_trace(self, client_id: str, message_id: Optional[str] = None):
+        """A new Trace if this message is sampled, else NOOP_TRACE"""
+        if not self.enabled or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return NOOP_TRACE
+        return Trace(client_id, message_id)
+
+    def finish(self, trace, **attributes):
+        if not trace.sampled: return
+        trace.set(**attributes)
+        spans = trace.finish()
+        self.counters["traces"] += 1
+        if len(self._buffer) + len(spans) > self.max_buffered_spans:
+            self.counters["dropped_spans"] += len(spans) # Exporter can't keep up; never grow without bound
+            return
+        self._buffer.extend(spans)
+        self.counters["spans"] += len(spans)
+
+    def start(self):
+        if self.enabled: self._task = asyncio.create_task(self._run(), name="trace-exporter")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+        await self.flush()
+        if self.exporter: await self.exporter.close()
+
+    async def flush(self):
+        if not self._buffer: return
+        batch, self._buffer = self._buffer, []
+        try:
+            await self.exporter.export(batch)
+        except Exception as e:
+            self.counters["export_failures"] += 1
+            logger.warning(f"Trace export failed ({len(batch)} spans dropped): {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "sample_rate": self.sample_rate, "buffered_spans": len(self._buffer), **self.counters}
+
+def create_tracer(enabled: bool, exporter: str = "file", sample_rate: float = 0.1, path: str = "traces.jsonl",
+                  endpoint: str = "http://localhost:4318/v1/traces") -> Tracer:
+    """Build the tracer selected by TRACING_ENABLED / TRACE_EXPORTER (file | otlp)"""
+    if not enabled: return Tracer(None, 0.0)
+    if exporter == "file": return Tracer(JsonlFileExporter(path), sample_rate)
+    if exporter == "otlp": return Tracer(OtlpHttpExporter(endpoint), sample_rate)
+    raise ValueError(f"Unknown trace exporter '{exporter}'")
@@ -0,0 +1,273 @@
+# backend/gemini_service/upload_stream.py
+# Streaming uploads for FILE_CHUNK frames (see binary_protocol.py).
+#
+# A client may announce a file with
+#     {"type": "upload_start", "upload_id": n, "mime_type": "...", "filename": "...", "size": bytes}
+# before streaming its chunks; the declared type and size are checked right away and the
+# content is sniffed as soon as the first bytes arrive, so unsupported or oversized files
+# are rejected without being buffered. Chunks stay in RAM up to a spill threshold (and only
+# while the process-wide RAM budget allows), then go to a temp file that is mmapped when
+# the upload completes. Either way the client gets a memoryview, not a copy. Disk work runs in
+# a thread, so a slow or full disk stalls only the connection uploading, not the event loop.
+import asyncio
+import logging
+import mmap
+import os
+import tempfile
+from typing import Dict, Optional
+
+from binary_protocol import FRAME_FILE_CHUNK, BinaryFrame, ProtocolError
+from gemini_client import SUPPORTED_MIME_TYPES
+
+logger = logging.getLogger(__name__)
+
+SNIFF_BYTES = 64 # Enough for every signature in sniff_mime_type
+
+# Declared types that share a container with a sniffed type
+_COMPATIBLE_TYPES = {
+    "application/zip": {"application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                        "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+                        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"},
+    "video/mp4": {"video/mov", "video/mp4", "audio/x-m4a"},
+    "audio/mpeg": {"audio/mp3", "audio/mpeg"},
+    "video/mpeg": {"video/mpeg", "video/mpg", "video/mpegps"},
+    "image/heif": {"image/heic", "image/heif"},
+    "text/plain": {t for t in SUPPORTED_MIME_TYPES if t.startswith("text/") or t in (
+        "application/json", "application/x-javascript", "application/x-typescript", "application/x-python-code", "application/rtf")},
+}
+
+def sniff_mime_type(head: bytes) -> Optional[str]:
+    """Best-effort content type from the leading bytes of a file"""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"): return "image/png"
+    if head.startswith(b"\xff\xd8\xff"): return "image/jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP": return "image/webp"
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE": return "audio/wav"
+    if head[:4] == b"RIFF" and head[8:12] == b"AVI ": return "video/avi"
+    if head[4:8] == b"ftyp":
+        brand = head[8:12]
+        if brand in (b"heic", b"heix", b"hevc", b"heim", b"heis", b"mif1", b"msf1"): return "image/heif"
+        return "video/mp4" # isom/mp42/qt/M4A all share the ISO-BMFF container
+    if head.startswith(b"%PDF-"): return "application/pdf"
+    if head.startswith(b"{\\rtf"): return "application/rtf"
+    if head.startswith(b"PK\x03\x04"): return "application/zip"
+    if head.startswith(b"ID3") or head[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"): return "audio/mpeg"
+    if head.startswith(b"OggS"): return "audio/ogg"
+    if head.startswith(b"fLaC"): return "audio/flac"
+    if head[:2] in (b"\xff\xf1", b"\xff\xf9"): return "audio/aac"
+    if head.startswith(b"FORM") and head[8:12] in (b"AIFF", b"AIFC"): return "audio/aiff"
+    if head.startswith(b"\x00\x00\x01\xba") or head.startswith(b"\x00\x00\x01\xb3"): return "video/mpeg"
+    if head.startswith(b"FLV"): return "video/flv"
+    if head.startswith(b"\x30\x26\xb2\x75\x8e\x66\xcf\x11"): return "video/wmv"
+    try:
+        head.decode("utf-8") # A multi-byte char may be cut at the end of the sniff window
+    except UnicodeDecodeError as e:
+        if e.start < len(head) - 3: return None
+    return "text/plain" if b"\x00" not in head else None
+
+def resolve_mime_type(declared: Optional[str], sniffed: Optional[str]) -> Optional[str]:
+    """Pick the type to send upstream; None when the content contradicts the declared type"""
+    if declared and declared not in SUPPORTED_MIME_TYPES:
+        return None
+    if sniffed is None:
+        return declared # Nothing recognisable; fall back to what the client told us
+    if declared is None:
+        return sniffed if sniffed in SUPPORTED_MIME_TYPES else None
+    if declared == sniffed or declared in _COMPATIBLE_TYPES.get(sniffed, ()):
+        return declared
+    return None
+
+class RamBudget:
+    """Process-wide cap on upload bytes held in memory; uploads spill to disk beyond it"""
+
+    def __init__(self, limit_bytes: int):
+        self.limit_bytes = limit_bytes
+        self.in_use = 0
+
+    def try_reserve(self, nbytes: int) -> bool:
+        if self.in_use + nbytes > self.limit_bytes:
+            return False
+        self.in_use += nbytes
+        return True
+
+    def release(self, nbytes: int):
+        self.in_use = max(0, self.in_use - nbytes)
+
+class StreamingUpload:
+    def __init__(self, upload_id: int, mime_type: Optional[str], filename: Optional[str], declared_size: Optional[int],
+                 max_bytes: int, spill_threshold: int, spool_dir: Optional[str], budget: RamBudget):
+        self.upload_id = upload_id
+        self.declared_mime_type = mime_type
+        self.mime_type = mime_type
+        self.filename = filename
+        self.declared_size = declared_size
+        self.max_bytes = max_bytes
+        self.spill_threshold = spill_threshold
+        self.spool_dir = spool_dir
+        self.budget = budget
+
+        self.size = 0
+        self.next_seq = 0
+        self.complete = False
+        self.path: Optional[str] = None # Set once spilled to disk
+        self._memory: Optional[bytearray] = bytearray()
+        self._reserved = 0
+        self._file = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._view: Optional[memoryview] = None
+        self._sniffed = False
+
+    async def write(self, seq: int, chunk: memoryview, final: bool):
+        if self.complete:
+            raise ProtocolError(f"Upload {self.upload_id} already completed")
+        if seq != self.next_seq:
+            raise ProtocolError(f"Upload {self.upload_id} chunk {seq} out of order (expected {self.next_seq})")
+        self.next_seq += 1
+        self.size += len(chunk)
+        if self.size > self.max_bytes or (self.declared_size is not None and self.size > self.declared_size):
+            raise ProtocolError(f"Upload {self.upload_id} exceeds {min(self.max_bytes, self.declared_size or self.max_bytes)} bytes")
+
+        if self._file is None and (self.size > self.spill_threshold or not self.budget.try_reserve(len(chunk))):
+            await self._spill()
+        if self._file is not None:
+            await asyncio.to_thread(self._file.write, chunk)
+        else:
+            self._reserved += len(chunk)
+            self._memory += chunk
+
+        if not self._sniffed and (self.size >= SNIFF_BYTES or final):
+            await self._check_content()
+        if final:
+            await self._finish()
+
+    async def _check_content(self):
+        self._sniffed = True
+        if self._memory is not None:
+            head = bytes(self._memory[:SNIFF_BYTES])
+        else:
+            head = await asyncio.to_thread(self._read_head)
+        sniffed = sniff_mime_type(head)
+        resolved = resolve_mime_type(self.declared_mime_type, sniffed)
+        if resolved is None:
+            raise ProtocolError(f"Upload {self.upload_id} rejected: content looks like '{sniffed}', declared '{self.declared_mime_type}'")
+        self.mime_type = resolved
+
+    def _read_head(self) -> bytes:
+        self._file.flush()
+        with open(self.path, "rb") as f: return f.read(SNIFF_BYTES)
+
+    async def _spill(self):
+        self._file, self.path = await asyncio.to_thread(self._create_spool_file, self._memory)
+        self._memory = None
+        self.budget.release(self._reserved); self._reserved = 0
+        logger.info(f"Upload {self.upload_id} ({self.filename}) spilled to {self.path}")
+
+    def _create_spool_file(self, memory: bytearray):
+        """Temp file holding what was buffered so far; removed again if that write fails"""
+        fd, path = tempfile.mkstemp(prefix="upload-", dir=self.spool_dir)
+        spool = os.fdopen(fd, "w+b")
+        try:
+            if memory: spool.write(memory)
+        except OSError:
+            spool.close(); os.unlink(path)
+            raise
+        return spool, path
+
+    async def _finish(self):
+        if self._file is not None:
+            self._view = await asyncio.to_thread(self._map_file)
+        else:
+            self._view = memoryview(self._memory)
+        self.complete = True
+
+    def _map_file(self) -> memoryview:
+        self._file.flush()
+        if not self.size: return memoryview(b"")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)
+
+    @property
+    def buffer(self) -> memoryview:
+        """Zero-copy view of the completed upload (RAM or mmapped temp file)"""
+        if not self.complete:
+            raise ValueError(f"Upload {self.upload_id} is incomplete")
+        return self._view
+
+    def close(self):
+        """Release the buffer, memory reservation and temp file"""
+        if self._view is not None:
+            self._view.release(); self._view = None
+        if self._mmap is not None:
+            try: self._mmap.close()
+            except BufferError: logger.warning(f"Upload {self.upload_id} buffer still referenced; leaving mmap to GC")
+            self._mmap = None
+        if self._file is not None:
+            self._file.close(); self._file = None
+        if self.path:
+            try: os.unlink(self.path)
+            except OSError: pass
+            self.path = None
+        self.budget.release(self._reserved); self._reserved = 0
+        self._memory = None
+
+class UploadManager:
+    """Per-connection set of streaming uploads keyed by upload id"""
+
+    def __init__(self, max_upload_bytes: int, max_pending_uploads: int, spill_threshold: int,
+                 budget: RamBudget, spool_dir: Optional[str] = None):
+        self.max_upload_bytes = max_upload_bytes
+        self.max_pending_uploads = max_pending_uploads
+        self.spill_threshold = spill_threshold
+        self.budget = budget
+        self.spool_dir = spool_dir
+        self._uploads: Dict[int, StreamingUpload] = {}
+
+    def start(self, upload_id: int, mime_type: Optional[str] = None, filename: Optional[str] = None, size: Optional[int] = None) -> StreamingUpload:
+        """Open an upload, rejecting unsupported types and oversized declared sizes up front"""
+        if upload_id in self._uploads:
+            raise ProtocolError(f"Upload {upload_id} already exists")
+        if len(self._uploads) >= self.max_pending_uploads:
+            raise ProtocolError(f"Too many pending uploads (max {self.max_pending_uploads})")
+        if mime_type and mime_type not in SUPPORTED_MIME_TYPES:
+            raise ProtocolError(f"Unsupported MIME type '{mime_type}'")
+        if size is not None and size > self.max_upload_bytes:
+            raise ProtocolError(f"Upload {upload_id} declares {size} bytes; limit is {self.max_upload_bytes}")
+        upload = StreamingUpload(upload_id, mime_type, filename, size, self.max_upload_bytes,
+                                 self.spill_threshold, self.spool_dir, self.budget)
+        self._uploads[upload_id] = upload
+        return upload
+
+    async def add(self, frame: BinaryFrame) -> Optional[StreamingUpload]:
+        """Write a FILE_CHUNK frame; returns the upload once its final chunk arrived. A rejected
+        chunk (ProtocolError) or a failed disk write (OSError) discards that upload only."""
+        if frame.frame_type != FRAME_FILE_CHUNK:
+            raise ProtocolError(f"Unexpected inbound frame type {frame.frame_type}")
+        upload = self._uploads.get(frame.stream_id)
+        if upload is None:
+            if frame.seq != 0:
+                raise ProtocolError(f"Upload {frame.stream_id} must start at chunk 0, got {frame.seq}")
+            upload = self.start(frame.stream_id) # Unannounced upload: type comes from sniffing
+        try:
+            await upload.write(frame.seq, frame.payload, frame.final)
+        except ProtocolError:
+            self.discard(frame.stream_id)
+            raise
+        except OSError as e:
+            self.discard(frame.stream_id)
+            raise OSError(e.errno, f"Upload {frame.stream_id} failed: {e.strerror or e}") from e
+        return upload if upload.complete else None
+
+    def take(self, upload_id: int) -> StreamingUpload:
+        """Hand over a completed upload; the caller must close() it when done"""
+        upload = self._uploads.get(upload_id)
+        if upload is None:
+            raise ValueError(f"Unknown upload id {upload_id}")
+        if not upload.complete:
+            raise ValueError(f"Upload {upload_id} is incomplete")
+        return self._uploads.pop(upload_id)
+
+    def discard(self, upload_id: int):
+        upload = self._uploads.pop(upload_id, None)
+        if upload: upload.close()
+
+    def clear(self):
+        for upload_id in list(self._uploads): self.discard(upload_id)